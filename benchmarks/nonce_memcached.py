@@ -0,0 +1,69 @@
+"""
+Benchmark the latency added by checking the nonces against memcached,
+compared to the process local nonce ring.
+
+A stand-in memcached server is started on the loopback interface unless
+the address of a real server is given.  The cost of the fail policy is
+measured against a server that does not respond within the timeout.
+
+Usage::
+
+    python benchmarks/nonce_memcached.py [requests] [host:port]
+"""
+
+import sys
+import time
+
+from pmr2.oauth.nonce import NonceRing
+from pmr2.oauth.memcached import MemcachedClient
+from pmr2.oauth.memcached import MemcachedNonceStore
+
+from pmr2.oauth.tests.memcached import StandInMemcachedServer
+
+
+def measure(store, count):
+    now = int(time.time())
+    timings = []
+    base = time.time()
+    for i in xrange(count):
+        start = time.time()
+        store.add(now, (u'client', u'token', u'%d-%f' % (i, base)))
+        timings.append(time.time() - start)
+    timings.sort()
+    return timings
+
+
+def report(name, timings):
+    p50 = timings[len(timings) // 2]
+    p99 = timings[int(len(timings) * 0.99)]
+    print('%-24s p50 %8.1f us  p99 %8.1f us' % (name, p50 * 1e6, p99 * 1e6))
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 10000
+    server = None
+    if len(argv) > 2:
+        host, port = argv[2].rsplit(':', 1)
+        port = int(port)
+    else:
+        server = StandInMemcachedServer()
+        host, port = server.start()
+
+    try:
+        report('NonceRing', measure(NonceRing(), count))
+        store = MemcachedNonceStore(MemcachedClient(host, port))
+        report('MemcachedNonceStore', measure(store, count))
+
+        if server is not None:
+            # every request now exceeds the timeout of the client.
+            server.delay = 0.2
+            store = MemcachedNonceStore(MemcachedClient(host, port),
+                fail_open=True)
+            report('fail policy (timeout)', measure(store, 20))
+    finally:
+        if server is not None:
+            server.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
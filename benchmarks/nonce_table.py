@@ -0,0 +1,97 @@
+"""
+Benchmark the inserts into the shared memory nonce table by concurrent
+processes.
+
+Each process opens the same table and records unique nonces, then every
+process attempts to replay a sample of the nonces recorded by the next
+process, all of which must be rejected.
+
+Usage::
+
+    python benchmarks/nonce_table.py [processes] [nonces_per_process]
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pmr2.oauth.nonce import MmapNonceTable
+
+
+def worker(path, n, processes, count, barrier, results):
+    table = MmapNonceTable(path)
+    now = int(time.time())
+    barrier.wait()
+    start = time.time()
+    accepted = 0
+    for i in xrange(count):
+        accepted += table.add(now, (u'client', u'token', u'%d-%d' % (n, i)))
+    elapsed = time.time() - start
+    barrier.wait()
+    other = (n + 1) % processes
+    replayed = 0
+    for i in xrange(0, count, 100):
+        replayed += table.add(now, (u'client', u'token',
+            u'%d-%d' % (other, i)))
+    table.close()
+    results.put((accepted, replayed, elapsed))
+
+
+class Barrier(object):
+    # multiprocessing in older versions of Python lacks a barrier.
+
+    def __init__(self, n):
+        self.n = n
+        self.count = multiprocessing.Value('i', 0)
+        self.lock = multiprocessing.Lock()
+        self.events = [multiprocessing.Event(), multiprocessing.Event()]
+        self.generation = multiprocessing.Value('i', 0)
+
+    def wait(self):
+        self.lock.acquire()
+        event = self.events[self.generation.value % 2]
+        self.count.value += 1
+        if self.count.value == self.n:
+            self.count.value = 0
+            self.generation.value += 1
+            self.events[self.generation.value % 2].clear()
+            event.set()
+        self.lock.release()
+        event.wait()
+
+
+def main(argv):
+    processes = len(argv) > 1 and int(argv[1]) or 4
+    count = len(argv) > 2 and int(argv[2]) or 50000
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'nonce')
+        # create the table before the workers.
+        MmapNonceTable(path).close()
+        barrier = Barrier(processes)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=worker,
+                args=(path, n, processes, count, barrier, results))
+            for n in range(processes)]
+        for p in workers:
+            p.start()
+        stats = [results.get() for p in workers]
+        for p in workers:
+            p.join()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    accepted = sum(s[0] for s in stats)
+    replayed = sum(s[1] for s in stats)
+    elapsed = max(s[2] for s in stats)
+    print('%d processes, %d nonces each' % (processes, count))
+    print('accepted %d, replays accepted %d' % (accepted, replayed))
+    print('%.1f inserts/s in total, %.1f inserts/s per process' % (
+        accepted / elapsed, accepted / elapsed / processes))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,67 @@
+"""
+Benchmark the extraction of the URL of a request with a long query
+string, such as the batch download URLs with hundreds of parameters,
+against the previous check through oauthlib's urldecode.
+
+Usage::
+
+    python benchmarks/request_url.py [requests] [parameters]
+"""
+
+import sys
+import time
+from urllib import quote_plus
+
+from oauthlib.common import urldecode
+
+from pmr2.oauth.utility import extractRequestURL
+
+
+class Request(object):
+
+    def __init__(self, url, query_string):
+        self.environ = {'ACTUAL_URL': url, 'QUERY_STRING': query_string}
+
+    def get(self, key, default=None):
+        return self.environ.get(key, default)
+
+
+def previous(request):
+    result = request.get('ACTUAL_URL')
+    query_string = request.get('QUERY_STRING')
+    try:
+        urldecode(query_string)
+    except ValueError:
+        query_string = quote_plus(query_string, safe='=&;%+~')
+    result += '?' + query_string
+    return result
+
+
+def run(name, f, requests):
+    start = time.time()
+    for request in requests:
+        f(request)
+    elapsed = time.time() - start
+    print('%-24s %8.1f us/request' % (name, elapsed / len(requests) * 1e6))
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 2000
+    parameters = len(argv) > 2 and int(argv[2]) or 500
+    query_string = '&'.join('file=%%2Fworkspace%%2Fexposure%%2Fmodel-%d.cellml'
+        % i for i in xrange(parameters))
+    url = 'http://nohost/plone/workspace/batch_download'
+    print('%d parameters, %d bytes' % (parameters, len(query_string)))
+
+    run('urldecode', previous,
+        [Request(url, query_string) for i in xrange(count)])
+    run('extractRequestURL', extractRequestURL,
+        [Request(url, query_string) for i in xrange(count)])
+    requests = [Request(url, query_string) for i in xrange(count)]
+    for request in requests:
+        extractRequestURL(request)
+    run('extractRequestURL (memo)', extractRequestURL, requests)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
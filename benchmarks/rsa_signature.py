@@ -0,0 +1,65 @@
+"""
+Benchmark the verification of RSA-SHA1 signatures with the parsed keys
+cached, against oauthlib parsing the key for every request.
+
+Usage::
+
+    python benchmarks/rsa_signature.py [requests] [key_bits]
+"""
+
+import sys
+import time
+
+from Crypto.PublicKey import RSA
+from oauthlib.common import Request
+from oauthlib.oauth1.rfc5849 import SIGNATURE_RSA
+from oauthlib.oauth1.rfc5849 import signature as oauth_signature
+
+from pmr2.oauth.signature import getRSAVerifier
+from pmr2.oauth.signature import verify_rsa_sha1
+
+
+def sign(private_key, n):
+    uri = u'http://example.com/resource'
+    request = Request(uri, u'GET')
+    request.params = [
+        (u'oauth_consumer_key', u'client'),
+        (u'oauth_nonce', u'%020d' % n),
+        (u'oauth_signature_method', SIGNATURE_RSA),
+        (u'oauth_timestamp', u'%d' % time.time()),
+    ]
+    base_string = oauth_signature.construct_base_string(u'GET',
+        oauth_signature.normalize_base_string_uri(uri),
+        oauth_signature.normalize_parameters(request.params))
+    request.signature = oauth_signature.sign_rsa_sha1(base_string,
+        private_key)
+    return request
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 500
+    bits = len(argv) > 2 and int(argv[2]) or 2048
+    key = RSA.generate(bits)
+    private_key = key.exportKey()
+    public_key = key.publickey().exportKey()
+    requests = [sign(private_key, n) for n in xrange(count)]
+
+    start = time.time()
+    for request in requests:
+        assert oauth_signature.verify_rsa_sha1(request, public_key)
+    uncached = time.time() - start
+
+    start = time.time()
+    for request in requests:
+        verifier = getRSAVerifier(u'client', public_key)
+        assert verify_rsa_sha1(request, verifier)
+    cached = time.time() - start
+
+    print('%d requests, %d bit key' % (count, bits))
+    print('uncached: %8.1f us/request' % (uncached / count * 1e6))
+    print('cached:   %8.1f us/request' % (cached / count * 1e6))
+    print('speedup:  %8.1fx' % (uncached / cached))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,56 @@
+"""
+Benchmark the matching of subpaths against a content type mapping with
+hundreds of patterns per type, compiled against the linear scan.
+
+Usage::
+
+    python benchmarks/scope_matching.py [patterns] [lookups]
+"""
+
+import random
+import sys
+import time
+
+from pmr2.oauth.scope import ContentTypeScopeManager
+
+
+def main(argv):
+    patterns = len(argv) > 1 and int(argv[1]) or 500
+    count = len(argv) > 2 and int(argv[2]) or 20000
+    random.seed(0)
+
+    valid = []
+    for i in xrange(patterns):
+        if i % 2:
+            valid.append('view_%d' % i)
+        else:
+            valid.append('api/%d/*' % i)
+    mapping = {'Workspace': valid}
+
+    sm = ContentTypeScopeManager()
+    mapping_id = sm.addMapping(mapping)
+    compiled = sm.getCompiledMapping(mapping_id)
+
+    subpaths = []
+    for i in xrange(count):
+        n = random.randrange(patterns * 2)
+        subpaths.append(random.choice(['view_%d', 'api/%d/files']) % n)
+
+    start = time.time()
+    linear = [sm.validateTypeSubpathMapping('Workspace', s, mapping)
+        for s in subpaths]
+    linear_elapsed = time.time() - start
+
+    start = time.time()
+    matched = [compiled.match('Workspace', s) for s in subpaths]
+    compiled_elapsed = time.time() - start
+
+    assert linear == matched
+    print('%d patterns, %d lookups, %d matched' % (
+        patterns, count, sum(matched)))
+    print('linear:   %8.2f us/lookup' % (linear_elapsed / count * 1e6))
+    print('compiled: %8.2f us/lookup' % (compiled_elapsed / count * 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
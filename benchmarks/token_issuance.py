@@ -0,0 +1,86 @@
+"""
+Benchmark the issuance of request tokens by concurrent ZODB connections.
+
+Each thread opens its own connection to a shared FileStorage and issues
+request tokens, one per transaction, retrying on conflict errors.  The
+conflict rate and the issuance throughput are reported for each of the
+token managers.
+
+Usage::
+
+    python benchmarks/token_issuance.py [threads] [tokens_per_thread]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+from ZODB.POSException import ConflictError
+
+from pmr2.oauth.token import TokenManager, ShardedTokenManager
+
+
+def issue(db, count, results):
+    tm = transaction.TransactionManager()
+    conn = db.open(transaction_manager=tm)
+    issued = conflicts = 0
+    try:
+        while issued < count:
+            manager = conn.root()['manager']
+            try:
+                manager.generateRequestToken('consumer-key', 'oob')
+                tm.commit()
+                issued += 1
+            except ConflictError:
+                tm.abort()
+                conflicts += 1
+    finally:
+        conn.close()
+    results.append((issued, conflicts))
+
+
+def run(cls, threads, count):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db = DB(FileStorage(os.path.join(tmpdir, 'Data.fs')))
+        conn = db.open()
+        conn.root()['manager'] = cls()
+        transaction.commit()
+        conn.close()
+
+        results = []
+        workers = [threading.Thread(target=issue, args=(db, count, results))
+            for i in range(threads)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    issued = sum(r[0] for r in results)
+    conflicts = sum(r[1] for r in results)
+    print('%-20s issued %6d  conflicts %6d (%5.1f%%)  %8.1f tokens/s' % (
+        cls.__name__, issued, conflicts,
+        100.0 * conflicts / (issued + conflicts), issued / elapsed))
+
+
+def main(argv):
+    threads = len(argv) > 1 and int(argv[1]) or 8
+    count = len(argv) > 2 and int(argv[2]) or 500
+    print('%d threads, %d tokens each' % (threads, count))
+    for cls in (TokenManager, ShardedTokenManager):
+        run(cls, threads, count)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
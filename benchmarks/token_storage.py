@@ -0,0 +1,78 @@
+"""
+Benchmark the storage size and load time of the tokens.
+
+A number of access tokens are added to each of the token managers and
+committed to a FileStorage.  The size of the storage per token is then
+reported, along with the time taken to load every token through a new
+connection with an empty cache.
+
+Usage::
+
+    python benchmarks/token_storage.py [tokens]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import transaction
+from ZODB.DB import DB
+from ZODB.FileStorage import FileStorage
+
+from pmr2.oauth.token import TokenManager, CompactTokenManager
+
+
+def run(cls, count):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'Data.fs')
+        db = DB(FileStorage(path))
+        conn = db.open()
+        conn.root()['manager'] = manager = cls()
+        transaction.commit()
+        base_size = os.path.getsize(path)
+
+        for i in range(count):
+            token = manager._generateBaseToken('consumer-key')
+            token.access = True
+            token.user = 'user%d' % (i % 100)
+            manager.add(token)
+            if i % 1000 == 999:
+                transaction.commit()
+        transaction.commit()
+        conn.close()
+        db.close()
+        # Only keep the current revisions.
+        db = DB(FileStorage(path))
+        db.pack()
+        size = os.path.getsize(path) - base_size
+
+        db.close()
+        db = DB(FileStorage(path))
+        conn = db.open()
+        manager = conn.root()['manager']
+        keys = list(manager._tokens.keys())
+        start = time.time()
+        for key in keys:
+            manager.get(key).expiry
+        elapsed = time.time() - start
+        conn.close()
+        db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%-20s %8.1f bytes/token  load %8.1f tokens/s' % (
+        cls.__name__, float(size) / count, len(keys) / elapsed))
+
+
+def main(argv):
+    count = len(argv) > 1 and int(argv[1]) or 20000
+    print('%d tokens' % count)
+    for cls in (TokenManager, CompactTokenManager):
+        run(cls, count)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -29,6 +29,7 @@ class ConsumerAddForm(form.AddForm):
         # secret should be generated.
         'title',
         'domain',
+        'rsa_key',
     )
 
     def update(self):
@@ -41,7 +42,8 @@ class ConsumerAddForm(form.AddForm):
         data['key'] = key = random_string(24)
         data['secret'] = secret = random_string(24)
         self._data = data
-        return Consumer(key, secret, data['title'], data['domain'])
+        return Consumer(key, secret, data['title'], data['domain'],
+            data.get('rsa_key'))
 
     def add(self, obj):
         cm = zope.component.getMultiAdapter(
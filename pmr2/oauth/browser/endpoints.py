@@ -1,68 +1,118 @@
-import zope.component
-
 from zope.component.hooks import getSite
 from oauthlib.oauth1.rfc5849.endpoints import base
 from oauthlib.oauth1.rfc5849.errors import OAuth1Error
 from oauthlib.oauth1 import ResourceEndpoint
+from oauthlib.oauth1.rfc5849 import SIGNATURE_HMAC, SIGNATURE_RSA
 
-from pmr2.oauth.interfaces import IOAuthRequestValidatorAdapter
-from pmr2.oauth.utility import safe_unicode, extractRequestURL
+from pmr2.oauth.signature import getRSAVerifier
+from pmr2.oauth.signature import verify_hmac_sha1
+from pmr2.oauth.signature import verify_rsa_sha1
+from pmr2.oauth.utility import getRequestValidator
 
 
 class BaseEndpoint(base.BaseEndpoint):
 
+    # the parsed oauthlib request, see ``parse_request``.
+    _oauth_request = None
+
     def __init__(self, context, request):
         self.context = context
         self.request = request
 
     @property
     def request_validator(self):
-        site = getSite()
-        return zope.component.getMultiAdapter((site, self.request),
-            IOAuthRequestValidatorAdapter)
+        return getRequestValidator(getSite(), self.request)
 
     @property
     def token_generator(self):
         raise NotImplementedError('Unused in this implementation')
 
+    def parse_request(self):
+        """
+        Return the oauthlib request for the request of this endpoint.
+
+        The request is only normalized and parsed once, a copy of the
+        parsed result is returned such that any modifications made by
+        the validation process will not affect subsequent calls.
+        """
+
+        if self._oauth_request is None:
+            # The values extracted from the request are shared through
+            # the request validator.
+            validator = self.request_validator
+            self._oauth_request = base.BaseEndpoint._create_request(self,
+                validator.uri, validator.http_method, validator.body,
+                validator.headers)
+
+        request = self._oauth_request
+        result = request.__class__.__new__(request.__class__)
+        result.__dict__.update(request.__dict__)
+        return result
+
     def _create_request(self, uri=None, http_method=None, body=None,
             headers=None):
 
+        if uri is http_method is body is headers is None:
+            # Default extraction, reuse the parsed request.
+            return self.parse_request()
+
+        validator = self.request_validator
         if uri is None:
-            uri = safe_unicode(extractRequestURL(self.request))
+            uri = validator.uri
         if http_method is None:
-            http_method = safe_unicode(self.request.method)
-
+            http_method = validator.http_method
         if headers is None:
-            # These are the only headers that affect the signature for
-            # an OAuth request.
-            headers = {
-                u'Content-Type':
-                    safe_unicode(self.request.getHeader('Content-type')),
-            }
-            if self.request._auth:
-                headers[u'Authorization'] = safe_unicode(self.request._auth)
-
+            headers = validator.headers
         if body is None:
-            self.request.stdin.seek(0)
-            body = safe_unicode(self.request.stdin.read())
+            body = validator.body
 
         return base.BaseEndpoint._create_request(self,
             uri, http_method, body, headers)
 
+    def _check_signature(self, request, is_token_request=False):
+        # The nonce is only reserved for requests with a valid signature,
+        # such that unsigned requests cannot exhaust the nonce manager.
+        return (self._verify_signature(request, is_token_request) and
+            self.request_validator.reserve_nonce(request.client_key,
+                request.timestamp, request.nonce,
+                request.resource_owner_key))
+
+    def _verify_signature(self, request, is_token_request=False):
+        if request.signature_method == SIGNATURE_HMAC:
+            # Use the prepared HMAC rather than having oauthlib derive
+            # it from the secrets for every request.
+            mac = self.request_validator.get_hmac(request.client_key,
+                request.resource_owner_key, is_token_request)
+            return verify_hmac_sha1(request, mac)
+
+        if request.signature_method != SIGNATURE_RSA:
+            return base.BaseEndpoint._check_signature(self, request,
+                is_token_request)
+
+        # Use the cached verifier rather than having oauthlib parse the
+        # key for every request.
+        rsa_key = self.request_validator.get_rsa_key(
+            request.client_key, request)
+        verifier = getRSAVerifier(request.client_key, rsa_key)
+        return verify_rsa_sha1(request, verifier)
+
 
 class ResourceEndpointValidator(BaseEndpoint, ResourceEndpoint):
     """
     Only provide the core validation, built on top of the magic we have.
     """
 
-    def check_request(self):
+    def check_request(self, request=None):
         """
         Raise exception on errors involving with the structure of the
         request.
+
+        An already parsed oauthlib request may be provided, otherwise
+        the one from ``parse_request`` will be used.
         """
 
-        request = self._create_request()
+        if request is None:
+            request = self.parse_request()
         self._check_transport_security(request)
         self._check_mandatory_parameters(request)
 
@@ -74,10 +124,38 @@ class ResourceEndpointValidator(BaseEndpoint, ResourceEndpoint):
                 request.resource_owner_key):
             raise OAuth1Error
 
-        if not self.request_validator.validate_timestamp_and_nonce(
-                request.client_key, request.timestamp, request.nonce, request,
-                access_token=request.resource_owner_key):
-            raise OAuth1Error
+        # The nonce is checked along with the signature, please see
+        # ``_check_signature``.
 
         return True
 
+    def validate_request(self, request, realms=None):
+        """
+        Validate the credentials and signature of an oauthlib request
+        that had already been parsed and passed ``check_request``.
+
+        This is the remaining half of ``validate_protected_resource_request``
+        such that the request is not parsed nor checked again.  Returns
+        the same tuple.
+        """
+
+        valid_client = self.request_validator.validate_client_key(
+                request.client_key, request)
+        if not valid_client:
+            request.client_key = self.request_validator.dummy_client
+
+        valid_resource_owner = self.request_validator.validate_access_token(
+            request.client_key, request.resource_owner_key, request)
+        if not valid_resource_owner:
+            request.resource_owner_key = \
+                self.request_validator.dummy_access_token
+
+        valid_realm = self.request_validator.validate_realms(
+            request.client_key, request.resource_owner_key, request,
+            uri=request.uri, realms=realms)
+
+        valid_signature = self._check_signature(request)
+
+        v = all((valid_client, valid_resource_owner, valid_realm,
+                 valid_signature))
+        return v, request
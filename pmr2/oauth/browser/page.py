@@ -1,11 +1,13 @@
 import zope.component
 import zope.interface
+from zope.publisher.browser import BrowserPage
 
 from Products.CMFCore.utils import getToolByName
 
 from pmr2.z3cform import page
 
 from pmr2.oauth import MessageFactory as _
+from pmr2.oauth.maintenance import purgeExpiredTokens
 from pmr2.oauth.browser.template import path, ViewPageTemplateFile
 
 
@@ -28,3 +30,15 @@ class PMR2OAuthPage(page.SimplePage):
 
     def update(self):
         self.request['disable_border'] = True
+
+
+class PurgeExpiredTokensPage(BrowserPage):
+    """
+    Purge the expired tokens.  Meant to be called periodically, such as
+    from cron.
+    """
+
+    def __call__(self):
+        count = purgeExpiredTokens(self.context, self.request)
+        self.request.response.setHeader('Content-type', 'text/plain')
+        return 'Purged %d expired tokens.' % count
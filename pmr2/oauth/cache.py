@@ -0,0 +1,147 @@
+import time
+from threading import Lock
+
+from BTrees.Length import Length
+
+_marker = object()
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that discards the least recently used entries.
+
+    Entries may also be given a time to live (in seconds), after which
+    they will be treated as missing.  This is meant as a process local
+    cache in front of the persistent managers, so access is guarded by
+    a lock such that one instance can be shared by multiple threads.
+    """
+
+    def __init__(self, size=1000, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._lock = Lock()
+        self._clear()
+
+    def _clear(self):
+        # key to entry, where entry is [prev, next, key, value, expiry]
+        self._entries = {}
+        # the sentinel for the circular linked list of entries, with the
+        # most recently used entry following it.
+        root = self._root = []
+        root[:] = [root, root, None, None, None]
+
+    def _unlink(self, entry):
+        prev, next_ = entry[0], entry[1]
+        prev[1] = next_
+        next_[0] = prev
+
+    def _link(self, entry):
+        root = self._root
+        first = root[1]
+        entry[0] = root
+        entry[1] = first
+        first[0] = entry
+        root[1] = entry
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[4] is not None and entry[4] < time.time():
+                self._unlink(entry)
+                del self._entries[key]
+                return default
+            self._unlink(entry)
+            self._link(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        expiry = self.ttl and time.time() + self.ttl or None
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            else:
+                if len(self._entries) >= self.size:
+                    oldest = self._root[0]
+                    self._unlink(oldest)
+                    del self._entries[oldest[2]]
+                entry = [None, None, key, None, None]
+                self._entries[key] = entry
+            entry[3] = value
+            entry[4] = expiry
+            self._link(entry)
+        finally:
+            self._lock.release()
+
+    def pop(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._unlink(entry)
+            return entry[3]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._clear()
+        finally:
+            self._lock.release()
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return self._entries.keys()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, _marker) is not _marker
+
+
+class VolatileCacheMixin(object):
+    """
+    Caches for the persistent managers, kept for each ZODB connection.
+
+    The caches are kept in volatile attributes of the manager, along
+    with the generation they were created for.  Invalidating increments
+    the persistent generation counter, so that the caches of every ZODB
+    client are discarded once they see the change.
+    """
+
+    # Managers created before this was introduced will have the counter
+    # created on the first invalidation.
+    _generation = None
+
+    def _invalidateCache(self):
+        if self._generation is None:
+            self._generation = Length()
+        self._generation.change(1)
+
+    def _getCache(self, name, size, ttl=None, key=None):
+        """
+        Return the cache kept in the volatile attribute `name`.  The
+        cache is also replaced whenever `key` changes, for the values
+        that the cached entries depend on but not tracked by the
+        generation counter.
+        """
+
+        generation = self._generation is not None and self._generation() or 0
+        generation = (generation, key)
+        cached = getattr(self, name, None)
+        if cached is None or cached[0] != generation:
+            cached = (generation, LRUCache(size, ttl))
+            setattr(self, name, cached)
+        return cached[1]
@@ -1,5 +1,6 @@
 from persistent import Persistent
 from BTrees.OOBTree import OOBTree
+from BTrees.Length import Length
 
 from zope.container.contained import Contained
 from zope.annotation.interfaces import IAttributeAnnotatable
@@ -8,11 +9,15 @@ from zope.schema import fieldproperty
 
 from pmr2.oauth.interfaces import IConsumer
 from pmr2.oauth.interfaces import IConsumerManager
+from pmr2.oauth.cache import VolatileCacheMixin
 from pmr2.oauth.factory import factory
+from pmr2.oauth.signature import invalidateHMAC
 from pmr2.oauth.utility import random_string
 
+_missing = object()
 
-class ConsumerManager(Persistent, Contained):
+
+class ConsumerManager(Persistent, Contained, VolatileCacheMixin):
     """\
     A very basic consumer manager for the default layer.
 
@@ -35,19 +40,48 @@ class ConsumerManager(Persistent, Contained):
     def DUMMY_SECRET(self):
         return self.__dummy_secret
     
+    # Size of the cache of the consumers kept for each ZODB connection.
+    consumer_cache_size = 1000
+
+    # Size of the cache of the keys of unknown consumers, kept apart from
+    # the above such that unknown keys cannot evict the consumers.
+    missing_cache_size = 1000
+
     def __init__(self):
         self.__dummy_key = random_string(24)
         self.__dummy_secret = random_string(24)
         self._consumers = OOBTree()
+        self._generation = Length()
+
+    def _getConsumerCache(self):
+        return self._getCache('_v_consumer_cache', self.consumer_cache_size)
+
+    def _getMissingConsumerCache(self):
+        return self._getCache('_v_missing_consumer_cache',
+            self.missing_cache_size)
 
     def add(self, consumer):
         assert IConsumer.providedBy(consumer)
         if self.get(consumer.key):
             raise ValueError('consumer %s already exists', consumer.key)
         self._consumers[consumer.key] = consumer
+        self._invalidateCache()
 
     def get(self, consumer_key, default=None):
-        return self._consumers.get(consumer_key, default)
+        # Unknown keys are cached also, such that a lookup costs the
+        # same for both valid and invalid keys once cached.
+        consumer = self._getConsumerCache().get(consumer_key, None)
+        if consumer is None:
+            consumer = self._getMissingConsumerCache().get(consumer_key, None)
+        if consumer is None:
+            consumer = self._consumers.get(consumer_key, _missing)
+            if consumer is _missing:
+                self._getMissingConsumerCache().set(consumer_key, consumer)
+            else:
+                self._getConsumerCache().set(consumer_key, consumer)
+        if consumer is _missing:
+            return default
+        return consumer
 
     def getValidated(self, consumer_key, default=None):
         # Provision for further checks by alternative implementations.
@@ -57,12 +91,19 @@ class ConsumerManager(Persistent, Contained):
         return self._consumers.keys()
 
     def makeDummy(self):
-        return Consumer(str(self.DUMMY_KEY), str(self.DUMMY_SECRET))
+        # The dummy never changes, so it is only built once.
+        dummy = getattr(self, '_v_dummy_consumer', None)
+        if dummy is None:
+            dummy = Consumer(str(self.DUMMY_KEY), str(self.DUMMY_SECRET))
+            self._v_dummy_consumer = dummy
+        return dummy
 
     def remove(self, consumer):
         if IConsumer.providedBy(consumer):
             consumer = consumer.key
         self._consumers.pop(consumer)
+        self._invalidateCache()
+        invalidateHMAC(consumer)
 
 ConsumerManagerFactory = factory(ConsumerManager)
 
@@ -78,13 +119,15 @@ class Consumer(Persistent):
     secret = fieldproperty.FieldProperty(IConsumer['secret'])
     title = fieldproperty.FieldProperty(IConsumer['title'])
     domain = fieldproperty.FieldProperty(IConsumer['domain'])
+    rsa_key = fieldproperty.FieldProperty(IConsumer['rsa_key'])
 
-    def __init__(self, key, secret, title=None, domain=None):
+    def __init__(self, key, secret, title=None, domain=None, rsa_key=None):
         assert not ((key is None) or (secret is None))
         self.key = key
         self.secret = secret
         self.title = title
         self.domain = domain
+        self.rsa_key = rsa_key
 
     def __eq__(self, other):
         same_type = isinstance(other, self.__class__)
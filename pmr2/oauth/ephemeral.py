@@ -0,0 +1,189 @@
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import cPickle
+
+import zope.component
+import zope.interface
+
+from pmr2.oauth.interfaces import IEphemeralStore
+from pmr2.oauth.utility import random_string
+
+_marker = object()
+
+
+class MemoryEphemeralStore(object):
+    """\
+    An ephemeral store that keeps the values in the memory of the
+    current process.
+
+    Only suitable for deployments with a single Zope instance, or where
+    the OAuth requests of a given client are always directed to the same
+    instance.  Values are pickled as they are by the SQLite store, such
+    that each thread gets its own copy, so modified values must be set
+    again.
+    """
+
+    zope.interface.implements(IEphemeralStore)
+
+    # Interval (in seconds) between the removal of the expired values.
+    purge_interval = 60
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._last_purge = time.time()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[1] < time.time():
+            return default
+        return cPickle.loads(entry[0])
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        value = cPickle.dumps(value, 2)
+        self._lock.acquire()
+        try:
+            self._data[key] = (value, now + ttl)
+        finally:
+            self._lock.release()
+        if now - self._last_purge > self.purge_interval:
+            self.purge(now)
+
+    def pop(self, key, default=None):
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+        finally:
+            self._lock.release()
+        if entry is None or entry[1] < time.time():
+            return default
+        return cPickle.loads(entry[0])
+
+    def purge(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._lock.acquire()
+        try:
+            self._last_purge = timestamp
+            for key, entry in self._data.items():
+                if entry[1] < timestamp:
+                    del self._data[key]
+        finally:
+            self._lock.release()
+
+
+class SQLiteEphemeralStore(object):
+    """\
+    An ephemeral store backed by a SQLite database file, which may be
+    shared by all the Zope instances on the same host.
+
+    Values are pickled, so modified values must be set again.
+    """
+
+    zope.interface.implements(IEphemeralStore)
+
+    purge_interval = 60
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._last_purge = time.time()
+
+    def _getConnection(self):
+        # sqlite connections cannot be shared between threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS ephemeral ('
+                'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                'expiry REAL NOT NULL)')
+            self._local.conn = conn
+        return conn
+
+    def _get(self, conn, key):
+        row = conn.execute('SELECT value FROM ephemeral '
+            'WHERE key = ? AND expiry >= ?', (key, time.time())).fetchone()
+        if row is None:
+            return _marker
+        return cPickle.loads(str(row[0]))
+
+    def get(self, key, default=None):
+        result = self._get(self._getConnection(), key)
+        if result is _marker:
+            return default
+        return result
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        conn = self._getConnection()
+        conn.execute('INSERT OR REPLACE INTO ephemeral VALUES (?, ?, ?)',
+            (key, sqlite3.Binary(cPickle.dumps(value, 2)), now + ttl))
+        if now - self._last_purge > self.purge_interval:
+            self.purge(now)
+
+    def pop(self, key, default=None):
+        conn = self._getConnection()
+        # Reserve the database for writing first, so that the value can
+        # only be popped once across all processes.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            result = self._get(conn, key)
+            conn.execute('DELETE FROM ephemeral WHERE key = ?', (key,))
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+        if result is _marker:
+            return default
+        return result
+
+    def purge(self, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._last_purge = timestamp
+        self._getConnection().execute(
+            'DELETE FROM ephemeral WHERE expiry < ?', (timestamp,))
+
+
+def SQLiteEphemeralStoreFactory():
+    """\
+    Create the SQLite ephemeral store at the path specified by the
+    PMR2_OAUTH_EPHEMERAL_SQLITE environment variable, defaulting to a
+    file in the temporary directory.
+    """
+
+    path = os.environ.get('PMR2_OAUTH_EPHEMERAL_SQLITE') or os.path.join(
+        tempfile.gettempdir(), 'pmr2.oauth.ephemeral.sqlite')
+    return SQLiteEphemeralStore(path)
+
+
+class EphemeralStorageMixin(object):
+    """\
+    Provides access to the registered ephemeral store for the managers,
+    with the keys namespaced to the manager as the store may be shared
+    by multiple sites.
+    """
+
+    # Managers created before this was introduced have none until they
+    # are upgraded, and are namespaced by their persistent id instead.
+    _ephemeral_prefix = None
+
+    def _initEphemeralPrefix(self):
+        self._ephemeral_prefix = random_string(12) + ':'
+
+    def _getEphemeralStore(self):
+        return zope.component.queryUtility(IEphemeralStore)
+
+    def _getEphemeralKey(self, key):
+        prefix = self._ephemeral_prefix
+        if prefix is None:
+            # Not assigned here, as that would write to the ZODB while
+            # reading.
+            prefix = (getattr(self, '_p_oid', None) or '').encode('hex') + ':'
+        return prefix + key
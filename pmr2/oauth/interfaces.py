@@ -60,6 +60,15 @@ class IOAuthRequestValidatorAdapter(zope.interface.Interface):
     Interface for the OAuth adapter.
     """
 
+    uri = zope.interface.Attribute('The URI of the request.')
+
+    http_method = zope.interface.Attribute('The HTTP method of the request.')
+
+    headers = zope.interface.Attribute(
+        'The headers of the request that affect the signature.')
+
+    body = zope.interface.Attribute('The body of the request.')
+
     def __call__():
         """
         Return a boolean value to determine whether access was granted.
@@ -114,6 +123,14 @@ class IConsumer(zope.interface.Interface):
         required=False,
     )
 
+    rsa_key = zope.schema.ASCII(
+        title=_(u'RSA Public Key'),
+        description=_(u'The PEM encoded RSA public key of this client, for '
+                      'clients that sign their requests using RSA-SHA1.  '
+                      'Leave this blank otherwise.'),
+        required=False,
+    )
+
     def validate():
         """
         Self validation.
@@ -405,6 +422,13 @@ class IToken(zope.interface.Interface):
         description=_(u'Expiry timestamp for this token'),
     )
 
+    last_access = zope.schema.Int(
+        title=_(u'Last Access'),
+        description=_(u'Approximate timestamp of the last use of this '
+                      'token, only tracked with an idle timeout'),
+        required=False,
+    )
+
     def validate():
         """
         Self validation.
@@ -449,6 +473,7 @@ class ITokenManager(zope.interface.Interface):
         Return request token identified by token.
 
         Raises NotRequestTokenError when token is not an access token.
+        Raises ExpiredTokenError when token has expired.
         Raises InvalidTokenError if internal consistency (invariants)
         are violated.
         If token is not found and default value is false, 
@@ -460,6 +485,7 @@ class ITokenManager(zope.interface.Interface):
         Return access token identified by token.
 
         Raises NotAccessTokenError when token is not an access token.
+        Raises ExpiredTokenError when token has expired.
         Raises InvalidTokenError if internal consistency (invariants)
         are violated.
         If token is not found and default value is false, 
@@ -471,11 +497,25 @@ class ITokenManager(zope.interface.Interface):
         Return a list of token keys for a user.
         """
 
+    def isExpired(token, timestamp=None):
+        """\
+        Check whether the token has expired at timestamp, which defaults
+        to the current time.
+        """
+
     def remove(token):
         """\
         Remove token.
         """
 
+    def purgeExpired(timestamp=None, limit=None):
+        """\
+        Remove the tokens that have expired before timestamp, which
+        defaults to the current time, up to limit number of tokens.
+
+        Returns the list of removed tokens.
+        """
+
 
 # Other management interfaces
 
@@ -507,9 +547,52 @@ class INonceManager(zope.interface.Interface):
     If nonce must be checked specifically, implement this manager.
     """
 
-    def check(timestamp, nonce):
+    def check(client_key, timestamp, nonce, token=None):
+        """\
+        Check that this nonce can be used by the client with the token
+        (request or access) at timestamp, and record its use.
+
+        Return True if it can be used, False otherwise.
+        """
+
+    def release(client_key, timestamp, nonce, token=None):
+        """\
+        Forget the use of the nonce recorded by ``check``, such as when
+        the request that used it is to be retried after a conflict.
+        """
+
+
+class IEphemeralStore(zope.interface.Interface):
+    """\
+    Storage for short-lived values outside of the ZODB.
+
+    When registered as a utility, the token and scope managers will keep
+    the request tokens and their requested scopes in this store, such
+    that only the access tokens are written to the ZODB.  Writes to the
+    store are not transactional.
+    """
+
+    def get(key, default=None):
+        """\
+        Return the value for key, or default if the key is missing or
+        has expired.
+        """
+
+    def set(key, value, ttl):
+        """\
+        Store the value under key for ttl seconds.
+        """
+
+    def pop(key, default=None):
+        """\
+        Remove and return the value for key, or default if the key is
+        missing or has expired.
+        """
+
+    def purge(timestamp=None):
         """\
-        Check that this nonce can be used.
+        Remove all values that have expired before timestamp, which
+        defaults to the current time.
         """
 
 
@@ -0,0 +1,247 @@
+from logging import getLogger
+
+import transaction
+import zope.component
+from zope.annotation.interfaces import IAnnotations
+from zope.location.location import locate
+
+from pmr2.oauth.interfaces import ITokenManager, IScopeManager
+from pmr2.oauth.interfaces import IContentTypeScopeManager
+from pmr2.oauth.token import TokenManager, CompactTokenManager
+
+logger = getLogger('pmr2.oauth')
+
+
+def purgeExpiredTokens(site, request=None, batch_size=500, commit=True,
+        timestamp=None):
+    """
+    Purge the expired tokens from the token manager for the site, along
+    with their scopes.
+
+    The tokens are removed in batches of batch_size, with the
+    transaction committed after each batch if commit is True, to keep
+    the size of each transaction bounded.
+
+    Returns the number of tokens removed.
+    """
+
+    tm = zope.component.getMultiAdapter((site, request), ITokenManager)
+    sm = zope.component.queryMultiAdapter((site, request), IScopeManager)
+
+    total = 0
+    while True:
+        tokens = tm.purgeExpired(timestamp=timestamp, limit=batch_size)
+        for token in tokens:
+            if sm is None:
+                continue
+            if token.access:
+                sm.delAccessScope(token.key, None)
+            else:
+                sm.popScope(token.key, None)
+
+        total += len(tokens)
+        if commit:
+            transaction.commit()
+        if len(tokens) < batch_size:
+            break
+
+    logger.info('Purged %d expired tokens.', total)
+    return total
+
+
+def _iterMappingAccessKeyBatches(sm, mapping_id, batch_size):
+    # Continue from the last key of the previous batch, as the keys
+    # may be removed from the index by the caller.
+    last = None
+    while True:
+        keys = list(sm.getMappingAccessKeys(mapping_id, last)[:batch_size])
+        if not keys:
+            break
+        yield keys
+        last = keys[-1]
+
+
+def revokeMappingAccess(site, mapping_id, request=None, batch_size=500,
+        commit=True):
+    """
+    Revoke the access tokens granted the mapping, e.g. for a profile
+    that was found to be too broad, along with their scopes.
+
+    The tokens are removed in batches of batch_size, with the
+    transaction committed after each batch if commit is True.
+
+    Returns the number of access keys revoked.
+    """
+
+    tm = zope.component.getMultiAdapter((site, request), ITokenManager)
+    sm = zope.component.getMultiAdapter((site, request),
+        IContentTypeScopeManager)
+
+    total = 0
+    for keys in _iterMappingAccessKeyBatches(sm, mapping_id, batch_size):
+        for key in keys:
+            if tm.get(key) is not None:
+                tm.remove(key)
+            sm.delAccessScope(key, None)
+
+        total += len(keys)
+        if commit:
+            transaction.commit()
+
+    logger.info('Revoked %d access keys granted mapping %d.', total,
+        mapping_id)
+    return total
+
+
+def rescopeMappingAccess(site, mapping_id, new_mapping_id, request=None,
+        batch_size=500, commit=True):
+    """
+    Replace the mapping with the new mapping in the scopes of the access
+    keys granted it, such that the tokens remain valid with the rights
+    of the new mapping instead.
+
+    The scopes are replaced in batches of batch_size, with the
+    transaction committed after each batch if commit is True.
+
+    Returns the number of access keys rescoped.
+    """
+
+    if mapping_id == new_mapping_id:
+        raise ValueError('mapping_id and new_mapping_id are the same')
+
+    sm = zope.component.getMultiAdapter((site, request),
+        IContentTypeScopeManager)
+    # ensure the new mapping exists.
+    sm.getMapping(new_mapping_id)
+
+    total = 0
+    for keys in _iterMappingAccessKeyBatches(sm, mapping_id, batch_size):
+        for key in keys:
+            scope = sm.getAccessScope(key, None)
+            if scope is None:
+                continue
+            scope = set(scope)
+            scope.discard(mapping_id)
+            scope.add(new_mapping_id)
+            sm.delAccessScope(key)
+            sm.setAccessScope(key, scope)
+            total += 1
+
+        if commit:
+            transaction.commit()
+
+    logger.info('Rescoped %d access keys from mapping %d to mapping %d.',
+        total, mapping_id, new_mapping_id)
+    return total
+
+
+def purgeUnusedMappings(site, request=None, commit=True):
+    """
+    Remove the mappings of the content type scope manager for the site
+    that are no longer referenced by a name, as the default, or by the
+    scope of any token.
+
+    Returns the number of mappings removed.
+    """
+
+    sm = zope.component.getMultiAdapter((site, request),
+        IContentTypeScopeManager)
+    removed = sm.purgeUnusedMappings()
+    if commit:
+        transaction.commit()
+
+    logger.info('Purged %d unused mappings.', len(removed))
+    return len(removed)
+
+
+def _iterTokenKeyBatches(tree, batch_size):
+    # Continue from the last key of the previous batch, as the tree may
+    # be modified between the batches.
+    last = None
+    while True:
+        if last is None:
+            keys = tree.keys()
+        else:
+            keys = tree.keys(min=last, excludemin=True)
+        keys = list(keys[:batch_size])
+        if not keys:
+            break
+        yield keys
+        last = keys[-1]
+
+
+def _copyToken(new, token):
+    # Copy the token into the new manager, unless an identical copy is
+    # already there.  Returns whether it was copied.
+    value = new._dumpToken(token)
+    tree = new._getTokenTree(token.key)
+    current = tree.get(token.key, None)
+    if current == value:
+        return False
+    if current is not None:
+        new._unindex_expiry(new._loadToken(current))
+    tree[token.key] = value
+    new._index_expiry(token)
+    return True
+
+
+def compactTokenManager(site, batch_size=500, commit=True):
+    """
+    Convert the default token manager of the site into a
+    CompactTokenManager, which stores the tokens as tuples.
+
+    The tokens are copied in batches of batch_size into the new manager,
+    which is kept under a temporary key until the conversion completes,
+    with the transaction committed after each batch if commit is True.
+    The final transaction copies the tokens added or modified since,
+    drops the ones removed since, and replaces the old manager.  An
+    interrupted conversion continues from the tokens already copied.
+
+    Returns the number of tokens converted, or None if the site has no
+    token manager or it was already converted.
+    """
+
+    annotations = IAnnotations(site)
+    key = TokenManager.__module__ + '.' + TokenManager.__name__
+    old = annotations.get(key, None)
+    if old is None or isinstance(old, CompactTokenManager):
+        return None
+
+    staging_key = key + '.compact'
+    new = annotations.get(staging_key, None)
+    if new is None:
+        new = CompactTokenManager()
+        # The mapping of users is kept as is, to retain the order of the
+        # tokens for each user.
+        new._user_token_map = old._user_token_map
+        # Keep the same namespace for the tokens in the ephemeral store.
+        new._ephemeral_prefix = old._getEphemeralKey('')
+        annotations[staging_key] = new
+
+    copied = 0
+    for tree in old._iterTokenTrees():
+        for keys in _iterTokenKeyBatches(tree, batch_size):
+            for token_key in keys:
+                copied += _copyToken(new, tree[token_key])
+            if commit:
+                transaction.commit()
+            logger.info('Copied %d tokens into the compact token manager.',
+                copied)
+
+    count = 0
+    for tree in old._iterTokenTrees():
+        for token in tree.values():
+            _copyToken(new, token)
+            count += 1
+    for tree in new._iterTokenTrees():
+        for token_key in list(tree.keys()):
+            if token_key not in old._getTokenTree(token_key):
+                new._unindex_expiry(new._loadToken(tree.pop(token_key)))
+
+    annotations[key] = new
+    del annotations[staging_key]
+    locate(new, site, key)
+    if commit:
+        transaction.commit()
+    logger.info('Converted %d tokens into the compact token manager.', count)
+    return count
@@ -0,0 +1,187 @@
+import os
+import time
+import socket
+import hashlib
+import logging
+from threading import Lock
+
+logger = logging.getLogger('pmr2.oauth.memcached')
+
+
+class MemcachedError(Exception):
+    __doc__ = "memcached error"
+
+
+class MemcachedClient(object):
+    """
+    A minimal client for the memcached text protocol.
+
+    Connections are kept in a pool for reuse, and multiple commands can
+    be pipelined within a single round trip through ``execute``.  Any
+    connection that fails or times out is discarded, and the failure is
+    raised as MemcachedError.  As pooled connections may have been
+    closed by the server while idle, a command that fails on one (other
+    than by timing out) is retried once on a new connection.
+    """
+
+    def __init__(self, host='127.0.0.1', port=11211, pool_size=8,
+            timeout=0.05):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._pool = []
+        self._lock = Lock()
+
+    def _acquire(self, pooled=True):
+        if pooled:
+            self._lock.acquire()
+            try:
+                if self._pool:
+                    return self._pool.pop(), True
+            finally:
+                self._lock.release()
+        return self._connect(), False
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port),
+            self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rb')
+
+    def _release(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(conn)
+                return
+        finally:
+            self._lock.release()
+        self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn[1].close()
+            conn[0].close()
+        except socket.error:
+            pass
+
+    def execute(self, commands):
+        """
+        Send the commands, each a complete command with its data block
+        if any, then return the response line for each of them.
+        """
+
+        pooled = True
+        while True:
+            try:
+                conn, reused = self._acquire(pooled)
+            except socket.error, e:
+                raise MemcachedError('cannot connect: %s' % e)
+
+            try:
+                conn[0].sendall(''.join(commands))
+                results = []
+                for command in commands:
+                    line = conn[1].readline()
+                    if not line.endswith('\r\n'):
+                        raise MemcachedError('connection closed')
+                    results.append(line[:-2])
+            except (socket.error, MemcachedError), e:
+                self._close(conn)
+                if reused and not isinstance(e, socket.timeout):
+                    # Most likely closed while idle in the pool.
+                    pooled = False
+                    continue
+                raise MemcachedError(str(e))
+            self._release(conn)
+            return results
+
+    def _add_command(self, key, value, ttl):
+        return 'add %s 0 %d %d\r\n%s\r\n' % (key, ttl, len(value), value)
+
+    def add(self, key, value, ttl):
+        """
+        Store the value only if the key is not already stored.  Returns
+        True if it was stored.
+        """
+
+        result = self.execute([self._add_command(key, value, ttl)])[0]
+        if result not in ('STORED', 'NOT_STORED'):
+            raise MemcachedError(result)
+        return result == 'STORED'
+
+    def delete(self, key):
+        result = self.execute(['delete %s\r\n' % key])[0]
+        if result not in ('DELETED', 'NOT_FOUND'):
+            raise MemcachedError(result)
+        return result == 'DELETED'
+
+
+class MemcachedNonceStore(object):
+    """
+    Record the nonces used in memcached, so that they are shared by all
+    the clients of the same server.
+
+    If the server cannot be reached within the timeout of the client,
+    the nonce is accepted if fail_open is True, otherwise rejected.
+    """
+
+    prefix = 'pmr2.oauth.nonce:'
+
+    def __init__(self, client, window=600, fail_open=False):
+        self.client = client
+        self.window = window
+        self.fail_open = fail_open
+
+    def _digest(self, key):
+        return hashlib.sha1('\0'.join(
+            k is None and '' or unicode(k).encode('utf8') for k in key
+        )).hexdigest()
+
+    def add(self, timestamp, key, now=None):
+        if now is None:
+            now = time.time()
+        if abs(now - timestamp) > self.window:
+            return False
+
+        digest = self._digest(key)
+        # Remember the nonce for as long as its timestamp is valid.
+        ttl = max(int(timestamp + self.window - now), 0) + 1
+        try:
+            return self.client.add(self.prefix + digest, '1', ttl)
+        except MemcachedError, e:
+            logger.warning('Failed to check nonce with memcached: %s', e)
+            return self.fail_open
+
+    def discard(self, timestamp, key):
+        try:
+            self.client.delete(self.prefix + self._digest(key))
+        except MemcachedError, e:
+            logger.warning('Failed to release nonce with memcached: %s', e)
+
+
+_store = None
+_store_lock = Lock()
+
+def getMemcachedNonceStore():
+    """
+    Return the nonce store for the memcached server specified by the
+    PMR2_OAUTH_MEMCACHED environment variable (host:port, defaults to
+    127.0.0.1:11211).  Nonces are accepted when the server is not
+    available only if PMR2_OAUTH_MEMCACHED_FAIL_OPEN is set to 1.
+    """
+
+    global _store
+    _store_lock.acquire()
+    try:
+        if _store is None:
+            address = os.environ.get('PMR2_OAUTH_MEMCACHED',
+                '127.0.0.1:11211')
+            host, port = address.rsplit(':', 1)
+            fail_open = os.environ.get('PMR2_OAUTH_MEMCACHED_FAIL_OPEN') == '1'
+            _store = MemcachedNonceStore(MemcachedClient(host, int(port)),
+                fail_open=fail_open)
+        return _store
+    finally:
+        _store_lock.release()
@@ -0,0 +1,422 @@
+import os
+import sys
+import time
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Not available on this platform, so is MmapNonceTable.
+    fcntl = None
+
+import zope.interface
+from ZODB.POSException import ConflictError
+
+from pmr2.oauth.interfaces import INonceManager
+from pmr2.oauth.memcached import getMemcachedNonceStore
+
+logger = logging.getLogger('pmr2.oauth.nonce')
+
+
+class NonceRing(object):
+    """
+    A replay cache for the nonces used within a time window.
+
+    The nonces are recorded in buckets of sets, selected by the
+    timestamp of the request, that are held in a ring large enough to
+    cover every timestamp within the window either side of the current
+    time.  Buckets that have moved out of the window are dropped as a
+    whole when their slot is reused, so both lookups and inserts take
+    constant time.  The size of each bucket is limited to bound the
+    memory used; once a bucket is full, further keys for that time are
+    accepted without being recorded rather than rejecting every client.
+    """
+
+    def __init__(self, window=600, bucket_size=60, bucket_limit=50000):
+        self.window = window
+        self.bucket_size = bucket_size
+        self.bucket_limit = bucket_limit
+        self._count = 2 * window // bucket_size + 2
+        # each slot holds (bucket index, set of keys)
+        self._buckets = [(None, None)] * self._count
+        # indexes of the buckets found full, to only warn once for each.
+        self._full = set()
+        self._lock = Lock()
+
+    def add(self, timestamp, key, now=None):
+        """
+        Record the key as used at timestamp.
+
+        Returns False if the timestamp is outside of the window, or if
+        the key was already recorded for that time, True otherwise.
+        """
+
+        if now is None:
+            now = time.time()
+        if abs(now - timestamp) > self.window:
+            return False
+
+        index = timestamp // self.bucket_size
+        slot = index % self._count
+        self._lock.acquire()
+        try:
+            bucket_index, keys = self._buckets[slot]
+            if bucket_index != index:
+                # The previous bucket in this slot is out of the window.
+                keys = set()
+                self._buckets[slot] = (index, keys)
+                self._full.discard(bucket_index)
+            if key in keys:
+                return False
+            if len(keys) >= self.bucket_limit:
+                if index not in self._full:
+                    self._full.add(index)
+                    logger.warning('Nonce bucket for %d is full, nonces '
+                        'for this time are no longer recorded.',
+                        index * self.bucket_size)
+                return True
+            keys.add(key)
+            return True
+        finally:
+            self._lock.release()
+
+    def discard(self, timestamp, key):
+        """
+        Forget the key recorded as used at timestamp.
+        """
+
+        index = timestamp // self.bucket_size
+        self._lock.acquire()
+        try:
+            bucket_index, keys = self._buckets[index % self._count]
+            if bucket_index == index:
+                keys.discard(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._buckets = [(None, None)] * self._count
+            self._full = set()
+        finally:
+            self._lock.release()
+
+
+# The window matches the timestamp_lifetime of the oauthlib request
+# validator, beyond which the requests are rejected anyway.
+_ring = NonceRing(window=600)
+
+
+class NonceManager(object):
+    """
+    The default nonce manager.
+
+    The nonces are kept in the memory of the current process, so no
+    writes to the ZODB are needed.  Note that the nonces are not shared
+    between processes.
+    """
+
+    zope.interface.implements(INonceManager)
+
+    def __init__(self, context, request, ring=None):
+        self.context = context
+        self.request = request
+        self.ring = ring is None and _ring or ring
+
+    def check(self, client_key, timestamp, nonce, token=None):
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            return False
+        return self.ring.add(timestamp, (client_key, token, nonce))
+
+    def release(self, client_key, timestamp, nonce, token=None):
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            return
+        self.ring.discard(timestamp, (client_key, token, nonce))
+
+
+class NonceRelease(object):
+    """
+    Release the nonces recorded by a nonce manager when the transaction
+    is aborted due to a conflict, as the publisher will then retry the
+    request, which should not be taken as a replay of itself.
+
+    The publisher aborts the transaction while handling the error, so
+    that is the exception looked for.  Requests aborted for any other
+    reason are not retried, so their nonces remain used.
+    """
+
+    transaction_manager = None
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.nonces = []
+
+    def add(self, client_key, timestamp, nonce, token=None):
+        self.nonces.append((client_key, timestamp, nonce, token))
+
+    def _release(self):
+        nonces, self.nonces = self.nonces, []
+        exc_type = sys.exc_info()[0]
+        if exc_type is None or not issubclass(exc_type, ConflictError):
+            return
+        for args in nonces:
+            try:
+                self.manager.release(*args)
+            except Exception:
+                logger.exception('Failed to release nonce.')
+
+    def abort(self, transaction):
+        self._release()
+
+    def tpc_abort(self, transaction):
+        self._release()
+
+    def tpc_begin(self, transaction):
+        pass
+
+    def commit(self, transaction):
+        pass
+
+    def tpc_vote(self, transaction):
+        pass
+
+    def tpc_finish(self, transaction):
+        self.nonces = []
+
+    def savepoint(self):
+        # Nothing to roll back to, the nonces stay recorded until the
+        # transaction is aborted due to a conflict.
+        return _NoRollback()
+
+    def sortKey(self):
+        return 'pmr2.oauth.nonce:%d' % id(self)
+
+
+class _NoRollback(object):
+
+    def rollback(self):
+        pass
+
+
+class MmapNonceTable(object):
+    """
+    A replay cache shared by the processes on the same host, using a
+    fixed size open addressing hash table in a memory mapped file.
+
+    Each slot holds the fingerprint of a key and the timestamp it was
+    used with.  Slots with timestamps that have left the window are
+    reused by later inserts, so the table never needs to be cleared.
+    The table is split into stripes, each guarded by a lock on its byte
+    range within the file (and a thread lock within this process), and
+    a key is only ever placed within max_probes slots of its home slot
+    in its stripe.  Should all of those slots be in use, the one with
+    the oldest timestamp is taken over, rather than rejecting the key.
+    """
+
+    MAGIC = 'PMR2NONC'
+    _header = struct.Struct('<8sII')
+    _slot = struct.Struct('<Qq')
+
+    def __init__(self, path, slots=1 << 20, window=600, stripe_size=4096,
+            max_probes=64):
+        if fcntl is None:
+            raise NotImplementedError('fcntl is required')
+        assert slots % stripe_size == 0
+        assert max_probes <= stripe_size
+        self.path = path
+        self.slots = slots
+        self.window = window
+        self.stripe_size = stripe_size
+        self.max_probes = max_probes
+        self._locks = [Lock() for i in xrange(slots // stripe_size)]
+        # time of the last warning about the table being full.
+        self._warned = 0
+
+        size = self._header.size + slots * self._slot.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, self._header.size, 0)
+            try:
+                header = os.read(fd, self._header.size)
+                if (len(header) != self._header.size or
+                        self._header.unpack(header) !=
+                        (self.MAGIC, 1, slots)):
+                    # New or incompatible file, (re)initialize it.
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, self._header.pack(self.MAGIC, 1, slots))
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, self._header.size, 0)
+            self._map = mmap.mmap(fd, size)
+        except:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def _fingerprint(self, key):
+        digest = hashlib.sha1('\0'.join(
+            k is None and '' or unicode(k).encode('utf8') for k in key
+        )).digest()
+        result = struct.unpack('<Q', digest[:8])[0]
+        # zero marks a slot that was never used.
+        return result or 1
+
+    def add(self, timestamp, key, now=None):
+        """
+        Record the key as used at timestamp.  Returns False if the key
+        was already recorded, or if the timestamp is outside of the
+        window, True otherwise.
+        """
+
+        if now is None:
+            now = time.time()
+        if abs(now - timestamp) > self.window:
+            return False
+
+        fingerprint = self._fingerprint(key)
+        home = fingerprint % self.slots
+        stripe = home // self.stripe_size
+        start = stripe * self.stripe_size
+        offset = self._header.size + start * self._slot.size
+        length = self.stripe_size * self._slot.size
+        oldest = now - self.window
+
+        lock = self._locks[stripe]
+        lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                free = None
+                evict = None
+                for i in xrange(self.max_probes):
+                    slot = start + (home - start + i) % self.stripe_size
+                    pos = self._header.size + slot * self._slot.size
+                    value, used = self._slot.unpack_from(self._map, pos)
+                    if value == 0:
+                        # Never used, so the key is not further along.
+                        if free is None:
+                            free = pos
+                        break
+                    if used < oldest:
+                        if free is None:
+                            free = pos
+                        continue
+                    if value == fingerprint:
+                        return False
+                    if evict is None or used < evict[0]:
+                        evict = (used, pos)
+                if free is None:
+                    free = evict[1]
+                    if now - self._warned > self.window:
+                        self._warned = now
+                        logger.warning('Nonce table at %s is full, '
+                            'replacing the oldest nonces.', self.path)
+                self._slot.pack_into(self._map, free, fingerprint,
+                    int(timestamp))
+                return True
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+        finally:
+            lock.release()
+
+    def discard(self, timestamp, key):
+        """
+        Forget the key recorded as used at timestamp.
+        """
+
+        fingerprint = self._fingerprint(key)
+        home = fingerprint % self.slots
+        stripe = home // self.stripe_size
+        start = stripe * self.stripe_size
+        offset = self._header.size + start * self._slot.size
+        length = self.stripe_size * self._slot.size
+
+        lock = self._locks[stripe]
+        lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                for i in xrange(self.max_probes):
+                    slot = start + (home - start + i) % self.stripe_size
+                    pos = self._header.size + slot * self._slot.size
+                    value, used = self._slot.unpack_from(self._map, pos)
+                    if value == 0:
+                        break
+                    if value == fingerprint and used == int(timestamp):
+                        # Mark it as expired rather than never used, so
+                        # the keys further along are still found.
+                        self._slot.pack_into(self._map, pos, value, 0)
+                        break
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+        finally:
+            lock.release()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+_tables = {}
+_tables_lock = Lock()
+
+def getMmapNonceTable(path=None):
+    """
+    Return the nonce table for this process at path, which defaults to
+    the PMR2_OAUTH_NONCE_TABLE environment variable, or a file in the
+    var directory of the Zope instance.
+    """
+
+    if path is None:
+        path = os.environ.get('PMR2_OAUTH_NONCE_TABLE')
+    if path is None:
+        try:
+            from App.config import getConfiguration
+            var = getConfiguration().clienthome
+        except (ImportError, AttributeError):
+            var = None
+        path = os.path.join(var or tempfile.gettempdir(),
+            'pmr2.oauth.nonce')
+
+    _tables_lock.acquire()
+    try:
+        table = _tables.get(path)
+        if table is None:
+            table = _tables[path] = MmapNonceTable(path)
+        return table
+    finally:
+        _tables_lock.release()
+
+
+class MmapNonceManager(NonceManager):
+    """
+    A nonce manager with the nonces shared by the Zope instances on the
+    same host through a memory mapped file.
+    """
+
+    def __init__(self, context, request, ring=None):
+        if ring is None:
+            ring = getMmapNonceTable()
+        super(MmapNonceManager, self).__init__(context, request, ring)
+
+
+class MemcachedNonceManager(NonceManager):
+    """
+    A nonce manager with the nonces shared through a memcached server.
+    """
+
+    def __init__(self, context, request, ring=None):
+        if ring is None:
+            ring = getMemcachedNonceStore()
+        super(MemcachedNonceManager, self).__init__(context, request, ring)
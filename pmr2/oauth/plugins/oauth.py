@@ -25,6 +25,9 @@ manage_addOAuthPlugin = PageTemplateFile("../www/oauthAdd", globals(),
 
 logger = logging.getLogger("PluggableAuthService")
 
+# Name of the request attribute used to memoize the extraction.
+_credentials_marker = '_pmr2_oauth1_credentials_'
+
 def addOAuthPlugin(self, id, title='', REQUEST=None):
     """Add an OAuth plugin to a Pluggable Authentication Service.
     """
@@ -61,6 +64,10 @@ class OAuthPlugin(BasePlugin):
 
         If the credential had been authenticated, return the login id,
         otherwise empty mapping.
+
+        As PAS may call this more than once for the same request, the
+        outcome (either the mappings or the error raised) is memoized
+        on the request for the object being published.
         """
 
         if not ((request._auth and request._auth.startswith('OAuth ')) or
@@ -69,15 +76,37 @@ class OAuthPlugin(BasePlugin):
             # Skip all not OAuth related.
             return {}
 
+        # Only look at the instance dict, as the request object falls
+        # back to the form values for missing attributes.
+        published = getattr(request, 'PUBLISHED', None)
+        cached = vars(request).get(_credentials_marker, None)
+        if cached is not None and cached[0] is published:
+            error, mappings = cached[1:]
+            if error is not None:
+                raise error
+            # PAS will write into the returned mapping, so copy it.
+            return dict(mappings)
+
+        try:
+            mappings = self._extractCredentials(request)
+        except (BadRequest, Forbidden), e:
+            setattr(request, _credentials_marker, (published, e, None))
+            raise
+
+        setattr(request, _credentials_marker, (published, None, mappings))
+        return dict(mappings)
+
+    def _extractCredentials(self, request):
         # XXX should just return the OAuth request string, let method
         # authenticateCredentials handle the rest.
         site = getSite()
         try:
             endpoint = ResourceEndpointValidator(site, request)
-            if not endpoint.check_request():
+            # Parse the request only once for both steps.
+            oreq = endpoint.parse_request()
+            if not endpoint.check_request(oreq):
                 return {}
-            result, oreq = endpoint.validate_protected_resource_request(
-                None, None)
+            result, oreq = endpoint.validate_request(oreq)
         except OAuth1Error:
             raise BadRequest('bad oauth request')
 
@@ -105,8 +134,7 @@ class OAuthPlugin(BasePlugin):
             return {}
 
         mappings = {}
-        tokenManager = zope.component.getMultiAdapter(
-            (site, request), ITokenManager)
+        tokenManager = endpoint.request_validator.tokenManager
         token = tokenManager.getAccessToken(oreq.resource_owner_key)
         mappings['userid'] = token.user
         return mappings
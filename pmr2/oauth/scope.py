@@ -1,28 +1,131 @@
 import re
 import logging
+import time
+from bisect import bisect_right
+from threading import Lock
 
 from persistent import Persistent
-from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
 from BTrees.IOBTree import IOBTree
 from BTrees.OIBTree import OIBTree
+from BTrees.Length import Length
 
 from zope.container.contained import Contained
 from zope.annotation.interfaces import IAttributeAnnotatable
 import zope.interface
 from zope.schema import fieldproperty
 
-from Acquisition import aq_parent, aq_inner
+from Acquisition import aq_base, aq_parent, aq_inner
 from Products.CMFCore.utils import getToolByName
 
 from pmr2.oauth.interfaces import KeyExistsError
 from pmr2.oauth.interfaces import IScopeManager, IDefaultScopeManager
 from pmr2.oauth.interfaces import IContentTypeScopeManager
 from pmr2.oauth.interfaces import IContentTypeScopeProfile
+from pmr2.oauth.cache import LRUCache
+from pmr2.oauth.cache import VolatileCacheMixin
 from pmr2.oauth.factory import factory
+from pmr2.oauth.ephemeral import EphemeralStorageMixin
 
 _marker = object()
+_missing = object()
 logger = logging.getLogger('pmr2.oauth.scope')
 
+# Process wide cache of the resolved targets, from the physical path of
+# the accessed object and the name accessed within it to the persistent
+# identities of the objects traversed during the resolution along with
+# the resolved content type and subpath.  As the identities include the
+# serial of each object, changes committed by any other process (such as
+# replacing or retyping one of these objects) invalidate the entry.
+_targets = LRUCache(size=10000)
+
+
+def _identity(obj):
+    """
+    Return the persistent identity of the committed state of the object,
+    or None if it has none.
+    """
+
+    obj = aq_base(obj)
+    if getattr(obj, '_p_oid', None) is None:
+        return None
+    # Load the state, as the serial of a ghost may be out of date.
+    obj._p_activate()
+    if obj._p_changed:
+        # Modified but not yet committed.
+        return None
+    return obj._p_oid, obj._p_serial
+
+
+_method_bits = {}
+_method_bits_lock = Lock()
+
+def getMethodBit(method, create=False):
+    """
+    Return the bit assigned to the HTTP method within this process, or
+    0 if none was assigned and create is False.
+    """
+
+    bit = _method_bits.get(method, 0)
+    if bit or not create:
+        return bit
+    _method_bits_lock.acquire()
+    try:
+        return _method_bits.setdefault(method, 1 << len(_method_bits))
+    finally:
+        _method_bits_lock.release()
+
+
+class CompiledMapping(object):
+    """
+    A content type mapping compiled for matching.
+
+    The subpaths of each type are split into a set of the exact matches
+    and a sorted table of the prefixes given by the patterns ending with
+    an asterisk, with the prefixes made redundant by shorter ones
+    removed such that only one of them can match any given subpath.
+    The permitted methods are kept as a bitmask.
+    """
+
+    __slots__ = ('types', 'methods')
+
+    def __init__(self, mapping, methods=()):
+        self.types = {}
+        for accessed_type, valid_scopes in mapping.items():
+            exact = set()
+            prefixes = []
+            for vs in valid_scopes:
+                # Same rules as validateTypeSubpathMapping.
+                if vs.endswith('*') and '/' in vs:
+                    prefixes.append(vs[:vs.rindex('*')])
+                else:
+                    exact.add(vs)
+            prefixes.sort()
+            table = []
+            for prefix in prefixes:
+                if not (table and prefix.startswith(table[-1])):
+                    table.append(prefix)
+            self.types[accessed_type] = (frozenset(exact), table)
+
+        self.methods = 0
+        for method in methods:
+            self.methods |= getMethodBit(method, create=True)
+
+    def match(self, accessed_type, subpath):
+        entry = self.types.get(accessed_type)
+        if entry is None:
+            return False
+        exact, table = entry
+        if subpath in exact:
+            return True
+        # The only prefix that could match is the greatest one that is
+        # not greater than the subpath.
+        i = bisect_right(table, subpath)
+        return i > 0 and subpath.startswith(table[i - 1])
+
+    def allowsMethod(self, method):
+        return bool(self.methods & getMethodBit(method))
+
 
 class BaseScopeManager(object):
     """
@@ -72,12 +175,15 @@ class BaseScopeManager(object):
         raise NotImplementedError()
 
 
-class BTreeScopeManager(Persistent, Contained, BaseScopeManager):
+class BTreeScopeManager(Persistent, Contained, BaseScopeManager,
+        EphemeralStorageMixin):
     """
     Basic BTree based client/access scope manager.
 
     Provides mapping of client and access keys to a scope, but does not
-    provide any validation capabilities.
+    provide any validation capabilities.  If an ephemeral store is
+    registered, the scopes requested for request tokens are kept there
+    instead.
     """
 
     zope.component.adapts(IAttributeAnnotatable, zope.interface.Interface)
@@ -85,22 +191,54 @@ class BTreeScopeManager(Persistent, Contained, BaseScopeManager):
     client_prefix = 'client.'
     access_prefix = 'access.'
 
+    # Lifetime (in seconds) of the scopes of request tokens in the
+    # ephemeral store, which should cover the time needed to claim the
+    # token and to exchange it for an access token.
+    request_scope_ttl = 600
+
     def __init__(self):
         self._scope = OOBTree()
+        self._initEphemeralPrefix()
 
     def setScope(self, key, scope):
         if self._scope.get(key, _marker) != _marker:
             raise KeyExistsError()
         self._scope[key] = scope
 
+    def _getRequestScopeStore(self, key):
+        # Only the scopes of request tokens may be ephemeral.
+        if key.startswith(self.client_prefix) or key.startswith(
+                self.access_prefix):
+            return None
+        return self._getEphemeralStore()
+
+    def _setRequestScope(self, request_key, scope):
+        store = self._getRequestScopeStore(request_key)
+        if store is None:
+            return self.setScope(request_key, scope)
+        store.set(self._getEphemeralKey(request_key), scope,
+            self.request_scope_ttl)
+
     def getScope(self, key, default=_marker):
-        result = self._scope.get(key, default)
-        if result == _marker:
-            raise KeyError()
+        result = self._scope.get(key, _marker)
+        if result is _marker:
+            store = self._getRequestScopeStore(key)
+            if store is not None:
+                result = store.get(self._getEphemeralKey(key), _marker)
+        if result is _marker:
+            if default is _marker:
+                raise KeyError()
+            return default
         return result
 
     def popScope(self, key, default=_marker):
-        result = self._scope.pop(key, default)
+        result = self._scope.pop(key, _marker)
+        if result is _marker:
+            store = self._getRequestScopeStore(key)
+            if store is not None:
+                result = store.pop(self._getEphemeralKey(key), _marker)
+        if result is _marker:
+            return default
         return result
 
     def setClientScope(self, client_key, scope):
@@ -138,11 +276,11 @@ class BTreeScopeManager(Persistent, Contained, BaseScopeManager):
 
         # No reason or means to refuse this request as this doesn't do
         # any kind of management.
-        self.setScope(request_key, raw_scope)
+        self._setRequestScope(request_key, raw_scope)
         return True
 
 
-class ContentTypeScopeManager(BTreeScopeManager):
+class ContentTypeScopeManager(BTreeScopeManager, VolatileCacheMixin):
     """
     A scope manager based on content types.
 
@@ -163,7 +301,8 @@ class ContentTypeScopeManager(BTreeScopeManager):
     ultimately on the access keys.  Workaround is to revoke those keys
     and have the content owners issue new ones regardless of changes.
 
-    Pruning of unused scope is not implemented.
+    Mappings no longer referenced can be removed by calling
+    purgeUnusedMappings.
     """
 
     zope.interface.implements(IContentTypeScopeManager)
@@ -171,8 +310,35 @@ class ContentTypeScopeManager(BTreeScopeManager):
     default_mapping_id = fieldproperty.FieldProperty(
         IContentTypeScopeManager['default_mapping_id'])
 
+    # Size of the cache of the validation decisions kept for each ZODB
+    # connection.
+    decision_cache_size = 10000
+
+    # The distinct sets of mapping ids granted to access keys, and the
+    # reverse mapping from the sorted ids to the id of the set.  Managers
+    # created before this was introduced will have these created when
+    # the first access scope is set.
+    _scope_sets = None
+    _scope_set_ids = None
+
+    # The access keys granted each of the mappings.  Managers created
+    # before this was introduced will have this built by the upgrade
+    # step to v0.6.
+    _mapping_access_keys = None
+
+    # The time each of the mappings was replaced by another for its
+    # name, and the time (in seconds) the replaced mappings are kept
+    # after that by purgeUnusedMappings, for the scopes of the request
+    # tokens that may still reference them.
+    _superseded = None
+    mapping_purge_grace = 3600
+
     def __init__(self):
         super(ContentTypeScopeManager, self).__init__()
+        self._generation = Length()
+        self._scope_sets = IOBTree()
+        self._scope_set_ids = OOBTree()
+        self._mapping_access_keys = IOBTree()
         self._mappings = IOBTree()
 
         # Methods permitted to access this mapping with.  Originally
@@ -208,14 +374,47 @@ class ContentTypeScopeManager(BTreeScopeManager):
         self._methods[key] = methods.split()
         if metadata is not None:
             self._mappings_metadata[key] = metadata
+        self._compileMapping(key)
+        self._invalidateCache()
         return key
 
+    def _getDecisionCache(self):
+        # The default mapping can be changed without going through this
+        # manager, so it is part of the key of the cache.
+        return self._getCache('_v_decision_cache', self.decision_cache_size,
+            key=self.default_mapping_id)
+
     def getMapping(self, mapping_id, default=_marker):
         result = self._mappings.get(mapping_id, default)
         if result is _marker:
             raise KeyError()
         return result
 
+    def _compileMapping(self, mapping_id):
+        # Mappings are never modified once added, so the compiled form
+        # of each is kept for as long as this manager is in memory.
+        compiled = getattr(self, '_v_compiled_mappings', None)
+        if compiled is None:
+            compiled = self._v_compiled_mappings = {}
+        mapping = self._mappings.get(mapping_id)
+        if not hasattr(mapping, 'items'):
+            # Missing, or not a mapping of types.
+            return None
+        result = compiled[mapping_id] = CompiledMapping(mapping,
+            self._methods.get(mapping_id, ()))
+        return result
+
+    def getCompiledMapping(self, mapping_id):
+        """
+        Return the compiled form of the mapping, or None if there is no
+        mapping with the id.
+        """
+
+        compiled = getattr(self, '_v_compiled_mappings', None)
+        if compiled is not None and mapping_id in compiled:
+            return compiled[mapping_id]
+        return self._compileMapping(mapping_id)
+
     def getMappingMetadata(self, mapping_id, default=None):
         result = self._mappings_metadata.get(mapping_id, default)
         return result
@@ -231,15 +430,25 @@ class ContentTypeScopeManager(BTreeScopeManager):
         return result
 
     def checkMethodPermission(self, mapping_id, method):
-        methods = self.getMappingMethods(mapping_id, ())
-        return method in methods
+        compiled = self.getCompiledMapping(mapping_id)
+        return compiled is not None and compiled.allowsMethod(method)
+
+    def _supersedeMapping(self, mapping_id):
+        if self._superseded is None:
+            self._superseded = IOBTree()
+        self._superseded[mapping_id] = int(time.time())
 
     def setMappingNameToId(self, name, mapping_id):
+        saved = self._named_mappings.get(name)
+        if saved is not None and saved != mapping_id:
+            self._supersedeMapping(saved)
         self._named_mappings[name] = mapping_id
 
     def delMappingName(self, name):
         saved = self._named_mappings.pop(name, None)
         edits = self._edit_mappings.pop(name, None)
+        if saved is not None:
+            self._supersedeMapping(saved)
         return (saved, edits)
 
     def getMappingByName(self, name, default=_marker):
@@ -268,6 +477,10 @@ class ContentTypeScopeManager(BTreeScopeManager):
         profile = self.getEditProfile(name)
         if not (IContentTypeScopeProfile.providedBy(profile)):
             raise KeyError('edit profile does not exist')
+        if not self.isProfileModified(name):
+            # Nothing to commit, so keep the current mapping rather than
+            # adding an identical one.
+            return self.getMappingId(name)
         new_mapping = profile.mapping
         methods = profile.methods
         metadata = {
@@ -280,6 +493,7 @@ class ContentTypeScopeManager(BTreeScopeManager):
         new_id = self.addMapping(new_mapping, methods=methods,
             metadata=metadata)
         self.setMappingNameToId(name, new_id)
+        return new_id
 
     def getEditProfileNames(self):
         return self._edit_mappings.keys()
@@ -303,8 +517,217 @@ class ContentTypeScopeManager(BTreeScopeManager):
             profile.methods == metadata.get('methods')
         )
 
+    def getReferencedMappingIds(self):
+        """
+        Return the set of the ids of the mappings referenced by a name,
+        as the default, or by the scope of a token or a client.
+        """
+
+        result = set(self._named_mappings.values())
+        result.add(self.default_mapping_id)
+        if self._mapping_access_keys is not None:
+            result.update(self._mapping_access_keys.keys())
+
+        # The remaining scopes, of the clients and of the request tokens
+        # kept in the ZODB, are sets of mapping ids.
+        prefix = self.access_prefix
+        after = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        for items in (self._scope.items(max=prefix, excludemax=True),
+                self._scope.items(min=after)):
+            for key, scope in items:
+                result.update(self._getScopeMappingIds(scope))
+
+        return result
+
+    def purgeUnusedMappings(self, timestamp=None):
+        """
+        Remove the mappings that are no longer referenced (see
+        getReferencedMappingIds), except for the ones replaced within
+        the last mapping_purge_grace seconds before timestamp (default
+        is now), as the scopes of request tokens in an ephemeral store
+        may still reference them.
+
+        Returns the list of ids of the removed mappings.
+        """
+
+        if self._mapping_access_keys is None:
+            raise ValueError('access keys are not indexed; run the upgrade '
+                'step to v0.6 first')
+
+        if timestamp is None:
+            timestamp = int(time.time())
+        superseded = self._superseded or {}
+        referenced = self.getReferencedMappingIds()
+        # The greatest id is always kept such that ids are never reused,
+        # as the compiled mappings of other processes are kept by id.
+        referenced.add(self._mappings.maxKey())
+
+        removed = []
+        for mapping_id in list(self._mappings.keys()):
+            if mapping_id in referenced:
+                continue
+            replaced = superseded.get(mapping_id)
+            if (replaced is not None and
+                    replaced + self.mapping_purge_grace > timestamp):
+                continue
+            del self._mappings[mapping_id]
+            self._methods.pop(mapping_id, None)
+            self._mappings_metadata.pop(mapping_id, None)
+            if self._superseded is not None:
+                self._superseded.pop(mapping_id, None)
+            compiled = getattr(self, '_v_compiled_mappings', None)
+            if compiled is not None:
+                compiled.pop(mapping_id, None)
+            removed.append(mapping_id)
+
+        if not removed:
+            return removed
+
+        # No access key can be granted the interned scopes with any of
+        # the removed mappings.
+        removed_set = set(removed)
+        if self._scope_sets is not None:
+            for scope_id, scope in list(self._scope_sets.items()):
+                if scope & removed_set:
+                    del self._scope_sets[scope_id]
+                    del self._scope_set_ids[tuple(sorted(scope))]
+
+        self._invalidateCache()
+        return removed
+
     # Scope handling.
 
+    def internScope(self, scope):
+        """
+        Return the id of the set of mapping ids, which is stored once
+        for all the access keys granted the same set.
+        """
+
+        if self._scope_sets is None:
+            self._scope_sets = IOBTree()
+            self._scope_set_ids = OOBTree()
+        # frozensets are not totally ordered, so not usable as the keys
+        # of a BTree.
+        key = tuple(sorted(scope))
+        scope_id = self._scope_set_ids.get(key)
+        if scope_id is None:
+            scope_id = 0
+            if len(self._scope_sets) > 0:
+                scope_id = self._scope_sets.maxKey() + 1
+            self._scope_sets[scope_id] = frozenset(key)
+            self._scope_set_ids[key] = scope_id
+        return scope_id
+
+    def getScopeSet(self, scope_id, default=None):
+        """
+        Return the set of mapping ids interned with the id.
+        """
+
+        if self._scope_sets is None:
+            return default
+        return self._scope_sets.get(scope_id, default)
+
+    def setAccessScope(self, access_key, scope):
+        """
+        The scopes of access keys are interned, such that only the id of
+        the set of mapping ids is stored for each of them.
+        """
+
+        if isinstance(scope, (set, frozenset)):
+            scope = self.internScope(scope)
+        super(ContentTypeScopeManager, self).setAccessScope(access_key,
+            scope)
+        self._indexAccessScope(access_key, scope)
+
+    def delAccessScope(self, access_key, default=_marker):
+        key = self.access_prefix + access_key
+        result = self.popScope(key, _missing)
+        if result is _missing:
+            if default is _marker:
+                raise KeyError()
+            return
+        self._unindexAccessScope(access_key, result)
+
+    def _getScopeMappingIds(self, scope):
+        # The stored scope may be the id of an interned set, or the set
+        # itself for scopes set before they were interned.
+        if isinstance(scope, int):
+            return self.getScopeSet(scope, ())
+        if isinstance(scope, (set, frozenset)):
+            return scope
+        return ()
+
+    def _indexAccessScope(self, access_key, scope):
+        if self._mapping_access_keys is None:
+            # Until built by the upgrade step, as a partial index would
+            # have purgeUnusedMappings remove mappings in use.
+            return
+        for mapping_id in self._getScopeMappingIds(scope):
+            keys = self._mapping_access_keys.get(mapping_id)
+            if keys is None:
+                keys = self._mapping_access_keys[mapping_id] = OOTreeSet()
+            keys.insert(access_key)
+
+    def _unindexAccessScope(self, access_key, scope):
+        if self._mapping_access_keys is None:
+            return
+        for mapping_id in self._getScopeMappingIds(scope):
+            keys = self._mapping_access_keys.get(mapping_id)
+            if keys is None:
+                continue
+            if access_key in keys:
+                keys.remove(access_key)
+            if not keys:
+                del self._mapping_access_keys[mapping_id]
+
+    def getMappingAccessKeys(self, mapping_id, after=None):
+        """
+        Return the access keys granted the mapping in order, only those
+        after the specified key if one is given.
+        """
+
+        if self._mapping_access_keys is None:
+            return ()
+        keys = self._mapping_access_keys.get(mapping_id)
+        if keys is None:
+            return ()
+        if after is None:
+            return keys.keys()
+        return keys.keys(min=after, excludemin=True)
+
+    def getMappingAccessKeyCounts(self):
+        """
+        Return a list of the ids of the mappings granted to access keys
+        along with the number of access keys granted each of them.
+        """
+
+        if self._mapping_access_keys is None:
+            return []
+        return [(mapping_id, len(keys))
+            for mapping_id, keys in self._mapping_access_keys.items()]
+
+    def getAccessScopeId(self, access_key, default=None):
+        """
+        Return the id of the interned scope of the access key, or default
+        if the access key has no scope or its scope was not interned.
+        """
+
+        result = self._scope.get(self.access_prefix + access_key)
+        if isinstance(result, int):
+            return result
+        return default
+
+    def getAccessScope(self, access_key, default=_marker):
+        result = super(ContentTypeScopeManager, self).getAccessScope(
+            access_key, _missing)
+        if isinstance(result, int):
+            result = self.getScopeSet(result, _missing)
+        if result is _missing:
+            if default is _marker:
+                raise KeyError()
+            return default
+        return result
+
     def requestScope(self, request_key, raw_scope):
         """
         This manager references scope by ids internally.  Resolve the
@@ -329,7 +752,7 @@ class ContentTypeScopeManager(BTreeScopeManager):
         if not result:
             result.add(self.default_mapping_id)
 
-        self.setScope(request_key, result)
+        self._setRequestScope(request_key, result)
         return True
 
     def validate(self, request, client_key, access_key,
@@ -338,14 +761,42 @@ class ContentTypeScopeManager(BTreeScopeManager):
         See IScopeManager.
         """
 
-        mappings = self.resolveMapping(client_key, access_key)
+        # Interned scopes are identified by their id, which is cheaper
+        # to use as the key of the decision than the set.
+        scope_id = self.getAccessScopeId(access_key)
+        if scope_id is None:
+            scope_id = frozenset(self.resolveMapping(client_key, access_key))
+
+        # The target is the same for all of the mappings.
+        atype, subpath = self.resolveTarget(accessed, name)
+
+        # The decision only depends on these values, which are shared by
+        # the requests for the same resource with the same scope.
+        key = (scope_id, atype, subpath, request.method)
+        cache = self._getDecisionCache()
+        result = cache.get(key)
+        if result is None:
+            mappings = scope_id
+            if isinstance(scope_id, int):
+                mappings = self.getScopeSet(scope_id, ())
+            result = self.validateMappings(mappings, atype, subpath,
+                request.method)
+            cache.set(key, result)
+        return result
+
+    def validateMappings(self, mappings, accessed_type, subpath, method):
+        """
+        Validate the type and subpath accessed with the method against
+        the mappings.
+        """
+
         # multiple rights were requested, check through all of them.
         for mapping_id in mappings:
-            mapping = self.getMapping(mapping_id, default={})
-            result = self.validateTargetWithMapping(accessed, name, mapping)
-            method_allowed = self.checkMethodPermission(mapping_id,
-                request.method)
-            if result and method_allowed:
+            compiled = self.getCompiledMapping(mapping_id)
+            if compiled is None:
+                continue
+            if (compiled.match(accessed_type, subpath) and
+                    compiled.allowsMethod(method)):
                 return True
 
         # no matching mappings.
@@ -366,29 +817,60 @@ class ContentTypeScopeManager(BTreeScopeManager):
         Find the type of the container object of the accessed object by
         traversing upwards, and gather the path to resolve into the 
         content type id.  Return both these values.
+
+        The results for persistent objects with a physical path are
+        cached for as long as the objects traversed are unchanged.
         """
 
+        # Only objects with their own path, as an acquired path would be
+        # the path of one of the parents.
+        if getattr(aq_base(accessed), 'getPhysicalPath', None) is None:
+            return self._resolveTarget(accessed, name)[0]
+
+        key = (accessed.getPhysicalPath(), name)
+        cached = _targets.get(key)
+        if cached is not None:
+            identities, result = cached
+            context = aq_inner(accessed)
+            for identity in identities:
+                if context is None or _identity(context) != identity:
+                    break
+                context = aq_parent(context)
+            else:
+                return result
+
+        result, contexts = self._resolveTarget(accessed, name)
+        identities = tuple([_identity(context) for context in contexts])
+        if identities and None not in identities:
+            _targets.set(key, (identities, result))
+        return result
+
+    def _resolveTarget(self, accessed, name):
+        # Return the target along with the objects traversed to find the
+        # type, which are empty if the type is not found.
         logger.debug('resolving %s into types', accessed)
         # use getSite() instead of container?
         pt_tool = getToolByName(accessed, 'portal_types', None)
         if pt_tool is None:
-            return None, None
+            return (None, None), ()
 
         context = aq_inner(accessed)
         typeinfo = None
         subpath = [name]
+        contexts = []
 
         while context is not None:
+            contexts.append(context)
             typeinfo = pt_tool.getTypeInfo(context)
             if typeinfo:
                 subpath.reverse()
-                return typeinfo.id, '/'.join(subpath)
+                return (typeinfo.id, '/'.join(subpath)), contexts
             # It should have a name...
             subpath.append(context.__name__)
             context = aq_parent(context)
 
         logger.debug('parent of %s failed to resolve into typeinfo', accessed)
-        return None, None
+        return (None, None), ()
 
     def validateTargetWithMapping(self, accessed, name, mapping):
         atype, subpath = self.resolveTarget(accessed, name)
@@ -69,3 +69,65 @@ def scope_upgrade_v0_4(site):
     logger.info('Purging and reinitializing the built-in token manager.')
     tm = zope.component.getMultiAdapter((site, None), ITokenManager)
     tm.__init__()
+
+
+def migrate_v0_4_to_v0_6(context):
+    logger = getLogger('pmr2.oauth')
+    logger.info('Migrating pmr2.oauth to v0.6.')
+    site = getSite()
+    token_upgrade_v0_6(site)
+    scope_upgrade_v0_6(site)
+
+def token_upgrade_v0_6(site):
+    import zope.component
+    from persistent.list import PersistentList
+    from pmr2.oauth.interfaces import ITokenManager
+    from pmr2.oauth.token import userTokensFromList
+
+    logger = getLogger('pmr2.oauth')
+    tm = zope.component.getMultiAdapter((site, None), ITokenManager)
+    if tm._ephemeral_prefix is None:
+        tm._initEphemeralPrefix()
+
+    user_token_map = getattr(tm, '_user_token_map', None)
+    if user_token_map is None:
+        return
+
+    logger.info('Converting the token lists of users into mappings.')
+    count = 0
+    for user, keys in list(user_token_map.items()):
+        if isinstance(keys, PersistentList):
+            user_token_map[user] = userTokensFromList(keys)
+            count += 1
+    logger.info('Converted the token lists of %d users.', count)
+
+    # Tokens may have been indexed already, which is harmless.
+    logger.info('Building the token expiry index.')
+    for tree in tm._iterTokenTrees():
+        for token in tree.values():
+            tm._index_expiry(token)
+
+def scope_upgrade_v0_6(site):
+    import zope.component
+    from BTrees.IOBTree import IOBTree
+    from pmr2.oauth.interfaces import IContentTypeScopeManager
+
+    logger = getLogger('pmr2.oauth')
+    sm = zope.component.getMultiAdapter((site, None),
+        IContentTypeScopeManager)
+    if sm._mapping_access_keys is None:
+        sm._mapping_access_keys = IOBTree()
+    if sm._ephemeral_prefix is None:
+        sm._initEphemeralPrefix()
+
+    logger.info('Interning and indexing the scopes of the access keys.')
+    count = 0
+    for key, scope in list(sm._scope.items(min=sm.access_prefix)):
+        if not key.startswith(sm.access_prefix):
+            break
+        if isinstance(scope, (set, frozenset)):
+            scope = sm._scope[key] = sm.internScope(scope)
+        # Access keys may have been indexed already, which is harmless.
+        sm._indexAccessScope(key[len(sm.access_prefix):], scope)
+        count += 1
+    logger.info('Interned and indexed the scopes of %d access keys.', count)
@@ -0,0 +1,140 @@
+import binascii
+import hashlib
+import hmac
+import logging
+
+try:
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+    from Crypto.Hash import SHA
+except ImportError:  # pragma: no cover
+    RSA = None
+
+from oauthlib.common import safe_string_equals
+from oauthlib.oauth1.rfc5849 import signature
+from oauthlib.oauth1.rfc5849 import utils
+
+from pmr2.oauth.cache import LRUCache
+
+logger = logging.getLogger('pmr2.oauth.signature')
+
+# RSA-SHA1 requires PyCrypto, as with oauthlib.
+rsa_available = RSA is not None
+
+# Process wide cache of the parsed public keys.
+_rsa_keys = LRUCache(size=1000)
+
+# Process wide cache of the prepared HMAC objects.
+_hmac_keys = LRUCache(size=10000)
+
+_invalid = object()
+
+
+def getRSAVerifier(client_key, rsa_key):
+    """
+    Return the PKCS#1 v1.5 verifier for the PEM encoded public key of
+    the client, or None if the key is missing or cannot be parsed.
+
+    Parsing the key costs far more than the verification, so the
+    verifiers are cached by the client key and the fingerprint of the
+    key, such that a key replaced for a client will be parsed again.
+    """
+
+    if not rsa_key or not rsa_available:
+        return None
+
+    if isinstance(rsa_key, unicode):
+        rsa_key = rsa_key.encode('utf8')
+    cache_key = (client_key, hashlib.sha1(rsa_key).hexdigest())
+    verifier = _rsa_keys.get(cache_key)
+    if verifier is None:
+        try:
+            verifier = PKCS1_v1_5.new(RSA.importKey(rsa_key))
+        except (ValueError, IndexError, TypeError), e:
+            logger.warning('Invalid RSA key for client `%s`: %s',
+                client_key, e)
+            verifier = _invalid
+        _rsa_keys.set(cache_key, verifier)
+
+    if verifier is _invalid:
+        return None
+    return verifier
+
+
+def verify_rsa_sha1(request, verifier):
+    """
+    Verify the RSA-SHA1 signature of the oauthlib request with the
+    verifier from ``getRSAVerifier``.
+
+    This is the same as the one provided by oauthlib, except the key is
+    not parsed for every request.
+    """
+
+    if verifier is None:
+        return False
+
+    norm_params = signature.normalize_parameters(request.params)
+    uri = signature.normalize_base_string_uri(request.uri)
+    message = signature.construct_base_string(request.http_method, uri,
+        norm_params)
+    h = SHA.new(message.encode('utf-8'))
+    try:
+        sig = binascii.a2b_base64(request.signature.encode('utf-8'))
+    except binascii.Error:
+        return False
+    return bool(verifier.verify(h, sig))
+
+
+def getHMAC(client_key, client_secret, token_key=None, token_secret=None):
+    """
+    Return a HMAC-SHA1 object keyed with the secrets of the client and
+    of the token (if any), ready to be updated with the base string.
+
+    The prepared objects are cached by the client key and the token key
+    and copied for each use, so the key schedule is not repeated for
+    every request.  The secrets are checked against the cached entry,
+    such that secrets that have changed will never be used.
+    """
+
+    secrets = (client_secret, token_secret)
+    cache_key = (client_key, token_key)
+    cached = _hmac_keys.get(cache_key)
+    if cached is None or cached[0] != secrets:
+        # As per RFC 5849 section 3.4.2.
+        key = utils.escape(client_secret or u'') + u'&' + \
+            utils.escape(token_secret or u'')
+        cached = (secrets,
+            hmac.new(key.encode('utf-8'), digestmod=hashlib.sha1))
+        _hmac_keys.set(cache_key, cached)
+    return cached[1].copy()
+
+
+def invalidateHMAC(client_key, token_key=None):
+    """
+    Discard the prepared HMAC objects for the token of the client, or
+    all of the ones for the client if no token key is specified.
+    """
+
+    if token_key is None:
+        # Removal of clients is rare, so the entries are found by going
+        # through the cache rather than tracking the tokens of each.
+        for cache_key in _hmac_keys.keys():
+            if cache_key[0] == client_key:
+                _hmac_keys.pop(cache_key)
+        return
+    _hmac_keys.pop((client_key, token_key))
+
+
+def verify_hmac_sha1(request, mac):
+    """
+    Verify the HMAC-SHA1 signature of the oauthlib request with the
+    HMAC object from ``getHMAC``.
+    """
+
+    norm_params = signature.normalize_parameters(request.params)
+    uri = signature.normalize_base_string_uri(request.uri)
+    base_string = signature.construct_base_string(request.http_method, uri,
+        norm_params)
+    mac.update(base_string.encode('utf-8'))
+    result = binascii.b2a_base64(mac.digest())[:-1].decode('utf-8')
+    return safe_string_equals(result, request.signature)
@@ -108,6 +108,7 @@ class TestRequest(pmr2.z3cform.tests.base.TestRequest):
 def SignedTestRequest(form=None, consumer=None, token=None, method=None,
         url=None, callback=None, timestamp=None, verifier=None,
         signature_type='AUTH_HEADER', raw_body=None,
+        signature_method=u'HMAC-SHA1', rsa_key=None,
         *a, **kw):
     """\
     Creates a signed TestRequest
@@ -148,6 +149,8 @@ def SignedTestRequest(form=None, consumer=None, token=None, method=None,
         verifier=safe_unicode(verifier),
         timestamp=timestamp,
         signature_type=signature_type,
+        signature_method=signature_method,
+        rsa_key=rsa_key,
     )
 
     if result.getHeader('Content-Type') == 'application/x-www-form-urlencoded':
@@ -0,0 +1,116 @@
+"""
+A stand-in memcached server, implementing just enough of the text
+protocol for the tests and the benchmarks to run without a real server.
+"""
+
+import time
+import socket
+import threading
+import SocketServer
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        server.connections.append(self.connection)
+        while True:
+            try:
+                line = self.rfile.readline()
+            except socket.error:
+                return
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = parts[0]
+            if command in ('add', 'set'):
+                key, exptime, size = parts[1], int(parts[3]), int(parts[4])
+                value = self.rfile.read(size + 2)[:-2]
+                result = server.store(command, key, value, exptime)
+            elif command == 'get':
+                result = ''.join('VALUE %s 0 %d\r\n%s\r\n' % (k, len(v), v)
+                    for k, v in [(k, server.fetch(k)) for k in parts[1:]]
+                    if v is not None) + 'END'
+            elif command == 'delete':
+                result = server.remove(parts[1]) and 'DELETED' or 'NOT_FOUND'
+            else:
+                result = 'ERROR'
+            self.wfile.write(result + '\r\n')
+            self.wfile.flush()
+
+
+class StandInMemcachedServer(SocketServer.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), delay=0):
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+            MemcachedHandler)
+        # artificial delay (in seconds) before every response.
+        self.delay = delay
+        self.data = {}
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] and entry[1] < time.time():
+            del self.data[key]
+            entry = None
+        return entry
+
+    def store(self, command, key, value, exptime):
+        if self.delay:
+            time.sleep(self.delay)
+        expiry = exptime and time.time() + exptime or 0
+        self.lock.acquire()
+        try:
+            if command == 'add' and self._get(key) is not None:
+                return 'NOT_STORED'
+            self.data[key] = (value, expiry)
+            return 'STORED'
+        finally:
+            self.lock.release()
+
+    def fetch(self, key):
+        self.lock.acquire()
+        try:
+            entry = self._get(key)
+            return entry and entry[0]
+        finally:
+            self.lock.release()
+
+    def remove(self, key):
+        self.lock.acquire()
+        try:
+            return self.data.pop(key, None) is not None
+        finally:
+            self.lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # also drop the connections already established.
+        self.disconnect()
+
+    def disconnect(self):
+        """
+        Drop the established connections, as a server would for idle
+        connections.
+        """
+
+        connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
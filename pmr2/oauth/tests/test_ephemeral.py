@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import zope.component
+
+from pmr2.oauth.interfaces import IEphemeralStore
+from pmr2.oauth.interfaces import ExpiredTokenError
+from pmr2.oauth.ephemeral import MemoryEphemeralStore
+from pmr2.oauth.ephemeral import SQLiteEphemeralStore
+from pmr2.oauth.token import TokenManager
+from pmr2.oauth.scope import BTreeScopeManager
+
+
+class MemoryEphemeralStoreTestCase(unittest.TestCase):
+
+    def makeStore(self):
+        return MemoryEphemeralStore()
+
+    def setUp(self):
+        self.store = self.makeStore()
+
+    def test_000_get_set_pop(self):
+        self.assertEqual(self.store.get('a'), None)
+        self.assertEqual(self.store.get('a', 'default'), 'default')
+        self.store.set('a', set([1, 2]), 60)
+        self.assertEqual(self.store.get('a'), set([1, 2]))
+        # values are copies.
+        self.store.get('a').add(3)
+        self.assertEqual(self.store.get('a'), set([1, 2]))
+        self.assertEqual(self.store.pop('a'), set([1, 2]))
+        self.assertEqual(self.store.pop('a'), None)
+        self.assertEqual(self.store.get('a'), None)
+
+    def test_001_expiry(self):
+        self.store.set('a', 1, 0)
+        self.store.set('b', 2, 60)
+        self.store.purge(time.time() + 1)
+        self.assertEqual(self.store.get('a'), None)
+        self.assertEqual(self.store.pop('a', 'default'), 'default')
+        self.assertEqual(self.store.get('b'), 2)
+        self.store.purge(time.time() + 61)
+        self.assertEqual(self.store.get('b'), None)
+
+
+class SQLiteEphemeralStoreTestCase(MemoryEphemeralStoreTestCase):
+
+    def makeStore(self):
+        return SQLiteEphemeralStore(os.path.join(self.tmpdir, 'store.db'))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        super(SQLiteEphemeralStoreTestCase, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_010_shared(self):
+        other = self.makeStore()
+        self.store.set('a', 1, 60)
+        self.assertEqual(other.pop('a'), 1)
+        self.assertEqual(self.store.get('a'), None)
+
+
+class EphemeralManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = MemoryEphemeralStore()
+        zope.component.provideUtility(self.store, IEphemeralStore)
+
+    def tearDown(self):
+        zope.component.getGlobalSiteManager().unregisterUtility(
+            self.store, IEphemeralStore)
+
+    def test_000_request_token(self):
+        m = TokenManager()
+        # The dummy token always lives in the ZODB.
+        self.assertTrue(m.DUMMY_KEY in m._tokens)
+
+        token = m.generateRequestToken('consumer-key', 'oob')
+        self.assertFalse(token.key in m._tokens)
+        self.assertEqual(m._expiry_index.get(
+            token.expiry // m.expiry_bucket_size), None)
+        self.assertEqual(m.getRequestToken(token.key).key, token.key)
+
+        # The token is a copy, modifications must be saved back.
+        m.getRequestToken(token.key).user = 'other'
+        self.assertEqual(m.get(token.key).user, None)
+        m.claimRequestToken(token.key, 'user')
+        self.assertEqual(m.get(token.key).user, 'user')
+
+        # Only the access tokens are stored in the ZODB.
+        access = m.generateAccessToken('consumer-key', token.key)
+        self.assertTrue(access.key in m._tokens)
+        self.assertEqual(m.getAccessToken(access.key), access)
+
+        self.assertEqual(m.remove(token.key).key, token.key)
+        self.assertEqual(m.get(token.key), None)
+
+    def test_001_request_token_expired(self):
+        m = TokenManager()
+        token = m.generateRequestToken('consumer-key', 'oob')
+        token.expiry = int(time.time()) - 1
+        self.store.set(m._getEphemeralKey(token.key), token, 60)
+        self.assertRaises(ExpiredTokenError, m.getRequestToken, token.key)
+        # Left to expire from the ephemeral store rather than purged.
+        self.assertEqual(m.purgeExpired(), [])
+
+    def test_002_namespaced(self):
+        m1 = TokenManager()
+        m2 = TokenManager()
+        token = m1.generateRequestToken('consumer-key', 'oob')
+        self.assertEqual(m2.get(token.key), None)
+
+    def test_003_legacy_namespace(self):
+        m = TokenManager()
+        del m._ephemeral_prefix
+        m._p_oid = '\0' * 7 + '\1'
+        token = m.generateRequestToken('consumer-key', 'oob')
+        self.assertEqual(m.get(token.key).key, token.key)
+        self.assertEqual(m._getEphemeralKey('key'), '0000000000000001:key')
+        # not assigned while in use.
+        self.assertFalse('_ephemeral_prefix' in m.__dict__)
+
+    def test_010_request_scope(self):
+        sm = BTreeScopeManager()
+        self.assertTrue(sm.requestScope('request-key', 'scope'))
+        self.assertFalse('request-key' in sm._scope)
+        self.assertEqual(sm.getScope('request-key'), 'scope')
+        self.assertEqual(sm.popScope('request-key'), 'scope')
+        self.assertRaises(KeyError, sm.getScope, 'request-key')
+        self.assertEqual(sm.popScope('request-key', None), None)
+
+        # Access scopes remain in the ZODB.
+        sm.setAccessScope('access-key', 'scope')
+        self.assertEqual(sm._scope['access.access-key'], 'scope')
+        self.assertEqual(sm.getAccessScope('access-key'), 'scope')
+
+
+class SQLiteEphemeralManagerTestCase(EphemeralManagerTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = SQLiteEphemeralStore(
+            os.path.join(self.tmpdir, 'store.db'))
+        zope.component.provideUtility(self.store, IEphemeralStore)
+
+    def tearDown(self):
+        super(SQLiteEphemeralManagerTestCase, self).tearDown()
+        shutil.rmtree(self.tmpdir)
+
+    def test_000_request_token(self):
+        m = TokenManager()
+        token = m.generateRequestToken('consumer-key', 'oob')
+        m.claimRequestToken(token.key, 'user')
+        # The token is a copy, modifications must be saved back.
+        stored = m.getRequestToken(token.key)
+        self.assertEqual(stored.key, token.key)
+        self.assertEqual(stored.user, 'user')
+        access = m.generateAccessToken('consumer-key', token.key)
+        self.assertTrue(access.key in m._tokens)
+
+    def test_001_request_token_expired(self):
+        # Expired tokens are not returned by the store.
+        m = TokenManager()
+        m.claim_timeout = 0
+        token = m.generateRequestToken('consumer-key', 'oob')
+        time.sleep(0.01)
+        self.assertEqual(m.get(token.key), None)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(MemoryEphemeralStoreTestCase))
+    suite.addTest(makeSuite(SQLiteEphemeralStoreTestCase))
+    suite.addTest(makeSuite(EphemeralManagerTestCase))
+    suite.addTest(makeSuite(SQLiteEphemeralManagerTestCase))
+    return suite
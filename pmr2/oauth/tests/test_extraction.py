@@ -3,12 +3,18 @@ import zope.component
 from time import time
 import unittest
 
+import transaction
+from ZODB.POSException import ConflictError
+
 from zExceptions import Forbidden
 from zExceptions import BadRequest
 
 from pmr2.oauth.interfaces import *
 
 from pmr2.oauth.utility import SiteRequestValidatorAdapter
+from pmr2.oauth.utility import getRequestValidator
+from pmr2.oauth.utility import extractRequestURL
+from pmr2.oauth.utility import isValidQueryString
 
 from pmr2.oauth.token import Token
 from pmr2.oauth.token import TokenManager
@@ -257,6 +263,236 @@ class TestExtraction(unittest.TestCase):
         credentials = plugin.extractCredentials(request)
         self.assertEqual(credentials['userid'], self.default_user_id)
 
+    def test_1010_memoized_extraction(self):
+        plugin = self.plugin
+        consumer, token = self.save_consumer_and_token()
+
+        request = SignedTestRequest(consumer=consumer, token=token,)
+        credentials = plugin.extractCredentials(request)
+        self.assertEqual(credentials['userid'], self.default_user_id)
+
+        # PAS writes into the returned mapping.
+        credentials['extractor'] = 'oauth'
+
+        # Subsequent extraction within the same request will not need
+        # to consult the token manager again.
+        self.tokenManager.remove(token)
+        credentials = plugin.extractCredentials(request)
+        self.assertEqual(credentials, {'userid': self.default_user_id})
+
+        # A new request will no longer be able to use the token.
+        request = SignedTestRequest(consumer=consumer, token=token,)
+        self.assertRaises(Forbidden, plugin.extractCredentials, request)
+
+        # The same error is raised again for the same request.
+        self.tokenManager.add(token)
+        self.assertRaises(Forbidden, plugin.extractCredentials, request)
+
+    def test_1020_replayed_request(self):
+        from pmr2.oauth.nonce import NonceManager, NonceRing
+        ring = NonceRing()
+        factory = lambda context, request: NonceManager(
+            context, request, ring=ring)
+        zope.component.provideAdapter(
+            factory, (Interface, IOAuthTestLayer,), INonceManager)
+        try:
+            plugin = self.plugin
+            consumer, token = self.save_consumer_and_token()
+            request = SignedTestRequest(consumer=consumer, token=token,)
+            credentials = plugin.extractCredentials(request)
+            self.assertEqual(credentials['userid'], self.default_user_id)
+
+            # Same signed header in a new request is rejected.
+            replay = TestRequest()
+            replay._auth = request._auth
+            self.assertRaises(Forbidden, plugin.extractCredentials, replay)
+        finally:
+            zope.component.getGlobalSiteManager().unregisterAdapter(
+                factory, (Interface, IOAuthTestLayer,), INonceManager)
+
+    def test_1022_nonce_released_on_conflict(self):
+        from pmr2.oauth.nonce import NonceManager, NonceRing
+        ring = NonceRing()
+        factory = lambda context, request: NonceManager(
+            context, request, ring=ring)
+        zope.component.provideAdapter(
+            factory, (Interface, IOAuthTestLayer,), INonceManager)
+        try:
+            plugin = self.plugin
+            consumer, token = self.save_consumer_and_token()
+            request = SignedTestRequest(consumer=consumer, token=token,)
+            transaction.commit()
+            credentials = plugin.extractCredentials(request)
+            self.assertEqual(credentials['userid'], self.default_user_id)
+
+            # As the publisher retrying the request after a conflict.
+            try:
+                raise ConflictError
+            except ConflictError:
+                transaction.abort()
+            retry = TestRequest()
+            retry._auth = request._auth
+            credentials = plugin.extractCredentials(retry)
+            self.assertEqual(credentials['userid'], self.default_user_id)
+
+            # Though not once committed.
+            transaction.commit()
+            replay = TestRequest()
+            replay._auth = request._auth
+            self.assertRaises(Forbidden, plugin.extractCredentials, replay)
+        finally:
+            zope.component.getGlobalSiteManager().unregisterAdapter(
+                factory, (Interface, IOAuthTestLayer,), INonceManager)
+
+    def test_1023_nonce_unsigned_not_reserved(self):
+        checked = []
+        class NonceManager(object):
+            def __init__(self, context, request):
+                pass
+            def check(self, *a):
+                checked.append(a)
+                return True
+        zope.component.provideAdapter(
+            NonceManager, (Interface, IOAuthTestLayer,), INonceManager)
+        try:
+            consumer, token = self.save_consumer_and_token()
+            # signed with the wrong secret.
+            request = SignedTestRequest(token=token,
+                consumer=Consumer(consumer.key, 'not-the-secret'))
+            self.assertRaises(Forbidden, self.plugin.extractCredentials,
+                request)
+            self.assertEqual(checked, [])
+        finally:
+            zope.component.getGlobalSiteManager().unregisterAdapter(
+                NonceManager, (Interface, IOAuthTestLayer,), INonceManager)
+
+    def test_1024_nonce_kept_on_error(self):
+        from pmr2.oauth.nonce import NonceManager, NonceRing
+        ring = NonceRing()
+        factory = lambda context, request: NonceManager(
+            context, request, ring=ring)
+        zope.component.provideAdapter(
+            factory, (Interface, IOAuthTestLayer,), INonceManager)
+        try:
+            plugin = self.plugin
+            consumer, token = self.save_consumer_and_token()
+            request = SignedTestRequest(consumer=consumer, token=token,)
+            transaction.commit()
+            credentials = plugin.extractCredentials(request)
+            self.assertEqual(credentials['userid'], self.default_user_id)
+
+            # Requests that failed are not retried by the publisher, so
+            # the nonce remains used.
+            try:
+                raise ValueError
+            except ValueError:
+                transaction.abort()
+            replay = TestRequest()
+            replay._auth = request._auth
+            self.assertRaises(Forbidden, plugin.extractCredentials, replay)
+        finally:
+            zope.component.getGlobalSiteManager().unregisterAdapter(
+                factory, (Interface, IOAuthTestLayer,), INonceManager)
+
+    def test_1021_nonce_checked_once_per_request(self):
+        checked = []
+        class NonceManager(object):
+            def __init__(self, context, request):
+                pass
+            def check(self, *a):
+                checked.append(a)
+                return len(checked) == 1
+        zope.component.provideAdapter(
+            NonceManager, (Interface, IOAuthTestLayer,), INonceManager)
+        try:
+            validator = SiteRequestValidatorAdapter(None, TestRequest())
+            self.assertTrue(validator.reserve_nonce(
+                u'client', u'1234567890', u'nonce', u'token'))
+            self.assertTrue(validator.reserve_nonce(
+                u'client', u'1234567890', u'nonce', u'token'))
+            self.assertEqual(checked,
+                [(u'client', u'1234567890', u'nonce', u'token')])
+            self.assertFalse(validator.reserve_nonce(
+                u'client', u'1234567890', u'nonce2', u'token'))
+        finally:
+            zope.component.getGlobalSiteManager().unregisterAdapter(
+                NonceManager, (Interface, IOAuthTestLayer,), INonceManager)
+
+    def test_1030_consumer_looked_up_once(self):
+        consumer, token = self.save_consumer_and_token()
+        looked_up = []
+        getValidated = self.consumerManager.getValidated
+        def counter(key, default=None):
+            looked_up.append(key)
+            return getValidated(key, default)
+        self.consumerManager.getValidated = counter
+        try:
+            validator = SiteRequestValidatorAdapter(None, TestRequest())
+            for key in (consumer.key, u'missing-consumer'):
+                validator.validate_client_key(key, None)
+                validator.get_client_secret(key, None)
+                validator.validate_redirect_uri(key, 'oob', None)
+            self.assertEqual(validator.get_client_secret(consumer.key, None),
+                consumer.secret)
+            self.assertEqual(
+                validator.get_client_secret(u'missing-consumer', None),
+                self.consumerManager.DUMMY_SECRET)
+            # valid or not, each key is only looked up once.
+            self.assertEqual(looked_up, [consumer.key, u'missing-consumer'])
+        finally:
+            del self.consumerManager.getValidated
+
+    def _validate_access(self, client_key, access_token):
+        # The calls made by the resource endpoint for a request.
+        validator = SiteRequestValidatorAdapter(None, TestRequest())
+        validator.validate_client_key(client_key, None)
+        validator.validate_access_token(client_key, access_token, None)
+        validator.get_client_secret(client_key, None)
+        validator.get_access_token_secret(client_key, access_token, None)
+
+    def test_1031_constant_lookups(self):
+        consumer, token = self.save_consumer_and_token()
+        looked_up = []
+        getAccessToken = self.tokenManager.getAccessToken
+        def counter(key, default=False):
+            looked_up.append(key)
+            return getAccessToken(key, default)
+        self.tokenManager.getAccessToken = counter
+        try:
+            for client_key, access_token in [
+                    (consumer.key, token.key),
+                    (consumer.key, u'missing-token'),
+                    (u'missing-consumer', token.key),
+                    (u'missing-consumer', u'missing-token'),
+                    ]:
+                self._validate_access(client_key, access_token)
+            # valid or not, the token is looked up once for each request.
+            self.assertEqual(looked_up, [token.key, u'missing-token',
+                token.key, u'missing-token'])
+        finally:
+            del self.tokenManager.getAccessToken
+
+    def test_1032_access_token_cache(self):
+        consumer, token = self.save_consumer_and_token()
+        looked_up = []
+        get = self.tokenManager.get
+        def counter(key, default=None):
+            looked_up.append(key)
+            return get(key, default)
+        self.tokenManager.get = counter
+        try:
+            self._validate_access(consumer.key, token.key)
+            self._validate_access(consumer.key, u'missing-token')
+            self.assertEqual(looked_up, [token.key, u'missing-token'])
+            # Valid or not, the tokens are served from the caches from
+            # then on, so both take the same path.
+            for i in range(2):
+                self._validate_access(consumer.key, token.key)
+                self._validate_access(consumer.key, u'missing-token')
+            self.assertEqual(looked_up, [token.key, u'missing-token'])
+        finally:
+            del self.tokenManager.get
+
     def test_1050_success_with_www_form_body(self):
         # use request token
         plugin = self.plugin
@@ -267,6 +503,42 @@ class TestExtraction(unittest.TestCase):
         credentials = plugin.extractCredentials(request)
         self.assertEqual(credentials['userid'], self.default_user_id)
 
+    def test_1051_success_with_unsigned_body(self):
+        plugin = self.plugin
+        consumer, token = self.save_consumer_and_token()
+        request = SignedTestRequest(consumer=consumer, token=token,
+            method='POST', raw_body='\x00binary\xff' * 1024,
+            CONTENT_TYPE='application/octet-stream')
+        credentials = plugin.extractCredentials(request)
+        self.assertEqual(credentials['userid'], self.default_user_id)
+        # Body is not part of the signature so it was not read.
+        oauth1 = getRequestValidator(None, request)
+        self.assertEqual(oauth1.body, u'')
+
+    def test_1060_success_rsa_sha1(self):
+        from pmr2.oauth.tests.test_signature import generateRSAKey
+        plugin = self.plugin
+        consumer, token = self.save_consumer_and_token()
+        private_key, consumer.rsa_key = generateRSAKey()
+        request = SignedTestRequest(consumer=consumer, token=token,
+            signature_method=u'RSA-SHA1', rsa_key=private_key)
+        credentials = plugin.extractCredentials(request)
+        self.assertEqual(credentials['userid'], self.default_user_id)
+
+    def test_1061_fail_rsa_sha1_wrong_key(self):
+        from pmr2.oauth.tests.test_signature import generateRSAKey
+        plugin = self.plugin
+        consumer, token = self.save_consumer_and_token()
+        private_key, public_key = generateRSAKey()
+        request = SignedTestRequest(consumer=consumer, token=token,
+            signature_method=u'RSA-SHA1', rsa_key=private_key)
+        # no key for this consumer.
+        self.assertRaises(Forbidden, plugin.extractCredentials, request)
+        consumer.rsa_key = generateRSAKey()[1]
+        request = SignedTestRequest(consumer=consumer, token=token,
+            signature_method=u'RSA-SHA1', rsa_key=private_key)
+        self.assertRaises(Forbidden, plugin.extractCredentials, request)
+
     def test_1100_missing_token_ignored(self):
         # Should not forbid cases where the oauth_token is missing (it
         # could be a RequestToken, let that page handle it).
@@ -305,9 +577,86 @@ class TestExtraction(unittest.TestCase):
         self.assertEqual(oauth1.dummy_access_token,
             self.tokenManager.DUMMY_KEY)
 
+    def test_2001_request_validator_shared(self):
+        site = object()
+        request = TestRequest()
+        oauth1 = getRequestValidator(site, request)
+        self.assertTrue(oauth1 is getRequestValidator(site, request))
+        self.assertTrue(oauth1.tokenManager is self.tokenManager)
+
+        # Different requests will have their own validators.
+        self.assertFalse(oauth1 is getRequestValidator(site, TestRequest()))
+
+        # The endpoints also share the validator for the request.
+        from pmr2.oauth.browser.endpoints import ResourceEndpointValidator
+        endpoint = ResourceEndpointValidator(site, request)
+        self.assertTrue(endpoint.request_validator is
+            endpoint.request_validator)
+
+    def test_2010_parse_request_once(self):
+        from pmr2.oauth.browser.endpoints import ResourceEndpointValidator
+        consumer, token = self.save_consumer_and_token()
+        request = SignedTestRequest(consumer=consumer, token=token,)
+        endpoint = ResourceEndpointValidator(None, request)
+
+        oreq = endpoint.parse_request()
+        self.assertEqual(oreq.client_key, consumer.key)
+        self.assertEqual(oreq.resource_owner_key, token.key)
+
+        # Modifications to the returned request are not retained.
+        oreq.client_key = u'dummy'
+        self.assertEqual(endpoint.parse_request().client_key, consumer.key)
+
+        # The parsed result is reused by the default extraction.
+        endpoint._oauth_request.signature = u'invalid'
+        self.assertEqual(endpoint.parse_request().signature, u'invalid')
+        self.assertEqual(endpoint._create_request().signature, u'invalid')
+
+        oreq = endpoint.parse_request()
+        self.assertTrue(endpoint.check_request(oreq))
+        result, oreq = endpoint.validate_request(oreq)
+        self.assertFalse(result)
+
+        # A new endpoint for the same request.
+        endpoint = ResourceEndpointValidator(None, request)
+        oreq = endpoint.parse_request()
+        self.assertTrue(endpoint.check_request(oreq))
+        result, oreq = endpoint.validate_request(oreq)
+        self.assertTrue(result)
+
+
+class TestExtractRequestURL(unittest.TestCase):
+
+    def test_0000_valid_query_string(self):
+        for qs in ['a=1&b=2', 'a=%2F&b=%C3%A9', 'a=%', 'a=%4', 'a', '',
+                'a=1;b=2+3~,*']:
+            self.assertTrue(isValidQueryString(qs), qs)
+        for qs in ['a=%4g', 'a=%%41', 'a=/', 'a=%FF', 'a=%C3', 'a=\xc3\xa9']:
+            self.assertFalse(isValidQueryString(qs), qs)
+
+    def test_0100_extract(self):
+        request = TestRequest(url='http://nohost/plone',
+            QUERY_STRING='a=1&b=%2F')
+        self.assertEqual(extractRequestURL(request),
+            'http://nohost/plone?a=1&b=%2F')
+
+    def test_0101_extract_quoted(self):
+        request = TestRequest(url='http://nohost/plone',
+            QUERY_STRING='a=/b c')
+        self.assertEqual(extractRequestURL(request),
+            'http://nohost/plone?a=%2Fb+c')
+
+    def test_0110_extract_memoized(self):
+        request = TestRequest(url='http://nohost/plone',
+            QUERY_STRING='a=1')
+        result = extractRequestURL(request)
+        request.other['ACTUAL_URL'] = 'http://nohost/other'
+        self.assertTrue(extractRequestURL(request) is result)
+
 
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestExtraction))
+    suite.addTest(makeSuite(TestExtractRequestURL))
     return suite
@@ -0,0 +1,201 @@
+import unittest
+
+from zope.interface import Interface
+import zope.component
+import zope.interface
+from zope.annotation.attribute import AttributeAnnotations
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.annotation.interfaces import IAnnotations
+
+from pmr2.oauth.interfaces import ITokenManager, IScopeManager
+from pmr2.oauth.interfaces import IContentTypeScopeManager
+from pmr2.oauth.token import Token, TokenManager, CompactTokenManager
+from pmr2.oauth.scope import BTreeScopeManager, ContentTypeScopeManager
+from pmr2.oauth.maintenance import purgeExpiredTokens
+from pmr2.oauth.maintenance import compactTokenManager
+from pmr2.oauth.maintenance import revokeMappingAccess
+from pmr2.oauth.maintenance import rescopeMappingAccess
+from pmr2.oauth.maintenance import purgeUnusedMappings
+
+from pmr2.oauth.tests.base import IOAuthTestLayer
+from pmr2.oauth.tests.base import TestRequest
+
+
+class PurgeExpiredTokensTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tm = TokenManager()
+        self.sm = BTreeScopeManager()
+        zope.component.provideAdapter(lambda c, r: self.tm,
+            (Interface, IOAuthTestLayer,), ITokenManager)
+        zope.component.provideAdapter(lambda c, r: self.sm,
+            (Interface, IOAuthTestLayer,), IScopeManager)
+
+    def test_0000_purge_expired(self):
+        tokens = [self.tm.generateRequestToken('consumer-key', 'oob')
+            for i in range(5)]
+        for token in tokens:
+            self.sm.requestScope(token.key, 'scope')
+        access = Token('access-key', 'access-secret')
+        access.access = True
+        access.user = 'user'
+        self.tm.add(access)
+        self.sm.setAccessScope(access.key, 'scope')
+
+        later = max(t.expiry for t in tokens) + 1
+        result = purgeExpiredTokens(object(), TestRequest(), batch_size=2,
+            commit=False, timestamp=later)
+        self.assertEqual(result, 5)
+        for token in tokens:
+            self.assertEqual(self.tm.get(token.key), None)
+            self.assertEqual(self.sm.getScope(token.key, None), None)
+
+        # access token and its scope untouched.
+        self.assertEqual(self.tm.get(access.key), access)
+        self.assertEqual(self.sm.getAccessScope(access.key), 'scope')
+
+
+class MappingAccessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tm = TokenManager()
+        self.sm = ContentTypeScopeManager()
+        zope.component.provideAdapter(lambda c, r: self.tm,
+            (Interface, IOAuthTestLayer,), ITokenManager)
+        zope.component.provideAdapter(lambda c, r: self.sm,
+            (Interface, IOAuthTestLayer,), IContentTypeScopeManager)
+        self.file_id = self.sm.addMapping({'File': ['document_view']})
+        self.folder_id = self.sm.addMapping({'Folder': ['folder_contents']})
+        for i in range(5):
+            token = Token('access-key%d' % i, 'access-secret')
+            token.access = True
+            token.user = 'user'
+            self.tm.add(token)
+            if i % 2:
+                scope = set([self.file_id])
+            else:
+                scope = set([self.file_id, self.folder_id])
+            self.sm.setAccessScope(token.key, scope)
+
+    def test_0000_revoke(self):
+        result = revokeMappingAccess(object(), self.folder_id,
+            TestRequest(), batch_size=2, commit=False)
+        self.assertEqual(result, 3)
+        for key in ('access-key0', 'access-key2', 'access-key4'):
+            self.assertEqual(self.tm.get(key), None)
+            self.assertEqual(self.sm.getAccessScope(key, None), None)
+        self.assertEqual(list(self.sm.getMappingAccessKeys(self.folder_id)),
+            [])
+        self.assertEqual(list(self.sm.getMappingAccessKeys(self.file_id)),
+            ['access-key1', 'access-key3'])
+        self.assertEqual(len(self.tm.getTokensForUser('user')), 2)
+
+    def test_0001_rescope(self):
+        new_id = self.sm.addMapping({'File': ['document_view', 'view']})
+        result = rescopeMappingAccess(object(), self.file_id, new_id,
+            TestRequest(), batch_size=2, commit=False)
+        self.assertEqual(result, 5)
+        self.assertEqual(list(self.sm.getMappingAccessKeys(self.file_id)),
+            [])
+        self.assertEqual(len(self.sm.getMappingAccessKeys(new_id)), 5)
+        self.assertEqual(self.sm.getAccessScope('access-key0'),
+            set([new_id, self.folder_id]))
+        self.assertEqual(self.sm.getAccessScope('access-key1'),
+            set([new_id]))
+        # tokens untouched.
+        self.assertEqual(len(self.tm.getTokensForUser('user')), 5)
+
+        self.assertRaises(ValueError, rescopeMappingAccess, object(),
+            new_id, new_id, TestRequest())
+        self.assertRaises(KeyError, rescopeMappingAccess, object(),
+            new_id, 100, TestRequest())
+
+    def test_0002_purge_unused(self):
+        revokeMappingAccess(object(), self.folder_id, TestRequest(),
+            commit=False)
+        self.sm.addMapping({'File': ['view']})
+        self.assertEqual(purgeUnusedMappings(object(), TestRequest(),
+            commit=False), 1)
+        self.assertEqual(self.sm.getMapping(self.folder_id, None), None)
+        self.assertEqual(self.sm.getAccessScope('access-key1'),
+            set([self.file_id]))
+
+
+class Site(object):
+    zope.interface.implements(IAttributeAnnotatable)
+
+
+class CompactTokenManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        zope.component.provideAdapter(AttributeAnnotations)
+
+    def test_0000_compact(self):
+        site = Site()
+        self.assertEqual(compactTokenManager(site), None)
+
+        annotations = IAnnotations(site)
+        key = 'pmr2.oauth.token.TokenManager'
+        tm = annotations[key] = TokenManager()
+        request = tm.generateRequestToken('consumer-key', 'oob')
+        tokens = []
+        for i in range(3):
+            token = Token('access-key%d' % i, 'access-secret')
+            token.access = True
+            token.user = 'user'
+            tm.add(token)
+            tokens.append(token.key)
+
+        self.assertEqual(compactTokenManager(site), 5)
+        new = annotations[key]
+        self.assertTrue(isinstance(new, CompactTokenManager))
+        self.assertEqual(new.__parent__, site)
+        self.assertEqual(new.getRequestToken(request.key).verifier,
+            request.verifier)
+        self.assertEqual(
+            [t.key for t in new.getTokensForUser('user')], tokens)
+        self.assertEqual(new.purgeExpired(request.expiry + 1)[0].key,
+            request.key)
+
+        # already converted.
+        self.assertEqual(compactTokenManager(site), None)
+
+    def test_0001_compact_resume(self):
+        site = Site()
+        annotations = IAnnotations(site)
+        key = 'pmr2.oauth.token.TokenManager'
+        tm = annotations[key] = TokenManager()
+        for i in range(5):
+            token = Token('access-key%d' % i, 'access-secret')
+            token.access = True
+            token.user = 'user'
+            tm.add(token)
+
+        # An interrupted conversion, with a token that was modified and
+        # one that was removed since they were copied.
+        staging = annotations[key + '.compact'] = CompactTokenManager()
+        stale = Token('access-key0', 'old-secret')
+        stale.expiry = 1
+        staging.add(stale)
+        staging.add(Token('removed-key', 'removed-secret'))
+
+        self.assertEqual(compactTokenManager(site, batch_size=2), 6)
+        new = annotations[key]
+        self.assertTrue(new is staging)
+        self.assertFalse(key + '.compact' in annotations)
+        self.assertEqual(new.get('access-key0').secret, 'access-secret')
+        self.assertEqual(new.get('access-key0').expiry, None)
+        self.assertEqual(new.get('removed-key'), None)
+        self.assertEqual(list(new._tokens.keys()), list(tm._tokens.keys()))
+        # the stale expiry is no longer indexed.
+        self.assertEqual(
+            sum([len(keys) for keys in new._expiry_index.values()]), 0)
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(PurgeExpiredTokensTestCase))
+    suite.addTest(makeSuite(MappingAccessTestCase))
+    suite.addTest(makeSuite(CompactTokenManagerTestCase))
+    return suite
@@ -2,10 +2,13 @@ import zope.component
 from zope.annotation import IAnnotations
 
 from BTrees.OOBTree import OOBTree
+from persistent.list import PersistentList
 
 from Products.PloneTestCase import ptc
 
-from pmr2.oauth.interfaces import ITokenManager
+from pmr2.oauth.interfaces import ITokenManager, TokenInvalidError
+from pmr2.oauth.interfaces import IContentTypeScopeManager
+from pmr2.oauth.token import Token
 
 from pmr2.oauth.tests import base
 
@@ -40,8 +43,59 @@ class MigrationV04TestCase(ptc.PloneTestCase):
         self.assertFalse('pmr2.oauth.scope.DefaultScopeManager' in ants)
 
 
+class MigrationV06TestCase(ptc.PloneTestCase):
+    """
+    Test case for migration from v0.4 to v0.6
+    """
+
+    def afterSetUp(self):
+        tm = zope.component.getMultiAdapter((self.portal, None), ITokenManager)
+        for key in ('test1', 'test2', 'test3'):
+            token = Token(key, 'secret')
+            token.access = True
+            token.user = 'user'
+            tm._tokens[key] = token
+        tm._user_token_map['user'] = PersistentList(['test3', 'test1'])
+        token = Token('request', 'secret')
+        token.expiry = 1000
+        tm._tokens['request'] = token
+        del tm._expiry_index
+
+    def test_0000_migration(self):
+        from pmr2.oauth.setuphandlers import token_upgrade_v0_6
+        tm = zope.component.getMultiAdapter((self.portal, None), ITokenManager)
+        token_upgrade_v0_6(self.portal)
+        user_tokens = tm._user_token_map['user']
+        self.assertFalse(isinstance(user_tokens, PersistentList))
+        self.assertEqual(sorted(user_tokens.keys()), ['test1', 'test3'])
+        self.assertEqual([t.key for t in tm.getTokensForUser('user')],
+            ['test3', 'test1'])
+        self.assertEqual(tm.getAccessToken('test1').key, 'test1')
+        self.assertRaises(TokenInvalidError, tm.getAccessToken, 'test2')
+        self.assertEqual([t.key for t in tm.purgeExpired()], ['request'])
+
+    def test_0001_migration_scope(self):
+        from pmr2.oauth.setuphandlers import scope_upgrade_v0_6
+        sm = zope.component.getMultiAdapter((self.portal, None),
+            IContentTypeScopeManager)
+        sm._scope['access.test1'] = set([1, 2])
+        sm._scope['access.test2'] = set([2, 1])
+        sm._scope['client.test1'] = set([1])
+        sm._scope['request'] = set([1])
+        scope_upgrade_v0_6(self.portal)
+        self.assertTrue(isinstance(sm._scope['access.test1'], int))
+        self.assertEqual(sm.getAccessScopeId('test1'),
+            sm.getAccessScopeId('test2'))
+        self.assertEqual(sm.getAccessScope('test1'), set([1, 2]))
+        self.assertEqual(sm._scope['client.test1'], set([1]))
+        self.assertEqual(sm._scope['request'], set([1]))
+        self.assertEqual(list(sm.getMappingAccessKeys(2)),
+            ['test1', 'test2'])
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(MigrationV04TestCase))
+    suite.addTest(makeSuite(MigrationV06TestCase))
     return suite
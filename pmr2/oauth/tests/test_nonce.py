@@ -0,0 +1,294 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pmr2.oauth.interfaces import INonceManager
+from pmr2.oauth.nonce import NonceRing
+from pmr2.oauth.nonce import NonceManager
+from pmr2.oauth.nonce import MmapNonceTable
+from pmr2.oauth.memcached import MemcachedClient
+from pmr2.oauth.memcached import MemcachedError
+from pmr2.oauth.memcached import MemcachedNonceStore
+
+from pmr2.oauth.tests.memcached import StandInMemcachedServer
+
+from pmr2.oauth.tests.base import TestRequest
+
+
+class NonceRingTestCase(unittest.TestCase):
+
+    def test_000_replay(self):
+        ring = NonceRing(window=600, bucket_size=60)
+        now = 1000000000
+        self.assertTrue(ring.add(now, 'a', now=now))
+        self.assertFalse(ring.add(now, 'a', now=now))
+        self.assertTrue(ring.add(now, 'b', now=now))
+        # the timestamp is part of the bucket selection.
+        self.assertTrue(ring.add(now + 60, 'a', now=now))
+
+    def test_001_window(self):
+        ring = NonceRing(window=600, bucket_size=60)
+        now = 1000000000
+        self.assertFalse(ring.add(now - 601, 'a', now=now))
+        self.assertFalse(ring.add(now + 601, 'a', now=now))
+        self.assertTrue(ring.add(now - 600, 'a', now=now))
+        self.assertTrue(ring.add(now + 600, 'a', now=now))
+
+    def test_002_rotation(self):
+        ring = NonceRing(window=600, bucket_size=60)
+        now = 1000000000
+        self.assertTrue(ring.add(now, 'a', now=now))
+        # still remembered for as long as the timestamp is valid.
+        later = now + 600
+        self.assertFalse(ring.add(now, 'a', now=later))
+        # the bucket taking over its slot drops the old entries.
+        later = now + ring._count * ring.bucket_size
+        self.assertTrue(ring.add(later, 'a', now=later))
+        self.assertEqual(len(ring._buckets), ring._count)
+        self.assertEqual(sum(len(b[1]) for b in ring._buckets if b[1]), 1)
+
+    def test_003_limit(self):
+        ring = NonceRing(window=600, bucket_size=60, bucket_limit=2)
+        now = 1000000000
+        self.assertTrue(ring.add(now, 'a', now=now))
+        self.assertTrue(ring.add(now, 'b', now=now))
+        # accepted but not recorded once full, rather than rejecting
+        # every client.
+        self.assertTrue(ring.add(now, 'c', now=now))
+        self.assertTrue(ring.add(now, 'c', now=now))
+        self.assertFalse(ring.add(now, 'a', now=now))
+
+    def test_004_discard(self):
+        ring = NonceRing(window=600, bucket_size=60)
+        now = 1000000000
+        self.assertTrue(ring.add(now, 'a', now=now))
+        ring.discard(now, 'a')
+        ring.discard(now, 'b')
+        ring.discard(now + 6000, 'a')
+        self.assertTrue(ring.add(now, 'a', now=now))
+        self.assertFalse(ring.add(now, 'a', now=now))
+
+
+class MmapNonceTableTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'nonce')
+        self.tables = []
+
+    def tearDown(self):
+        for table in self.tables:
+            table.close()
+        shutil.rmtree(self.tmpdir)
+
+    def makeTable(self, **kw):
+        table = MmapNonceTable(self.path, **kw)
+        self.tables.append(table)
+        return table
+
+    def test_000_replay(self):
+        table = self.makeTable(slots=1024, stripe_size=256)
+        now = 1000000000
+        self.assertTrue(table.add(now, ('c', 't', 'a'), now=now))
+        self.assertFalse(table.add(now, ('c', 't', 'a'), now=now))
+        self.assertTrue(table.add(now, ('c', 't', 'b'), now=now))
+        self.assertTrue(table.add(now, ('c', None, 'a'), now=now))
+        self.assertFalse(table.add(now - 601, ('c', 't', 'c'), now=now))
+
+    def test_001_shared(self):
+        # As if opened by another process.
+        table1 = self.makeTable(slots=1024, stripe_size=256)
+        table2 = self.makeTable(slots=1024, stripe_size=256)
+        now = 1000000000
+        self.assertTrue(table1.add(now, ('c', 't', 'a'), now=now))
+        self.assertFalse(table2.add(now, ('c', 't', 'a'), now=now))
+
+    def test_002_reinitialize(self):
+        table1 = self.makeTable(slots=1024, stripe_size=256)
+        now = 1000000000
+        self.assertTrue(table1.add(now, ('c', 't', 'a'), now=now))
+        table1.close()
+        self.tables.remove(table1)
+        # incompatible layout, so the table is recreated.
+        table2 = self.makeTable(slots=2048, stripe_size=256)
+        self.assertTrue(table2.add(now, ('c', 't', 'a'), now=now))
+
+    def test_003_discard(self):
+        table = self.makeTable(slots=4, stripe_size=4, max_probes=4)
+        now = 1000000000
+        for i in range(3):
+            self.assertTrue(table.add(now, ('c', 't', str(i)), now=now))
+        table.discard(now, ('c', 't', '0'))
+        # the keys further along the probes are still found.
+        for i in range(1, 3):
+            self.assertFalse(table.add(now, ('c', 't', str(i)), now=now))
+        self.assertTrue(table.add(now, ('c', 't', '0'), now=now))
+        self.assertFalse(table.add(now, ('c', 't', '0'), now=now))
+
+    def test_010_full_and_expiry(self):
+        table = self.makeTable(slots=4, stripe_size=4, max_probes=4)
+        now = 1000000000
+        for i in range(4):
+            self.assertTrue(table.add(now + i, ('c', 't', str(i)),
+                now=now))
+        # Still remembered while within the window.
+        self.assertFalse(table.add(now, ('c', 't', '0'), now=now + 600))
+        # Slots are reused once the timestamps have left the window.
+        later = now + 601
+        self.assertTrue(table.add(later, ('c', 't', 'x'), now=later))
+        self.assertFalse(table.add(later, ('c', 't', 'x'), now=later))
+
+    def test_011_full_evicts_oldest(self):
+        table = self.makeTable(slots=4, stripe_size=4, max_probes=4)
+        now = 1000000000
+        for i in range(4):
+            self.assertTrue(table.add(now + i, ('c', 't', str(i)),
+                now=now))
+        # accepted by taking over the slot of the oldest nonce.
+        self.assertTrue(table.add(now, ('c', 't', 'x'), now=now))
+        self.assertFalse(table.add(now, ('c', 't', 'x'), now=now))
+        self.assertTrue(table.add(now, ('c', 't', '0'), now=now))
+        for i in range(2, 4):
+            self.assertFalse(table.add(now + i, ('c', 't', str(i)),
+                now=now))
+
+
+class MemcachedTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInMemcachedServer()
+        self.host, self.port = self.server.start()
+        self.client = MemcachedClient(self.host, self.port, timeout=1)
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+
+    def test_000_client(self):
+        self.assertTrue(self.client.add('a', '1', 60))
+        self.assertFalse(self.client.add('a', '2', 60))
+        self.assertTrue(self.client.add('b', '1', 60))
+        self.assertTrue(self.client.delete('a'))
+        self.assertFalse(self.client.delete('a'))
+        # connection reused.
+        self.assertEqual(len(self.client._pool), 1)
+
+    def test_001_client_error(self):
+        self.assertTrue(self.client.add('a', '1', 60))
+        self.server.stop()
+        self.assertRaises(MemcachedError, self.client.add, 'b', '1', 60)
+        # the failed connection is discarded.
+        self.assertEqual(len(self.client._pool), 0)
+        self.server = None
+
+    def test_002_client_retry(self):
+        self.assertTrue(self.client.add('a', '1', 60))
+        self.assertEqual(len(self.client._pool), 1)
+        # the server drops the pooled connection while it is idle.
+        self.server.disconnect()
+        self.assertFalse(self.client.add('a', '1', 60))
+        self.assertTrue(self.client.add('b', '1', 60))
+        # the new connection is pooled in place of the dropped one.
+        self.assertEqual(len(self.client._pool), 1)
+
+    def test_010_store(self):
+        store = MemcachedNonceStore(self.client)
+        now = time.time()
+        self.assertTrue(store.add(now, ('c', 't', 'a')))
+        self.assertFalse(store.add(now, ('c', 't', 'a')))
+        self.assertTrue(store.add(now, ('c', None, 'a')))
+        self.assertFalse(store.add(now - 601, ('c', 't', 'b')))
+        store.discard(now, ('c', 't', 'a'))
+        self.assertTrue(store.add(now, ('c', 't', 'a')))
+
+    def test_011_store_fail_policy(self):
+        self.server.delay = 0.2
+        client = MemcachedClient(self.host, self.port, timeout=0.05)
+        store = MemcachedNonceStore(client, fail_open=False)
+        self.assertFalse(store.add(time.time(), ('c', 't', 'a')))
+        store = MemcachedNonceStore(client, fail_open=True)
+        self.assertTrue(store.add(time.time(), ('c', 't', 'b')))
+
+
+class NonceManagerTestCase(unittest.TestCase):
+
+    def test_000_check(self):
+        manager = NonceManager(None, TestRequest(), ring=NonceRing())
+        self.assertTrue(INonceManager.providedBy(manager))
+        timestamp = unicode(int(time.time()))
+        self.assertTrue(manager.check(u'client', timestamp, u'nonce',
+            u'token'))
+        self.assertFalse(manager.check(u'client', timestamp, u'nonce',
+            u'token'))
+        self.assertTrue(manager.check(u'client', timestamp, u'nonce',
+            u'other'))
+        self.assertTrue(manager.check(u'other', timestamp, u'nonce',
+            u'token'))
+        self.assertFalse(manager.check(u'client', u'bad', u'nonce'))
+
+        manager.release(u'client', timestamp, u'nonce', u'token')
+        manager.release(u'client', u'bad', u'nonce')
+        self.assertTrue(manager.check(u'client', timestamp, u'nonce',
+            u'token'))
+
+    def test_001_release_on_conflict(self):
+        import transaction
+        from ZODB.POSException import ConflictError
+        from pmr2.oauth.nonce import NonceRelease
+        manager = NonceManager(None, TestRequest(), ring=NonceRing())
+        timestamp = unicode(int(time.time()))
+
+        for i in range(2):
+            self.assertTrue(manager.check(u'client', timestamp, u'nonce'))
+            release = NonceRelease(manager)
+            release.add(u'client', timestamp, u'nonce')
+            transaction.get().join(release)
+            transaction.savepoint()
+            # As the publisher does before retrying the request.
+            try:
+                raise ConflictError
+            except ConflictError:
+                transaction.abort()
+
+        self.assertTrue(manager.check(u'client', timestamp, u'nonce'))
+        release = NonceRelease(manager)
+        release.add(u'client', timestamp, u'nonce')
+        transaction.get().join(release)
+        transaction.commit()
+        self.assertFalse(manager.check(u'client', timestamp, u'nonce'))
+
+
+    def test_002_no_release_on_error(self):
+        import transaction
+        from pmr2.oauth.nonce import NonceRelease
+        manager = NonceManager(None, TestRequest(), ring=NonceRing())
+        timestamp = unicode(int(time.time()))
+
+        self.assertTrue(manager.check(u'client', timestamp, u'nonce'))
+        release = NonceRelease(manager)
+        release.add(u'client', timestamp, u'nonce')
+        transaction.get().join(release)
+        # Requests failing for other reasons are not retried.
+        try:
+            raise ValueError
+        except ValueError:
+            transaction.abort()
+        self.assertFalse(manager.check(u'client', timestamp, u'nonce'))
+
+        self.assertTrue(manager.check(u'client', timestamp, u'nonce2'))
+        release = NonceRelease(manager)
+        release.add(u'client', timestamp, u'nonce2')
+        transaction.get().join(release)
+        transaction.abort()
+        self.assertFalse(manager.check(u'client', timestamp, u'nonce2'))
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(NonceRingTestCase))
+    suite.addTest(makeSuite(MmapNonceTableTestCase))
+    suite.addTest(makeSuite(MemcachedTestCase))
+    suite.addTest(makeSuite(NonceManagerTestCase))
+    return suite
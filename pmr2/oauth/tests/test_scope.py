@@ -1,6 +1,8 @@
 from time import time
 import unittest
 
+import transaction
+
 from zope.interface import Interface
 import zope.component
 from zope.schema.interfaces import WrongType, WrongContainedType
@@ -14,6 +16,7 @@ from pmr2.oauth.interfaces import KeyExistsError
 from pmr2.oauth.interfaces import IDefaultScopeManager
 from pmr2.oauth.scope import BTreeScopeManager, ContentTypeScopeManager
 from pmr2.oauth.scope import ContentTypeScopeProfile
+from pmr2.oauth import scope
 
 from pmr2.oauth.tests import base
 
@@ -113,6 +116,184 @@ class CTSMMappingTestCase(unittest.TestCase):
         self.sm.delMappingName('rawscope')
         self.assertRaises(KeyError, self.sm.getMappingId, 'rawscope')
 
+    def test_0300_compiled_mapping(self):
+        mapping = {
+            'Folder': ['folder_contents', 'test_*', 'test/*', 'test/a/*',
+                'example/view*'],
+            'File': [],
+        }
+        mapping_id = self.sm.addMapping(mapping)
+        compiled = self.sm.getCompiledMapping(mapping_id)
+        # the redundant prefix is dropped.
+        self.assertEqual(compiled.types['Folder'][1],
+            ['example/view', 'test/'])
+        for subpath in ['folder_contents', 'test_*', 'test_view', 'test/',
+                'test/a', 'test/a/b', 'example/view', 'example/viewer',
+                'example/', 'example', 'folder_contents/', 'tes']:
+            self.assertEqual(compiled.match('Folder', subpath),
+                self.sm.validateTypeSubpathMapping('Folder', subpath,
+                    mapping), subpath)
+        self.assertFalse(compiled.match('File', 'view'))
+        self.assertFalse(compiled.match('Document', 'view'))
+        self.assertFalse(compiled.match(None, None))
+
+    def test_0301_compiled_mapping_lazy(self):
+        mapping_id = self.sm.addMapping(self.folder_mapping)
+        del self.sm._v_compiled_mappings
+        compiled = self.sm.getCompiledMapping(mapping_id)
+        self.assertTrue(compiled.match('Folder', 'folder_contents'))
+        self.assertTrue(self.sm.getCompiledMapping(mapping_id) is compiled)
+        self.assertEqual(self.sm.getCompiledMapping(100), None)
+
+    def test_0310_check_method_permission(self):
+        mapping_id = self.sm.addMapping(self.folder_mapping,
+            methods='GET POST')
+        self.assertTrue(self.sm.checkMethodPermission(mapping_id, 'GET'))
+        self.assertTrue(self.sm.checkMethodPermission(mapping_id, 'POST'))
+        self.assertFalse(self.sm.checkMethodPermission(mapping_id, 'PUT'))
+        self.assertFalse(self.sm.checkMethodPermission(mapping_id,
+            'UNKNOWN'))
+        self.assertFalse(self.sm.checkMethodPermission(100, 'GET'))
+
+    def test_0320_validate_mappings(self):
+        file_id = self.sm.addMapping(self.file_mapping)
+        folder_id = self.sm.addMapping(self.folder_mapping,
+            methods='GET POST')
+        mappings = set([file_id, folder_id, 100])
+        self.assertTrue(self.sm.validateMappings(mappings, 'File',
+            'document_view', 'GET'))
+        self.assertFalse(self.sm.validateMappings(mappings, 'File',
+            'document_view', 'POST'))
+        self.assertTrue(self.sm.validateMappings(mappings, 'Folder',
+            'folder_contents', 'POST'))
+        self.assertFalse(self.sm.validateMappings(mappings, 'Folder',
+            'document_view', 'GET'))
+        self.assertFalse(self.sm.validateMappings(set([100]), 'File',
+            'document_view', 'GET'))
+
+    def test_0330_decision_cache(self):
+        file_id = self.sm.addMapping(self.file_mapping)
+        self.sm.setAccessScope('akey', set([file_id]))
+        # no portal_types here, so resolve the name as the subpath.
+        self.sm.resolveTarget = lambda accessed, name: ('File', name)
+        request = base.TestRequest()
+
+        self.assertTrue(self.sm.validate(request, '', 'akey', None, None,
+            'document_view', None))
+        self.assertFalse(self.sm.validate(request, '', 'akey', None, None,
+            'folder_contents', None))
+        cache = self.sm._getDecisionCache()
+        self.assertEqual(len(cache), 2)
+        self.assertTrue(self.sm.validate(request, '', 'akey', None, None,
+            'document_view', None))
+        self.assertEqual(len(cache), 2)
+
+        # added mappings and a changed default discard the decisions.
+        self.sm.addMapping(self.folder_mapping)
+        self.assertFalse(self.sm._getDecisionCache() is cache)
+        cache = self.sm._getDecisionCache()
+        self.sm.default_mapping_id = file_id
+        self.assertFalse(self.sm._getDecisionCache() is cache)
+
+    def test_0340_intern_access_scope(self):
+        file_id = self.sm.addMapping(self.file_mapping)
+        folder_id = self.sm.addMapping(self.folder_mapping)
+        self.sm.setAccessScope('akey1', set([file_id, folder_id]))
+        self.sm.setAccessScope('akey2', set([folder_id, file_id]))
+        self.sm.setAccessScope('akey3', set([file_id]))
+
+        scope_id = self.sm.getAccessScopeId('akey1')
+        self.assertEqual(self.sm.getAccessScopeId('akey2'), scope_id)
+        self.assertNotEqual(self.sm.getAccessScopeId('akey3'), scope_id)
+        self.assertEqual(len(self.sm._scope_sets), 2)
+        self.assertTrue(self.sm.getAccessScope('akey1') is
+            self.sm.getAccessScope('akey2'))
+        self.assertEqual(self.sm.getAccessScope('akey1'),
+            set([file_id, folder_id]))
+        self.assertEqual(self.sm.internScope(frozenset([file_id])),
+            self.sm.getAccessScopeId('akey3'))
+
+        self.assertRaises(KeyError, self.sm.getAccessScope, 'akey4')
+        self.assertEqual(self.sm.getAccessScopeId('akey4'), None)
+        self.sm.delAccessScope('akey1')
+        self.assertEqual(self.sm.getAccessScope('akey1', None), None)
+
+    def test_0341_access_scope_not_interned(self):
+        # scopes set before interning was introduced.
+        file_id = self.sm.addMapping(self.file_mapping)
+        self.sm._scope['access.akey'] = set([file_id])
+        self.assertEqual(self.sm.getAccessScopeId('akey'), None)
+        self.assertEqual(self.sm.getAccessScope('akey'), set([file_id]))
+
+        self.sm.resolveTarget = lambda accessed, name: ('File', name)
+        request = base.TestRequest()
+        self.assertTrue(self.sm.validate(request, '', 'akey', None, None,
+            'document_view', None))
+        self.assertFalse(self.sm.validate(request, '', 'akey', None, None,
+            'folder_contents', None))
+
+    def test_0350_mapping_access_keys(self):
+        file_id = self.sm.addMapping(self.file_mapping)
+        folder_id = self.sm.addMapping(self.folder_mapping)
+        self.sm.setAccessScope('akey1', set([file_id, folder_id]))
+        self.sm.setAccessScope('akey2', set([file_id]))
+        self.sm.setAccessScope('akey3', set([folder_id]))
+
+        self.assertEqual(list(self.sm.getMappingAccessKeys(file_id)),
+            ['akey1', 'akey2'])
+        self.assertEqual(list(self.sm.getMappingAccessKeys(folder_id)),
+            ['akey1', 'akey3'])
+        self.assertEqual(list(self.sm.getMappingAccessKeys(folder_id,
+            'akey1')), ['akey3'])
+        self.assertEqual(list(self.sm.getMappingAccessKeys(100)), [])
+        self.assertEqual(sorted(self.sm.getMappingAccessKeyCounts()),
+            [(file_id, 2), (folder_id, 2)])
+
+        self.sm.delAccessScope('akey1')
+        self.sm.delAccessScope('akey3')
+        self.assertEqual(list(self.sm.getMappingAccessKeys(file_id)),
+            ['akey2'])
+        self.assertEqual(list(self.sm.getMappingAccessKeys(folder_id)), [])
+        self.assertEqual(self.sm.getMappingAccessKeyCounts(), [(file_id, 1)])
+        self.assertRaises(KeyError, self.sm.delAccessScope, 'akey1')
+
+    def test_0400_purge_unused_mappings(self):
+        file_id = self.sm.addMapping(self.file_mapping)
+        folder_id = self.sm.addMapping(self.folder_mapping)
+        unused_id = self.sm.addMapping(self.file_mapping)
+        named_id = self.sm.addMapping(self.file_mapping)
+        client_id = self.sm.addMapping(self.file_mapping)
+        self.sm.setMappingNameToId('file', named_id)
+        self.sm.setAccessScope('akey1', set([file_id, folder_id]))
+        self.sm.setAccessScope('akey2', set([folder_id]))
+        self.sm.setClientScope('ckey', set([client_id]))
+        last_id = self.sm.addMapping(self.folder_mapping)
+
+        self.assertEqual(self.sm.getReferencedMappingIds(), set([
+            self.sm.default_mapping_id, file_id, folder_id, named_id,
+            client_id]))
+        self.assertEqual(self.sm.purgeUnusedMappings(), [unused_id])
+        self.assertRaises(KeyError, self.sm.getMapping, unused_id)
+        self.assertEqual(self.sm.getMappingMethods(unused_id, None), None)
+        self.assertEqual(self.sm.getCompiledMapping(unused_id), None)
+        # the greatest id is kept.
+        self.assertEqual(self.sm.getMapping(last_id), self.folder_mapping)
+
+        # replaced mappings are kept for the grace period.
+        scope_id = self.sm.getAccessScopeId('akey1')
+        self.sm.delAccessScope('akey1')
+        self.sm.setMappingNameToId('file', last_id)
+        now = int(time())
+        self.assertEqual(self.sm.purgeUnusedMappings(now), [file_id])
+        self.assertEqual(self.sm.getScopeSet(scope_id), None)
+        self.assertEqual(self.sm.purgeUnusedMappings(
+            now + self.sm.mapping_purge_grace + 1), [named_id])
+        self.assertEqual(self.sm.getAccessScope('akey2'), set([folder_id]))
+
+    def test_0401_purge_unused_mappings_unindexed(self):
+        self.sm._mapping_access_keys = None
+        self.assertRaises(ValueError, self.sm.purgeUnusedMappings)
+
     def test_1000_request_scope_fresh_fail(self):
         self.assertFalse(self.sm.requestScope('key', 'rawscope'))
         self.assertEqual(len(self.sm._scope), 0)
@@ -199,6 +380,20 @@ class CTSMEditingTestCase(unittest.TestCase):
         self.assertEqual(self.sm.getEditProfile('file'), None)
         self.assertEqual(self.sm.getMappingByName('file', default=None), None)
 
+    def test_0003_commit_unchanged(self):
+        self.sm.setEditProfile('file', self.file_profile)
+        mapping_id = self.sm.commitEditProfile('file')
+        self.assertEqual(self.sm.getMappingId('file'), mapping_id)
+        count = len(self.sm._mappings)
+        self.assertEqual(self.sm.commitEditProfile('file'), mapping_id)
+        self.assertEqual(len(self.sm._mappings), count)
+
+        self.file_profile.methods = 'GET POST'
+        new_id = self.sm.commitEditProfile('file')
+        self.assertNotEqual(new_id, mapping_id)
+        self.assertEqual(self.sm.getMappingId('file'), new_id)
+        self.assertEqual(len(self.sm._mappings), count + 1)
+
 
 class CTSMPloneIntegrationTestCase(ptc.PloneTestCase):
     """
@@ -209,6 +404,7 @@ class CTSMPloneIntegrationTestCase(ptc.PloneTestCase):
     def afterSetUp(self):
         self.sm = ContentTypeScopeManager()
         self.mapping = {}
+        scope._targets.clear()
 
     def assertScopeValid(self, accessed, name):
         self.assertTrue(self.sm.validateTargetWithMapping(
@@ -234,6 +430,45 @@ class CTSMPloneIntegrationTestCase(ptc.PloneTestCase):
         self.assertEqual(obj, None)
         self.assertEqual(path, None)
 
+    def test_0003_resolve_cached(self):
+        transaction.savepoint(optimistic=True)
+        self.assertEqual(self.sm.resolveTarget(self.folder, 'view'),
+            ('Folder', 'view'))
+        key = (self.folder.getPhysicalPath(), 'view')
+        identities, result = scope._targets.get(key)
+        self.assertEqual(result, ('Folder', 'view'))
+        scope._targets.set(key, (identities, ('Document', 'view')))
+        self.assertEqual(self.sm.resolveTarget(self.folder, 'view'),
+            ('Document', 'view'))
+
+        # discarded once the object is no longer the same, such as when
+        # another process committed a change to it.
+        scope._targets.set(key, (((identities[0][0], 'other'),),
+            ('Document', 'view')))
+        self.assertEqual(self.sm.resolveTarget(self.folder, 'view'),
+            ('Folder', 'view'))
+
+        # uncommitted changes are not trusted.
+        scope._targets.set(key, (identities, ('Document', 'view')))
+        self.folder._p_changed = True
+        self.assertEqual(self.sm.resolveTarget(self.folder, 'view'),
+            ('Folder', 'view'))
+
+    def test_0004_resolve_cache_replaced(self):
+        self.folder.invokeFactory('Folder', 'sub')
+        self.folder.sub.invokeFactory('Document', 'doc')
+        transaction.savepoint(optimistic=True)
+        self.assertEqual(self.sm.resolveTarget(self.folder.sub.doc, 'view'),
+            ('Document', 'view'))
+        self.assertEqual(len(scope._targets), 1)
+
+        # another object of another type at the same path.
+        self.folder.sub.manage_delObjects(['doc'])
+        self.folder.sub.invokeFactory('Folder', 'doc')
+        transaction.savepoint(optimistic=True)
+        self.assertEqual(self.sm.resolveTarget(self.folder.sub.doc, 'view'),
+            ('Folder', 'view'))
+
     def test_0100_root_scope(self):
         self.mapping = {
             'Plone Site': ['folder_contents'],
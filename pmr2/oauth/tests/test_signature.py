@@ -0,0 +1,136 @@
+import unittest
+
+from oauthlib.common import Request
+from oauthlib.oauth1.rfc5849 import SIGNATURE_RSA
+from oauthlib.oauth1.rfc5849 import signature as oauth_signature
+
+from pmr2.oauth import signature
+from pmr2.oauth.signature import getHMAC
+from pmr2.oauth.signature import invalidateHMAC
+from pmr2.oauth.signature import getRSAVerifier
+from pmr2.oauth.signature import verify_hmac_sha1
+from pmr2.oauth.signature import verify_rsa_sha1
+
+
+def generateRSAKey(bits=1024):
+    from Crypto.PublicKey import RSA
+    key = RSA.generate(bits)
+    return key.exportKey(), key.publickey().exportKey()
+
+
+class RSASignatureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.private_key, self.public_key = generateRSAKey()
+        signature._rsa_keys.clear()
+
+    def sign(self, private_key, uri=u'http://example.com/resource'):
+        request = Request(uri, u'GET')
+        request.params = [
+            (u'oauth_consumer_key', u'client'),
+            (u'oauth_nonce', u'1234567890'),
+            (u'oauth_signature_method', SIGNATURE_RSA),
+            (u'oauth_timestamp', u'1234567890'),
+        ]
+        base_string = oauth_signature.construct_base_string(u'GET',
+            oauth_signature.normalize_base_string_uri(uri),
+            oauth_signature.normalize_parameters(request.params))
+        request.signature = oauth_signature.sign_rsa_sha1(base_string,
+            private_key)
+        return request
+
+    def test_000_verify(self):
+        request = self.sign(self.private_key)
+        verifier = getRSAVerifier(u'client', self.public_key)
+        self.assertTrue(verify_rsa_sha1(request, verifier))
+
+        request.uri = u'http://example.com/other'
+        self.assertFalse(verify_rsa_sha1(request, verifier))
+
+    def test_001_verify_wrong_key(self):
+        private_key, public_key = generateRSAKey()
+        request = self.sign(private_key)
+        verifier = getRSAVerifier(u'client', self.public_key)
+        self.assertFalse(verify_rsa_sha1(request, verifier))
+
+    def test_002_verify_missing(self):
+        request = self.sign(self.private_key)
+        self.assertEqual(getRSAVerifier(u'client', None), None)
+        self.assertFalse(verify_rsa_sha1(request, None))
+        self.assertEqual(getRSAVerifier(u'client', u'not a key'), None)
+
+    def test_010_verifier_cached(self):
+        verifier = getRSAVerifier(u'client', self.public_key)
+        self.assertTrue(getRSAVerifier(u'client', self.public_key)
+            is verifier)
+        self.assertFalse(getRSAVerifier(u'client2', self.public_key)
+            is verifier)
+        # a replaced key will be parsed.
+        private_key, public_key = generateRSAKey()
+        self.assertFalse(getRSAVerifier(u'client', public_key) is verifier)
+
+
+class HMACSignatureTestCase(unittest.TestCase):
+
+    def setUp(self):
+        signature._hmac_keys.clear()
+
+    def sign(self, client_secret, token_secret,
+            uri=u'http://example.com/resource'):
+        request = Request(uri, u'GET')
+        request.params = [
+            (u'oauth_consumer_key', u'client'),
+            (u'oauth_nonce', u'1234567890'),
+            (u'oauth_signature_method', u'HMAC-SHA1'),
+            (u'oauth_timestamp', u'1234567890'),
+            (u'oauth_token', u'token'),
+        ]
+        base_string = oauth_signature.construct_base_string(u'GET',
+            oauth_signature.normalize_base_string_uri(uri),
+            oauth_signature.normalize_parameters(request.params))
+        request.signature = oauth_signature.sign_hmac_sha1(base_string,
+            client_secret, token_secret)
+        return request
+
+    def test_000_verify(self):
+        request = self.sign(u'client-secret', u'token-secret')
+        for i in range(2):
+            self.assertTrue(verify_hmac_sha1(request, getHMAC(
+                u'client', u'client-secret', u'token', u'token-secret')))
+        self.assertEqual(len(signature._hmac_keys), 1)
+        self.assertFalse(verify_hmac_sha1(request, getHMAC(
+            u'client', u'client-secret', u'token', u'other-secret')))
+        self.assertFalse(verify_hmac_sha1(request, getHMAC(
+            u'client', u'client-secret')))
+
+        request = self.sign(u'client-secret', None)
+        self.assertTrue(verify_hmac_sha1(request, getHMAC(
+            u'client', u'client-secret')))
+
+    def test_001_changed_secret(self):
+        request = self.sign(u'client-secret', u'token-secret')
+        mac = getHMAC(u'client', u'client-secret', u'token', u'token-secret')
+        self.assertTrue(verify_hmac_sha1(request, mac))
+        request = self.sign(u'client-secret', u'token-secret2')
+        mac = getHMAC(u'client', u'client-secret', u'token', u'token-secret2')
+        self.assertTrue(verify_hmac_sha1(request, mac))
+
+    def test_010_invalidate(self):
+        getHMAC(u'client', u'client-secret', u'token', u'token-secret')
+        getHMAC(u'client', u'client-secret', u'token2', u'token-secret')
+        getHMAC(u'other', u'other-secret', u'token3', u'token-secret')
+        invalidateHMAC(u'client', u'token')
+        self.assertEqual(len(signature._hmac_keys), 2)
+        # only the entries of the client.
+        invalidateHMAC(u'client')
+        self.assertEqual(signature._hmac_keys.keys(),
+            [(u'other', u'token3')])
+
+
+def test_suite():
+    from unittest import TestSuite, makeSuite
+    suite = TestSuite()
+    suite.addTest(makeSuite(HMACSignatureTestCase))
+    if signature.rsa_available:
+        suite.addTest(makeSuite(RSASignatureTestCase))
+    return suite
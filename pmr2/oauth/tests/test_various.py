@@ -7,6 +7,9 @@ from pmr2.oauth.consumer import ConsumerManager
 from pmr2.oauth.consumer import Consumer
 
 from pmr2.oauth.token import TokenManager
+from pmr2.oauth.token import ShardedTokenManager
+from pmr2.oauth.token import CompactTokenManager
+from pmr2.oauth.token import TokenRecord
 from pmr2.oauth.token import Token
 
 from pmr2.oauth.interfaces import *
@@ -71,6 +74,61 @@ class TestConsumer(unittest.TestCase):
         m.remove(c2)
         self.assertEqual(len(m._consumers), 0)
 
+    def test_110_consumer_manager_cache(self):
+        m = ConsumerManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        # missing consumers are cached also.
+        self.assertEqual(m.get('consumer-key'), None)
+        m.add(consumer)
+        self.assertEqual(m.get('consumer-key'), consumer)
+        # served from the cache.
+        m._consumers = {}
+        self.assertEqual(m.get('consumer-key'), consumer)
+        self.assertEqual(m.get('consumer-key2'), None)
+        # invalidated on removal.
+        m._consumers['consumer-key'] = consumer
+        m.remove(consumer)
+        self.assertEqual(m.get('consumer-key'), None)
+
+    def test_111_consumer_manager_cache_legacy(self):
+        m = ConsumerManager()
+        del m._generation
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        self.assertEqual(m.get('consumer-key'), None)
+        m.add(consumer)
+        self.assertEqual(m.get('consumer-key'), consumer)
+
+    def test_112_consumer_manager_remove_hmac(self):
+        from pmr2.oauth import signature
+        m = ConsumerManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        m.add(consumer)
+        signature.getHMAC(u'consumer-key', u'consumer-secret')
+        m.remove(consumer)
+        self.assertEqual(
+            signature._hmac_keys.get(('consumer-key', None)), None)
+
+    def test_113_consumer_manager_cache_missing(self):
+        m = ConsumerManager()
+        m.consumer_cache_size = 1
+        m.missing_cache_size = 2
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        m.add(consumer)
+        self.assertEqual(m.get('consumer-key'), consumer)
+        # Unknown keys are kept apart, so they cannot evict consumers.
+        m._consumers = {}
+        for i in range(10):
+            self.assertEqual(m.get('consumer-key%d' % i), None)
+        self.assertEqual(m.get('consumer-key'), consumer)
+        self.assertEqual(len(m._getMissingConsumerCache()), 2)
+
+    def test_120_consumer_manager_dummy(self):
+        m = ConsumerManager()
+        dummy = m.makeDummy()
+        self.assertEqual(dummy.key, m.DUMMY_KEY)
+        self.assertEqual(dummy.secret, m.DUMMY_SECRET)
+        self.assertTrue(m.makeDummy() is dummy)
+
 
 class TestToken(unittest.TestCase):
 
@@ -145,6 +203,18 @@ class TestToken(unittest.TestCase):
         m.remove(t2)
         self.assertEqual(len(m._tokens), 1)
 
+    def test_104_token_manager_remove_hmac(self):
+        from pmr2.oauth import signature
+        m = TokenManager()
+        token = Token('token-key', 'token-secret')
+        token.consumer_key = 'consumer-key'
+        m.add(token)
+        signature.getHMAC(u'consumer-key', u'consumer-secret',
+            u'token-key', u'token-secret')
+        m.remove(token)
+        self.assertEqual(
+            signature._hmac_keys.get(('consumer-key', 'token-key')), None)
+
     def test_112_token_manager_addget_user(self):
         m = TokenManager()
         token = Token('token-key', 'token-secret')
@@ -206,6 +276,40 @@ class TestToken(unittest.TestCase):
         # User must know about the token for the getter to work.
         self.assertEqual(m.getTokensForUser('t2user'), [])
 
+    def test_116_token_manager_user_order(self):
+        m = TokenManager()
+        tokens = []
+        for key in ('token-c', 'token-a', 'token-b'):
+            token = Token(key, 'token-secret')
+            token.user = 'user'
+            token.access = True
+            m.add(token)
+            tokens.append(token)
+        # Same order as they were added.
+        self.assertEqual(m.getTokensForUser('user'), tokens)
+        m.remove('token-a')
+        self.assertEqual(m.getTokensForUser('user'), [tokens[0], tokens[2]])
+
+    def test_117_token_manager_user_legacy_list(self):
+        from persistent.list import PersistentList
+        m = TokenManager()
+        t1 = Token('token-key', 'token-secret')
+        t1.user = 'user'
+        t1.access = True
+        t2 = Token('token-key2', 'token-secret')
+        t2.user = 'user'
+        t2.access = True
+        m.add(t1)
+        m.add(t2)
+        m._user_token_map['user'] = PersistentList(['token-key2', 'token-key'])
+        self.assertEqual(m.getTokensForUser('user'), [t2, t1])
+        self.assertEqual(m.getAccessToken('token-key'), t1)
+
+        # converted on modification.
+        m.remove(t2)
+        self.assertFalse(isinstance(m._user_token_map['user'], PersistentList))
+        self.assertEqual(m.getTokensForUser('user'), [t1])
+
     def test_120_token_manager_access_token_tm_empty(self):
         m = TokenManager()
         self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
@@ -254,6 +358,148 @@ class TestToken(unittest.TestCase):
         self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
         self.assertRaises(NotRequestTokenError, m.getRequestToken, 'token-key')
 
+    def test_130_token_manager_access_token_cache(self):
+        m = TokenManager()
+        t1 = Token('token-key', 'token-secret')
+        t1.access = True
+        t1.user = 'user'
+        t2 = Token('token-key2', 'token-secret')
+        t2.access = True
+        t2.user = 'user'
+        m.add(t1)
+        m.add(t2)
+        self.assertEqual(m.getAccessToken('token-key'), t1)
+
+        # Validated access tokens are cached, so the underlying storage
+        # is no longer consulted.
+        m._tokens.pop('token-key')
+        self.assertEqual(m.getAccessToken('token-key'), t1)
+        self.assertEqual(m.getAccessToken(t1), t1)
+
+        # Removal of any access token invalidates the cache.
+        m.remove(t2)
+        self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
+        self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key2')
+
+    def test_131_token_manager_access_token_cache_remove(self):
+        m = TokenManager()
+        token = Token('token-key', 'token-secret')
+        token.access = True
+        token.user = 'user'
+        m.add(token)
+        self.assertEqual(m.getAccessToken('token-key'), token)
+        m.remove(token)
+        self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
+        self.assertEqual(m.getAccessToken('token-key', None), None)
+
+        # Managers created without the counter still get invalidated.
+        m = TokenManager()
+        del m._generation
+        m.add(token)
+        self.assertEqual(m.getAccessToken('token-key'), token)
+        m.remove(token)
+        self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
+
+    def test_132_token_manager_missing_token_cache(self):
+        m = TokenManager()
+        m.access_cache_size = 1
+        token = Token('token-key', 'token-secret')
+        token.access = True
+        token.user = 'user'
+        self.assertEqual(m.getAccessToken('token-key', None), None)
+
+        # Unknown keys are cached too, without consulting the storage.
+        m._tokens['token-key'] = m._dumpToken(token)
+        self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
+        m._tokens.pop('token-key')
+
+        # But not once they are added.
+        m.add(token)
+        self.assertEqual(m.getAccessToken('token-key'), token)
+
+        # Unknown keys cannot evict the validated access tokens.
+        m._tokens.pop('token-key')
+        for i in range(10):
+            m.getAccessToken('missing-%d' % i, None)
+        self.assertEqual(m.getAccessToken('token-key'), token)
+
+    def test_140_token_manager_expired_request_token(self):
+        m = TokenManager()
+        token = m.generateRequestToken('consumer-key', 'oob')
+        self.assertEqual(m.getRequestToken(token.key), token)
+        m._unindex_expiry(token)
+        token.expiry = int(time.time()) - 1
+        m._index_expiry(token)
+        self.assertRaises(ExpiredTokenError, m.getRequestToken, token.key)
+        self.assertEqual(m.getRequestToken(token.key, None), None)
+        # Not removed on read, but left for the next purge.
+        self.assertEqual(m.get(token.key), token)
+        self.assertEqual(m.purgeExpired(), [token])
+        self.assertEqual(m.get(token.key), None)
+
+    def test_141_token_manager_expired_access_token(self):
+        m = TokenManager()
+        token = Token('token-key', 'token-secret')
+        token.access = True
+        token.user = 'user'
+        m.add(token)
+        self.assertEqual(m.getAccessToken('token-key'), token)
+        # Cached tokens are checked too.
+        m._unindex_expiry(token)
+        token.expiry = int(time.time()) - 1
+        m._index_expiry(token)
+        self.assertRaises(ExpiredTokenError, m.getAccessToken, 'token-key')
+        self.assertEqual(m.getAccessToken('token-key', None), None)
+        # Found through the persistent index, as the purge is usually
+        # done by another process.
+        self.assertEqual(m.purgeExpired(), [token])
+        self.assertRaises(TokenInvalidError, m.getAccessToken, 'token-key')
+
+    def test_142_token_manager_access_token_timeouts(self):
+        m = TokenManager()
+        m.access_timeout = 3600
+        m.access_idle_timeout = 600
+        token = m.generateRequestToken('consumer-key', 'oob')
+        token.user = 'user'
+        access = m.generateAccessToken('consumer-key', token.key)
+        self.assertEqual(access.expiry, access.timestamp + 3600)
+        self.assertFalse(m.isExpired(access))
+        self.assertTrue(m.isExpired(access, access.timestamp + 3601))
+
+        # idle timeout
+        self.assertTrue(m.isExpired(access, access.timestamp + 601))
+        access.timestamp -= 601
+        self.assertRaises(ExpiredTokenError, m.getAccessToken, access.key)
+
+        # access refreshes the idle time.
+        access.last_access = int(time.time()) - 500
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertTrue(access.last_access >= int(time.time()) - 1)
+
+    def test_143_token_manager_purge_idle_access_token(self):
+        m = TokenManager()
+        m.access_idle_timeout = 600
+        access = Token('token-key', 'token-secret')
+        access.access = True
+        access.user = 'user'
+        access.timestamp = now = int(time.time()) - 30
+        m.add(access)
+        self.assertEqual(m.purgeExpired(now + 599), [])
+
+        # recent accesses are not written.
+        m.getAccessToken(access.key)
+        self.assertEqual(access.last_access, None)
+
+        # later accesses are, and extend the indexed expiry.
+        m._unindex_expiry(access)
+        access.timestamp = now = int(time.time()) - 300
+        m._index_expiry(access)
+        m.getAccessToken(access.key)
+        self.assertTrue(access.last_access >= now + 300)
+        self.assertEqual(m.purgeExpired(now + 601), [])
+        self.assertEqual(m.purgeExpired(access.last_access + 601), [access])
+        self.assertEqual(m.get(access.key), None)
+
     def test_200_token_manager_generate_request_token(self):
         m = TokenManager()
         consumer = Consumer('consumer-key', 'consumer-secret')
@@ -297,6 +543,50 @@ class TestToken(unittest.TestCase):
         self.assertRaises(TokenInvalidError, m.claimRequestToken, token, 'u')
         self.assertEqual(token.user, None)
 
+    def test_260_token_manager_purge_expired(self):
+        m = TokenManager()
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        now = int(time.time())
+        t1 = m.generateRequestToken(consumer.key, 'oob')
+        t2 = m.generateRequestToken(consumer.key, 'oob')
+        t3 = m.generateRequestToken(consumer.key, 'oob')
+        access = Token('token-key', 'token-secret')
+        access.access = True
+        access.user = 'user'
+        m.add(access)
+
+        # nothing expired yet.
+        self.assertEqual(m.purgeExpired(), [])
+        self.assertEqual(m.purgeExpired(t1.expiry), [])
+
+        # claimed tokens are reindexed with the new expiry.
+        t3.expiry = now
+        m.claimRequestToken(t3, 'user')
+        self.assertTrue(t3.key in
+            m._expiry_index[t3.expiry // m.expiry_bucket_size])
+
+        later = now + m.claim_timeout * 2
+        removed = m.purgeExpired(later, limit=2)
+        self.assertEqual(len(removed), 2)
+        removed.extend(m.purgeExpired(later))
+        self.assertEqual(sorted(t.key for t in removed),
+            sorted([t1.key, t2.key, t3.key]))
+        self.assertEqual(m.get(t1.key), None)
+        self.assertEqual(m.get(t3.key), None)
+
+        # Only the dummy and access token remains.
+        self.assertEqual(len(m._tokens), 2)
+        self.assertEqual(len(m._expiry_index), 0)
+        self.assertEqual(m.purgeExpired(later), [])
+
+    def test_261_token_manager_purge_expired_no_index(self):
+        m = TokenManager()
+        del m._expiry_index
+        self.assertEqual(m.purgeExpired(), [])
+        consumer = Consumer('consumer-key', 'consumer-secret')
+        token = m.generateRequestToken(consumer.key, 'oob')
+        self.assertEqual(m.purgeExpired(token.expiry + 1), [token])
+
     def test_300_token_manager_generate_access_token(self):
         m = TokenManager()
         consumer = Consumer('consumer-key', 'consumer-secret')
@@ -354,9 +644,121 @@ class TestToken(unittest.TestCase):
         self.assertEqual(token, None)
 
 
+class TestShardedToken(unittest.TestCase):
+    """\
+    Test the sharded token manager.
+    """
+
+    def test_000_sharded_addget(self):
+        m = ShardedTokenManager()
+        self.assertEqual(len(m._shards), m.shard_count)
+        self.assertEqual(m.get(m.DUMMY_KEY).key, m.DUMMY_KEY)
+        tokens = [m.generateRequestToken('consumer-key', 'oob')
+            for i in range(32)]
+        for token in tokens:
+            self.assertEqual(m.get(token.key), token)
+            self.assertEqual(m.getRequestToken(token.key), token)
+        self.assertEqual(sum(len(t) for t in m._shards), 33)
+        # Tokens are spread over multiple shards.
+        self.assertTrue(len([t for t in m._shards if len(t)]) > 1)
+
+    def test_001_sharded_remove_purge(self):
+        m = ShardedTokenManager()
+        token = m.generateRequestToken('consumer-key', 'oob')
+        m.remove(token)
+        self.assertEqual(m.get(token.key), None)
+        token = m.generateRequestToken('consumer-key', 'oob')
+        self.assertEqual(m.purgeExpired(token.expiry + 1), [token])
+        self.assertEqual(m.get(token.key), None)
+
+    def test_002_sharded_access_token(self):
+        m = ShardedTokenManager()
+        token = m.generateRequestToken('consumer-key', 'oob')
+        m.claimRequestToken(token, 'user')
+        access = m.generateAccessToken('consumer-key', token.key)
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertEqual(m.getTokensForUser('user'), [access])
+        m.remove(access)
+        self.assertRaises(TokenInvalidError, m.getAccessToken, access.key)
+
+    def test_003_sharded_users(self):
+        m = ShardedTokenManager()
+        # The trees of the default manager are not used.
+        self.assertFalse('_tokens' in m.__dict__)
+        self.assertFalse('_user_token_map' in m.__dict__)
+        self.assertEqual(m._expiry_index, None)
+        for i in range(32):
+            token = m.generateRequestToken('consumer-key', 'oob')
+            m.claimRequestToken(token, 'user%d' % i)
+            access = m.generateAccessToken('consumer-key', token.key)
+            self.assertEqual(m.getAccessToken(access.key), access)
+            self.assertEqual(m.getTokensForUser('user%d' % i), [access])
+        self.assertEqual(sum(len(t) for t in m._user_shards), 32)
+        # Users are spread over multiple shards.
+        self.assertTrue(len([t for t in m._user_shards if len(t)]) > 1)
+
+
+class TestCompactToken(unittest.TestCase):
+    """\
+    Test the compact token manager.
+    """
+
+    def test_000_token_record(self):
+        token = TokenRecord('token-key', 'token-secret')
+        self.assertTrue(IToken.providedBy(token))
+        self.assertEqual(token.access, False)
+        self.assertEqual(token.expiry, None)
+        token.set_callback('oob')
+        token.set_verifier('verify')
+        record = TokenRecord.fromTuple(token.toTuple())
+        self.assertEqual(record, token)
+        self.assertEqual(record.verifier, 'verify')
+        # shorter records from previous layouts.
+        record = TokenRecord.fromTuple(('key', 'secret'))
+        self.assertEqual(record.key, 'key')
+        self.assertEqual(record.last_access, None)
+
+    def test_001_compact_addget(self):
+        m = CompactTokenManager()
+        self.assertEqual(m.get(m.DUMMY_KEY).key, m.DUMMY_KEY)
+        token = m.generateRequestToken('consumer-key', 'oob')
+        self.assertTrue(isinstance(m._tokens[token.key], tuple))
+        self.assertEqual(m.getRequestToken(token.key), token)
+
+        m.claimRequestToken(token.key, 'user')
+        self.assertEqual(m.get(token.key).user, 'user')
+        access = m.generateAccessToken('consumer-key', token.key)
+        self.assertEqual(m.getAccessToken(access.key), access)
+        self.assertEqual(m.getTokensForUser('user'), [access])
+
+        self.assertEqual(m.remove(access), access)
+        self.assertRaises(TokenInvalidError, m.getAccessToken, access.key)
+
+    def test_002_compact_touch(self):
+        m = CompactTokenManager()
+        m.access_idle_timeout = 600
+        token = TokenRecord('token-key', 'token-secret')
+        token.access = True
+        token.user = 'user'
+        token.timestamp = int(time.time()) - 500
+        m.add(token)
+        m.getAccessToken(token.key)
+        # The updated access time is saved into the stored record.
+        self.assertTrue(m.get(token.key).last_access >= token.timestamp)
+
+    def test_003_compact_legacy_token(self):
+        m = CompactTokenManager()
+        token = Token('token-key', 'token-secret')
+        m.add(token)
+        self.assertTrue(isinstance(m._tokens[token.key], tuple))
+        self.assertEqual(m.get(token.key).secret, 'token-secret')
+
+
 def test_suite():
     from unittest import TestSuite, makeSuite
     suite = TestSuite()
     suite.addTest(makeSuite(TestConsumer))
     suite.addTest(makeSuite(TestToken))
+    suite.addTest(makeSuite(TestShardedToken))
+    suite.addTest(makeSuite(TestCompactToken))
     return suite
@@ -1,9 +1,12 @@
 import time
 import urlparse
+import zlib
 
 from persistent import Persistent
 from persistent.list import PersistentList
-from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOBTree, OOTreeSet
+from BTrees.IOBTree import IOBTree
+from BTrees.Length import Length
 
 from zope.container.contained import Contained
 from zope.annotation.interfaces import IAttributeAnnotatable
@@ -16,17 +19,28 @@ from pmr2.oauth.interfaces import ITokenManager
 from pmr2.oauth.interfaces import CallbackValueError
 from pmr2.oauth.interfaces import TokenInvalidError, ExpiredTokenError
 from pmr2.oauth.interfaces import NotAccessTokenError, NotRequestTokenError
+from pmr2.oauth.cache import VolatileCacheMixin
+from pmr2.oauth.ephemeral import EphemeralStorageMixin
 from pmr2.oauth.factory import factory
+from pmr2.oauth.signature import invalidateHMAC
 from pmr2.oauth.utility import random_string
 
 
-class TokenManager(Persistent, Contained):
+_marker = object()
+_missing = object()
+
+
+class TokenManager(Persistent, Contained, EphemeralStorageMixin,
+        VolatileCacheMixin):
     """\
     A basic token manager for the default layer.
 
     This manager provides the bare minimum functionality, currently it
     does not easily provide a way for users to check what tokens they
     have approved.
+
+    If an ephemeral store is registered, request tokens are kept there
+    instead of the ZODB.
     """
 
     zope.component.adapts(IAttributeAnnotatable, zope.interface.Interface)
@@ -37,54 +51,279 @@ class TokenManager(Persistent, Contained):
 
     # expiry
     claim_timeout = 180
-    
+
+    # Optional lifetime of access tokens, and the time they may stay
+    # unused, both in seconds.
+    access_timeout = None
+    access_idle_timeout = None
+
+    # Fraction of the idle timeout that must pass before the last
+    # access time of a token is updated, to limit the writes.
+    access_idle_resolution = 0.1
+
+    # Size (in seconds) of the time buckets of the expiry index.
+    expiry_bucket_size = 60
+
+    # Index of expiry bucket to the keys of the tokens expiring within
+    # that bucket.  Created on first use for managers created before
+    # this was introduced.
+    _expiry_index = None
+
+    # Size and lifetime (in seconds) of the cache of the validated access
+    # tokens kept for each ZODB connection.
+    access_cache_size = 1000
+    access_cache_ttl = 300
+
+    # Size and lifetime (in seconds) of the cache of the keys that are
+    # not access tokens, kept apart from the above such that unknown
+    # keys cannot evict the validated access tokens.
+    missing_cache_size = 1000
+    missing_cache_ttl = 60
+
     def __init__(self):
-        self._tokens = OOBTree()
-        self._user_token_map = OOBTree()
+        self._initTrees()
+        self._generation = Length()
+        self._initEphemeralPrefix()
         dummy = self._makeDummy()
         self.add(dummy)
 
+    def _initTrees(self):
+        """\
+        Create the trees that store the tokens and their indexes.
+        """
+
+        self._tokens = OOBTree()
+        self._user_token_map = OOBTree()
+        self._expiry_index = IOBTree()
+
+    def _createToken(self, key, secret):
+        return Token(key, secret)
+
     def _makeDummy(self):
-        dummy = Token(self.DUMMY_KEY, self.DUMMY_SECRET)
+        dummy = self._createToken(self.DUMMY_KEY, self.DUMMY_SECRET)
+        return dummy
+
+    def makeDummy(self):
+        """\
+        Return the dummy token, for use in place of missing tokens.
+
+        This is never stored, and is only built once.
+        """
+
+        dummy = getattr(self, '_v_dummy_token', None)
+        if dummy is None:
+            dummy = self._v_dummy_token = self._makeDummy()
         return dummy
 
+    def _getTokenTree(self, key):
+        """\
+        Return the tree that stores the token identified by key.
+        """
+
+        return self._tokens
+
+    def _iterTokenTrees(self):
+        """\
+        Return all the trees that store the tokens.
+        """
+
+        return (self._tokens,)
+
+    def _loadToken(self, value):
+        """\
+        Return the token from a value stored in the token trees.
+        """
+
+        return value
+
+    def _dumpToken(self, token):
+        """\
+        Return the value to be stored in the token trees for token.
+        """
+
+        return token
+
+    def _saveToken(self, token):
+        """\
+        Save the modifications made to a token already stored.
+        """
+
+        # Persistent tokens track their own modifications.
+        pass
+
+    def _getUserTokenMap(self, user):
+        """\
+        Return the tree that maps user to the keys of their tokens.
+        """
+
+        return self._user_token_map
+
+    def _get_user_map(self, user):
+        # Each user has their token keys mapped to the time they were
+        # added, for ordering.  Convert the lists used by the previous
+        # versions as this is done before the map is modified.
+        user_token_map = self._getUserTokenMap(user)
+        user_tokens = user_token_map.get(user, None)
+        if isinstance(user_tokens, PersistentList):
+            user_tokens = user_token_map[user] = \
+                userTokensFromList(user_tokens)
+        return user_tokens
+
     def _add_user_map(self, token):
         if not token.access or token.user is None:
             return
 
         # only tracking access tokens with user defined.
-        user_tokens = self._user_token_map.get(token.user, None)
+        user_tokens = self._get_user_map(token.user)
         if user_tokens is None:
-            user_tokens = PersistentList()
-            self._user_token_map[token.user] = user_tokens
+            user_tokens = OOBTree()
+            self._getUserTokenMap(token.user)[token.user] = user_tokens
 
-        user_tokens.append(token.key)
+        user_tokens[token.key] = time.time()
 
     def _del_user_map(self, token):
         if token.user is None:
             return
 
         # only tracking access tokens with user defined.
-        user_tokens = self._user_token_map.get(token.user, None)
+        user_tokens = self._get_user_map(token.user)
         if user_tokens is None:
             # guess this user didn't have any tokens tracked before.
             return
 
         if token.key in user_tokens:
             # Well this key may not have been mapped.
-            user_tokens.remove(token.key)
+            del user_tokens[token.key]
+            # Only the tokens tracked here could have been cached.
+            self._invalidateCache()
+
+    def _getExpiryIndex(self, key):
+        """\
+        Return the expiry index for the token identified by key.
+        """
+
+        if self._expiry_index is None:
+            self._expiry_index = IOBTree()
+        return self._expiry_index
+
+    def _iterExpiryIndexes(self):
+        """\
+        Return all the expiry indexes.
+        """
+
+        if self._expiry_index is None:
+            return ()
+        return (self._expiry_index,)
+
+    def _getExpiry(self, token):
+        """\
+        Return the time the token expires at, which for access tokens
+        includes the idle timeout, or None if it never expires.
+        """
+
+        expiry = token.expiry
+        if token.access and self.access_idle_timeout:
+            last_access = token.last_access or token.timestamp
+            if last_access is not None:
+                idle_expiry = last_access + self.access_idle_timeout
+                if expiry is None or idle_expiry < expiry:
+                    expiry = idle_expiry
+        return expiry
+
+    def _index_expiry(self, token):
+        expiry = self._getExpiry(token)
+        if expiry is None:
+            return
+
+        index = self._getExpiryIndex(token.key)
+        bucket = expiry // self.expiry_bucket_size
+        keys = index.get(bucket, None)
+        if keys is None:
+            keys = OOTreeSet()
+            index[bucket] = keys
+        keys.insert(token.key)
+
+    def _unindex_expiry(self, token):
+        expiry = self._getExpiry(token)
+        if expiry is None:
+            return
+
+        # Empty buckets are left for purgeExpired to remove, to avoid
+        # conflicts with concurrent additions to the same bucket.
+        bucket = expiry // self.expiry_bucket_size
+        keys = self._getExpiryIndex(token.key).get(bucket, None)
+        if keys is not None and token.key in keys:
+            keys.remove(token.key)
+
+    def isExpired(self, token, timestamp=None):
+        """\
+        Check whether the token has expired at timestamp (default is
+        now).
+        """
+
+        if timestamp is None:
+            timestamp = int(time.time())
+        expiry = self._getExpiry(token)
+        return expiry is not None and expiry < timestamp
+
+    def _touch(self, token, timestamp):
+        if not self.access_idle_timeout:
+            return
+        last_access = token.last_access or token.timestamp or 0
+        if (timestamp - last_access >
+                self.access_idle_timeout * self.access_idle_resolution):
+            # Reindexed under the extended idle expiry, such that the
+            # tokens left idle are found by purgeExpired.
+            self._unindex_expiry(token)
+            token.last_access = timestamp
+            self._index_expiry(token)
+            self._saveToken(token)
+
+    def _getAccessTokenCache(self):
+        return self._getCache('_v_access_token_cache',
+            self.access_cache_size, self.access_cache_ttl)
+
+    def _getMissingTokenCache(self):
+        return self._getCache('_v_missing_token_cache',
+            self.missing_cache_size, self.missing_cache_ttl)
+
+    def _storeEphemeral(self, token):
+        """\
+        Store the request token in the ephemeral store, if available.
+
+        Returns True if the token was stored.
+        """
+
+        if token.access or token.key == self.DUMMY_KEY:
+            return False
+        store = self._getEphemeralStore()
+        if store is None:
+            return False
+        ttl = self.claim_timeout
+        if token.expiry is not None:
+            ttl = max(token.expiry - int(time.time()), 0)
+        store.set(self._getEphemeralKey(token.key), token, ttl)
+        return True
 
     def add(self, token):
         assert IToken.providedBy(token)
         if self.get(token.key):
             raise ValueError('token %s already exists', token.key)
-        self._tokens[token.key] = token
+        # Do not let an earlier lookup of this key shadow the new token.
+        # Only the cache of this connection is reachable from here, but
+        # the other connections can only have looked up a key that is
+        # yet to be generated by chance.
+        self._getMissingTokenCache().pop(token.key)
+        if self._storeEphemeral(token):
+            return
+        self._getTokenTree(token.key)[token.key] = self._dumpToken(token)
         self._add_user_map(token)
+        self._index_expiry(token)
 
     def _generateBaseToken(self, consumer_key):
         key = random_string(24)
         secret = random_string(24)
-        token = Token(key, secret)
+        token = self._createToken(key, secret)
         token.consumer_key = consumer_key
         token.timestamp = int(time.time())
         return token
@@ -116,8 +355,13 @@ class TokenManager(Persistent, Contained):
             raise TokenInvalidError('invalid token')
         old_key = old_token.key
 
+        if self.isExpired(old_token):
+            raise ExpiredTokenError('request token expired.')
+
         token = self._generateBaseToken(consumer_key)
         token.access = True
+        if self.access_timeout:
+            token.expiry = token.timestamp + self.access_timeout
 
         # Must have a user.
         if not old_token.user:
@@ -135,11 +379,27 @@ class TokenManager(Persistent, Contained):
         if token.access:
             raise TokenInvalidError('not request token')
         token.user = user
+        if token.key not in self._getTokenTree(token.key):
+            # Store the modified token back into the ephemeral store.
+            token.expiry = int(time.time()) + self.claim_timeout
+            self._storeEphemeral(token)
+            return
+        self._unindex_expiry(token)
         token.expiry = int(time.time()) + self.claim_timeout
+        self._index_expiry(token)
+        self._saveToken(token)
 
     def get(self, token, default=None):
         token_key = IToken.providedBy(token) and token.key or token
-        return self._tokens.get(token_key, default)
+        result = self._getTokenTree(token_key).get(token_key, _marker)
+        if result is not _marker:
+            return self._loadToken(result)
+        store = self._getEphemeralStore()
+        if store is not None:
+            result = store.get(self._getEphemeralKey(token_key), _marker)
+        if result is _marker:
+            return default
+        return result
 
     def getRequestToken(self, token, default=False):
         token = self.get(token, default)
@@ -153,42 +413,125 @@ class TokenManager(Persistent, Contained):
                 raise NotRequestTokenError('not a request token.')
             return default
 
-        return token
-
-    def getAccessToken(self, token, default=False):
-        token = self.get(token, default)
-        if token is default:
+        if self.isExpired(token):
+            # Expired tokens are not removed while reading, but are left
+            # for purgeExpired.
             if default is False:
-                raise TokenInvalidError('no such access token.')
+                raise ExpiredTokenError('request token expired.')
             return default
 
-        if not token.access:
+        return token
+
+    def getAccessToken(self, token, default=False):
+        token_key = IToken.providedBy(token) and token.key or token
+        cache = self._getAccessTokenCache()
+        missing = self._getMissingTokenCache()
+        token = cache.get(token_key)
+
+        if token is None:
+            # Unknown keys are cached also, so that they are not any
+            # slower to reject than the valid ones are to accept.
+            token = missing.get(token_key)
+            if token is None:
+                token = self.get(token_key, _missing)
+                if token is _missing:
+                    missing.set(token_key, _missing)
+            if token is _missing:
+                if default is False:
+                    raise TokenInvalidError('no such access token.')
+                return default
+
+            if not token.access:
+                if default is False:
+                    raise NotAccessTokenError('not an access token.')
+                return default
+
+            # must be identified
+            if not token.user:
+                raise TokenInvalidError('token has no user')
+            raw_keys = self._getUserTokenMap(token.user).get(token.user, [])
+            if token.key not in raw_keys:
+                raise TokenInvalidError('user `%s` does not own this key' 
+                    % token.user)
+
+            cache.set(token.key, token)
+
+        now = int(time.time())
+        if self.isExpired(token, now):
+            cache.pop(token.key)
             if default is False:
-                raise NotAccessTokenError('not an access token.')
+                raise ExpiredTokenError('access token expired.')
             return default
 
-        # must be identified
-        if not token.user:
-            raise TokenInvalidError('token has no user')
-        raw_keys = self._user_token_map.get(token.user, [])
-        if token.key not in raw_keys:
-            raise TokenInvalidError('user `%s` does not own this key' 
-                % token.user)
-
+        self._touch(token, now)
         return token
 
     def getTokensForUser(self, user):
-        raw_keys = self._user_token_map.get(user, [])
+        raw_keys = self._getUserTokenMap(user).get(user, None)
+        if raw_keys is None:
+            return []
+        if not isinstance(raw_keys, PersistentList):
+            # In the order they were added.
+            raw_keys = [k for v, k in sorted(
+                (v, k) for k, v in raw_keys.items())]
         result = [self.get(t) for t in raw_keys]
         return result
 
     def remove(self, token):
         if IToken.providedBy(token):
             token = token.key
-        token = self._tokens.pop(token)
+        tree = self._getTokenTree(token)
+        if token not in tree:
+            store = self._getEphemeralStore()
+            if store is not None:
+                result = store.pop(self._getEphemeralKey(token), None)
+                if result is not None:
+                    invalidateHMAC(result.consumer_key, result.key)
+                    return result
+        token = self._loadToken(tree.pop(token))
         self._del_user_map(token)
+        self._unindex_expiry(token)
+        invalidateHMAC(token.consumer_key, token.key)
         return token
 
+    def purgeExpired(self, timestamp=None, limit=None):
+        """\
+        Remove the tokens that have expired before timestamp (default is
+        now), up to limit number of tokens if specified.
+
+        Returns the list of removed tokens.
+        """
+
+        if timestamp is None:
+            timestamp = int(time.time())
+        result = []
+
+        last = timestamp // self.expiry_bucket_size
+        for index in self._iterExpiryIndexes():
+            for bucket in list(index.keys(max=last)):
+                keys = index[bucket]
+                for key in list(keys):
+                    if limit is not None and len(result) >= limit:
+                        return result
+                    token = self.get(key, None)
+                    expiry = None
+                    if token is not None:
+                        expiry = self._getExpiry(token)
+                    if (expiry is None or
+                            expiry // self.expiry_bucket_size != bucket):
+                        # stale entry, ensure the token is indexed
+                        # correctly.
+                        keys.remove(key)
+                        if token is not None:
+                            self._index_expiry(token)
+                        continue
+                    if self.isExpired(token, timestamp):
+                        result.append(self.remove(token))
+                if not keys:
+                    del index[bucket]
+
+        return result
+
     def requestTokenVerify(self, consumer_key, token, verifier):
         """\
         Verify that the request results in a valid token by checking for
@@ -204,25 +547,123 @@ class TokenManager(Persistent, Contained):
 TokenManagerFactory = factory(TokenManager)
 
 
-class Token(Persistent):
+class ShardedTokenManager(TokenManager):
+    """\
+    A token manager that spreads the tokens over a number of independent
+    trees, selected by a prefix of the token key.
+
+    With a single tree every token issued or removed may modify the same
+    buckets, so concurrent issuance from many ZEO clients frequently
+    results in conflict errors.  As token keys are random, the writes
+    using this manager are distributed evenly across the shards, along
+    with the entries of the expiry index.  The mapping of users to their
+    tokens is sharded by the user id.
+
+    This manager is not registered by default, and it is stored under a
+    different annotation key from the default manager, so the tokens
+    issued by the default manager will not be available through it.
+    """
 
-    zope.interface.implements(IToken)
+    zope.interface.implements(ITokenManager)
 
-    key = fieldproperty.FieldProperty(IToken['key'])
-    secret = fieldproperty.FieldProperty(IToken['secret'])
-    callback = fieldproperty.FieldProperty(IToken['callback'])
-    verifier = fieldproperty.FieldProperty(IToken['verifier'])
-    access = fieldproperty.FieldProperty(IToken['access'])
+    shard_count = 16
+    shard_prefix_length = 4
 
-    user = fieldproperty.FieldProperty(IToken['user'])
-    consumer_key = fieldproperty.FieldProperty(IToken['consumer_key'])
-    timestamp = fieldproperty.FieldProperty(IToken['timestamp'])
-    expiry = fieldproperty.FieldProperty(IToken['expiry'])
+    def _initTrees(self):
+        # Each shard also has its own expiry index, as every token
+        # issued within the same minute would otherwise be added to the
+        # same set.  The users are spread over their own shards.
+        self._shards = tuple(OOBTree() for i in range(self.shard_count))
+        self._expiry_shards = tuple(
+            IOBTree() for i in range(self.shard_count))
+        self._user_shards = tuple(
+            OOBTree() for i in range(self.shard_count))
+
+    def _getShardIndex(self, value, shards):
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        return (zlib.crc32(value) & 0xffffffff) % len(shards)
+
+    def _getShard(self, key, shards):
+        return shards[self._getShardIndex(
+            key[:self.shard_prefix_length], shards)]
+
+    def _getTokenTree(self, key):
+        return self._getShard(key, self._shards)
+
+    def _iterTokenTrees(self):
+        return self._shards
+
+    def _getExpiryIndex(self, key):
+        return self._getShard(key, self._expiry_shards)
+
+    def _iterExpiryIndexes(self):
+        return self._expiry_shards
+
+    def _getUserTokenMap(self, user):
+        # User ids may share a common prefix, so all of it is used.
+        return self._user_shards[self._getShardIndex(user, self._user_shards)]
+
+ShardedTokenManagerFactory = factory(ShardedTokenManager)
+
+
+class CompactTokenManager(TokenManager):
+    """\
+    A token manager that stores the tokens as tuples in its tree rather
+    than as individual persistent objects, which reduces the size of the
+    storage and the number of objects in the ZODB cache.
+
+    Tokens are returned as TokenRecord instances, so modifications made
+    to them outside of this manager are not saved.
+
+    This manager is stored under the same annotation key as the default
+    manager, so the default manager of a site can be converted in place
+    by pmr2.oauth.maintenance.compactTokenManager.
+    """
+
+    zope.interface.implements(ITokenManager)
+
+    def _createToken(self, key, secret):
+        return TokenRecord(key, secret)
+
+    def _loadToken(self, value):
+        if isinstance(value, tuple):
+            return TokenRecord.fromTuple(value)
+        return value
+
+    def _dumpToken(self, token):
+        if isinstance(token, TokenRecord):
+            return token.toTuple()
+        return tuple(getattr(token, name, None)
+            for name in TOKEN_RECORD_FIELDS)
+
+    def _saveToken(self, token):
+        tree = self._getTokenTree(token.key)
+        if token.key in tree:
+            tree[token.key] = self._dumpToken(token)
+
+CompactTokenManagerFactory = factory(CompactTokenManager,
+    TokenManager.__module__ + '.' + TokenManager.__name__)
+
+
+def userTokensFromList(keys):
+    """
+    Convert a list of token keys for a user into the mapping used by the
+    token manager, retaining the order.
+    """
+
+    result = OOBTree()
+    for i, key in enumerate(keys):
+        result[key] = float(i)
+    return result
 
-    def __init__(self, key, secret):
-        assert not ((key is None) or (secret is None))
-        self.key = key
-        self.secret = secret
+
+class BaseToken(object):
+    """\
+    The methods shared by the token implementations.
+    """
+
+    __slots__ = ()
 
     def set_callback(self, callback):
         """
@@ -270,3 +711,80 @@ class Token(Persistent):
             return urlparse.urlunparse((scheme, netloc, path, params,
                 query, fragment))
         return self.callback
+
+
+class Token(Persistent, BaseToken):
+
+    zope.interface.implements(IToken)
+
+    key = fieldproperty.FieldProperty(IToken['key'])
+    secret = fieldproperty.FieldProperty(IToken['secret'])
+    callback = fieldproperty.FieldProperty(IToken['callback'])
+    verifier = fieldproperty.FieldProperty(IToken['verifier'])
+    access = fieldproperty.FieldProperty(IToken['access'])
+
+    user = fieldproperty.FieldProperty(IToken['user'])
+    consumer_key = fieldproperty.FieldProperty(IToken['consumer_key'])
+    timestamp = fieldproperty.FieldProperty(IToken['timestamp'])
+    expiry = fieldproperty.FieldProperty(IToken['expiry'])
+    last_access = fieldproperty.FieldProperty(IToken['last_access'])
+
+    def __init__(self, key, secret):
+        assert not ((key is None) or (secret is None))
+        self.key = key
+        self.secret = secret
+
+
+# The order of the token fields stored in the records.
+TOKEN_RECORD_FIELDS = ('key', 'secret', 'callback', 'verifier', 'access',
+    'user', 'consumer_key', 'timestamp', 'expiry', 'last_access',)
+
+
+class TokenRecord(BaseToken):
+    """\
+    A lightweight token that is not persistent on its own, built from
+    and converted into the tuples stored by CompactTokenManager.
+
+    Unlike Token, the values assigned are not validated.
+    """
+
+    zope.interface.implements(IToken)
+
+    __slots__ = TOKEN_RECORD_FIELDS
+
+    def __init__(self, key, secret):
+        assert not ((key is None) or (secret is None))
+        for name in TOKEN_RECORD_FIELDS:
+            setattr(self, name, IToken[name].default)
+        self.key = key
+        self.secret = secret
+
+    @classmethod
+    def fromTuple(cls, values):
+        result = cls.__new__(cls)
+        # Records written before any new fields were added are shorter.
+        result.__setstate__(values)
+        return result
+
+    def toTuple(self):
+        return tuple(getattr(self, name) for name in TOKEN_RECORD_FIELDS)
+
+    def __eq__(self, other):
+        if not isinstance(other, TokenRecord):
+            return False
+        return self.toTuple() == other.toTuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __getstate__(self):
+        return self.toTuple()
+
+    def __setstate__(self, state):
+        for name in TOKEN_RECORD_FIELDS:
+            setattr(self, name, None)
+        for name, value in zip(TOKEN_RECORD_FIELDS, state):
+            setattr(self, name, value)
@@ -1,12 +1,19 @@
 import os
+import re
 import base64
 from urllib import quote_plus
 
+import transaction
+
 import oauthlib.oauth1
+from oauthlib.oauth1.rfc5849 import CONTENT_TYPE_FORM_URLENCODED
+from oauthlib.oauth1.rfc5849 import SIGNATURE_METHODS, SIGNATURE_RSA
 from oauthlib.common import urldecode
 
+import zope.component
 import zope.interface
 import zope.schema
+from zope.cachedescriptors.property import Lazy
 from zope.component.hooks import getSite
 
 from Products.CMFCore.utils import getToolByName
@@ -17,10 +24,21 @@ from pmr2.oauth.interfaces import IOAuthRequestValidatorAdapter, INonceManager
 from pmr2.oauth.interfaces import IConsumerManager, ITokenManager
 from pmr2.oauth.interfaces import IScopeManager
 
+from pmr2.oauth.nonce import NonceRelease
 from pmr2.oauth.schema import buildSchemaInterface, CTSMMappingList
+from pmr2.oauth.signature import rsa_available
+from pmr2.oauth.signature import getHMAC
 
 SAFE_ASCII_CHARS = set([chr(i) for i in xrange(32, 127)])
 
+# Query strings accepted by oauthlib.common.urldecode: only the characters
+# permitted by it, with every % followed by two hex digits, except at the
+# very end where the hex digits may be missing.
+_valid_query_string = re.compile(r'[A-Za-z0-9_.\-=&;+~,*]*'
+    r'(?:%[0-9A-Fa-f]{2}[A-Za-z0-9_.\-=&;+~,*]*)*(?:%[0-9A-Fa-f]?)?\Z')
+# Escaped bytes outside of ASCII, which must also decode as UTF-8.
+_non_ascii_escape = re.compile(r'%[89A-Fa-f]')
+
 
 class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
     """
@@ -30,44 +48,102 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
 
     zope.interface.implements(IOAuthRequestValidatorAdapter)
 
+    # Only read the body of the request if it has the content type that
+    # will have its parameters included in the signature, as per RFC
+    # 5849 section 3.4.1.3.1.
+    form_encoded_body_only = True
+
     def __init__(self, site, request):
-        # consider adapting self rather than site for these managers?
-        # this might make it easier to provide a whole suite of managers
-        # for a given validator.
-        self.consumerManager = zope.component.getMultiAdapter(
-            (site, request), IConsumerManager)
-        self.tokenManager = zope.component.getMultiAdapter(
-            (site, request), ITokenManager)
-        self.callbackManager = zope.component.getMultiAdapter(
-            (site, request), ICallbackManager)
+        self.access_key = None
 
+        self.site = site
+        self.request = request
+
+        # results of the nonce checks made for this request.
+        self._nonces = {}
+        # consumers and tokens looked up for this request.
+        self._consumers = {}
+        self._request_tokens = {}
+        self._access_tokens = {}
+
+    # The managers are resolved once on first use, as this adapter is
+    # meant to be shared for the lifetime of the request (please see
+    # ``getRequestValidator``).
+
+    # consider adapting self rather than site for these managers?
+    # this might make it easier to provide a whole suite of managers
+    # for a given validator.
+
+    @Lazy
+    def consumerManager(self):
+        return zope.component.getMultiAdapter(
+            (self.site, self.request), IConsumerManager)
+
+    @Lazy
+    def tokenManager(self):
+        return zope.component.getMultiAdapter(
+            (self.site, self.request), ITokenManager)
+
+    @Lazy
+    def callbackManager(self):
+        return zope.component.getMultiAdapter(
+            (self.site, self.request), ICallbackManager)
+
+    @Lazy
+    def scopeManager(self):
         # Really should not be optional, but this is only used within
         # the ``invalidate_request_token`` method
-        self.scopeManager = zope.component.queryMultiAdapter(
-            (site, request), IScopeManager)
+        return zope.component.queryMultiAdapter(
+            (self.site, self.request), IScopeManager)
 
+    @Lazy
+    def nonceManager(self):
         # Optional at this point.
-        self.nonceManager = zope.component.queryMultiAdapter(
-            (site, request), INonceManager)
+        return zope.component.queryMultiAdapter(
+            (self.site, self.request), INonceManager)
 
-        self.access_key = None
+    # The dummies of the managers, which stand in for the missing
+    # consumers and tokens.
 
-        self.site = site
-        self.request = request
+    @Lazy
+    def dummyConsumer(self):
+        return self.consumerManager.makeDummy()
+
+    @Lazy
+    def dummyToken(self):
+        return self.tokenManager.makeDummy()
+
+    # Values extracted from the request, also only done once.
 
-        self.uri = safe_unicode(extractRequestURL(request))
-        self.http_method = safe_unicode(request.method)
+    @Lazy
+    def uri(self):
+        return safe_unicode(extractRequestURL(self.request))
 
+    @Lazy
+    def http_method(self):
+        return safe_unicode(self.request.method)
+
+    @Lazy
+    def headers(self):
         # These are the only headers that affect the signature for
         # an OAuth request.
-
-        self.headers = {
-            u'Content-type': safe_unicode(request.getHeader('Content-type')),
-            u'Authorization': safe_unicode(request._auth),
+        headers = {
+            u'Content-Type':
+                safe_unicode(self.request.getHeader('Content-type')),
         }
-
-        request.stdin.seek(0)
-        self.body = safe_unicode(request.stdin.read())
+        if self.request._auth:
+            headers[u'Authorization'] = safe_unicode(self.request._auth)
+        return headers
+
+    @Lazy
+    def body(self):
+        if (self.form_encoded_body_only and self.headers[u'Content-Type'] !=
+                CONTENT_TYPE_FORM_URLENCODED):
+            # Only form encoded bodies are part of the signature, so
+            # avoid reading what could be a very large upload.
+            return u''
+        self.request.stdin.seek(0)
+        return safe_unicode(self.request.stdin.read())
 
     def mark_request(self, oauth_request):
         """
@@ -88,6 +164,12 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         # configure this.
         return False
 
+    @property
+    def allowed_signature_methods(self):
+        if rsa_available:
+            return SIGNATURE_METHODS
+        return tuple(m for m in SIGNATURE_METHODS if m != SIGNATURE_RSA)
+
     @property
     def safe_characters(self):
         return SAFE_ASCII_CHARS
@@ -108,7 +190,10 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
     def nonce_length(self):
         return 8, 64
 
-    # Dummies to ensure near constant time validations.
+    # Dummies to ensure near constant time validations.  Missing
+    # consumers and tokens are substituted by the dummy records of the
+    # managers, which are built once and never looked up, such that the
+    # same steps are taken for the valid and the invalid values.
 
     @property
     def dummy_client(self):
@@ -117,48 +202,90 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
 
     @property
     def dummy_request_token(self):
-        token = self.tokenManager.get(self.tokenManager.DUMMY_KEY)
-        result = token and token.key or self.tokenManager.DUMMY_KEY
+        result = self.tokenManager.DUMMY_KEY
         return unicode(result)
 
     @property
     def dummy_access_token(self):
-        token = self.tokenManager.get(self.tokenManager.DUMMY_KEY)
-        result = token and token.key or self.tokenManager.DUMMY_KEY
+        result = self.tokenManager.DUMMY_KEY
         return unicode(result)
 
-    # Implementation
+    def _getConsumer(self, client_key):
+        """
+        Return the validated consumer for the client key, or None.
 
-    def get_client_secret(self, client_key, request):
+        The result is memoized, as the same consumer is needed by a
+        number of the validation steps of a request.  Valid or not, a
+        client key is looked up exactly once.
+        """
+
+        try:
+            return self._consumers[client_key]
+        except KeyError:
+            pass
         consumer = self.consumerManager.getValidated(client_key)
-        # Spend actual time failing.
-        dummy = self.consumerManager.getValidated(
-            self.consumerManager.DUMMY_KEY)
+        self._consumers[client_key] = consumer
+        return consumer
 
-        if consumer:
-            result = consumer.secret
-        else:
-            result = self.consumerManager.DUMMY_SECRET
+    def _getToken(self, tokens, getter, token_key, client_key):
+        """
+        Return the token for the token key from the getter if it was
+        issued to the client, otherwise the dummy token.
 
-        return unicode(result)
+        The token is memoized in tokens, so each token key is looked up
+        exactly once whether it is valid or not.
+        """
 
-    def get_request_token_secret(self, client_key, request_token, request):
-        token = self.tokenManager.getRequestToken(request_token, None)
-        if token and token.consumer_key == client_key:
-            result = token.secret
-        else:
-            result = self.tokenManager.DUMMY_SECRET
+        try:
+            token = tokens[token_key]
+        except KeyError:
+            token = tokens[token_key] = getter(token_key, None)
+        dummy = self.dummyToken
+        if token is None or token.consumer_key != client_key:
+            token = dummy
+        return token, dummy
+
+    def _getRequestToken(self, client_key, request_token):
+        return self._getToken(self._request_tokens,
+            self.tokenManager.getRequestToken, request_token, client_key)
+
+    def _getAccessToken(self, client_key, access_token):
+        return self._getToken(self._access_tokens,
+            self.tokenManager.getAccessToken, access_token, client_key)
 
-        return unicode(result)
+    # Implementation
+
+    def get_client_secret(self, client_key, request):
+        consumer = self._getConsumer(client_key) or self.dummyConsumer
+        return unicode(consumer.secret)
+
+    def get_request_token_secret(self, client_key, request_token, request):
+        token, dummy = self._getRequestToken(client_key, request_token)
+        return unicode(token.secret)
 
     def get_access_token_secret(self, client_key, access_token, request):
-        token = self.tokenManager.getAccessToken(access_token, None)
-        if token and token.consumer_key == client_key:
-            result = token.secret
-        else:
-            result = self.tokenManager.DUMMY_SECRET
+        token, dummy = self._getAccessToken(client_key, access_token)
+        return unicode(token.secret)
 
-        return unicode(result)
+    def get_hmac(self, client_key, resource_owner_key=None,
+            is_token_request=False):
+        """
+        Return the HMAC-SHA1 object prepared with the secrets of the
+        client and the request or access token, as per the arguments
+        for the secrets that oauthlib would have retrieved.
+        """
+
+        client_secret = self.get_client_secret(client_key, None)
+        token_secret = None
+        if resource_owner_key:
+            if is_token_request:
+                token_secret = self.get_request_token_secret(
+                    client_key, resource_owner_key, None)
+            else:
+                token_secret = self.get_access_token_secret(
+                    client_key, resource_owner_key, None)
+        return getHMAC(client_key, client_secret,
+            resource_owner_key, token_secret)
 
     def get_default_realms(self, client_key, request):
         return []
@@ -171,8 +298,8 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         raise NotImplementedError
 
     def get_rsa_key(self, client_key, request):
-        # TODO figure out how to implement this.
-        raise NotImplementedError
+        consumer = self._getConsumer(client_key)
+        return consumer and consumer.rsa_key or None
 
     def invalidate_request_token(self, client_key, request_token, request):
         # purge the scope
@@ -182,35 +309,68 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         token = self.tokenManager.getRequestToken(request_token, None)
         if token:
             self.tokenManager.remove(token)
+        self._request_tokens.pop(request_token, None)
 
     def validate_client_key(self, client_key, request):
-        # This will search through the table to acquire a failed dummy key
-        dummy = self.consumerManager.get(self.consumerManager.DUMMY_KEY,
-            self.consumerManager.makeDummy())
-        consumer = self.consumerManager.getValidated(client_key, dummy)
+        # A missing consumer is substituted by the dummy such that it is
+        # validated in the same way.
+        dummy = self.dummyConsumer
+        consumer = self._getConsumer(client_key) or dummy
         return consumer.validate() and consumer != dummy
 
     def validate_request_token(self, client_key, request_token, request):
         # XXX request_token <- token in parent
-        token = self.tokenManager.getRequestToken(request_token, 
-            self.dummy_request_token)
-        return (token != self.dummy_request_token and 
-            token.consumer_key == client_key)
+        token, dummy = self._getRequestToken(client_key, request_token)
+        return token is not dummy
 
     def validate_access_token(self, client_key, access_token, request):
-        token = self.tokenManager.getAccessToken(access_token, 
-            self.dummy_access_token)
-        return (token != self.dummy_access_token and 
-            token.consumer_key == client_key)
+        token, dummy = self._getAccessToken(client_key, access_token)
+        return token is not dummy
 
     def validate_timestamp_and_nonce(self, client_key, timestamp, nonce,
             request, request_token=None, access_token=None):
-        if self.nonceManager:
-            # TODO figure out the parameters.
-            return self.nonceManager.validate(timestamp, nonce)
-        # Just let this one go...
+        # This is called before the signature is verified, so recording
+        # the nonce here would let unsigned requests fill the nonce
+        # manager.  The nonce is reserved by ``reserve_nonce`` once the
+        # signature is verified instead, and the timestamp had already
+        # been checked by oauthlib.
         return True
 
+    def reserve_nonce(self, client_key, timestamp, nonce, token=None):
+        """
+        Record the use of the nonce with the nonce manager, returning
+        False if it was already used.
+
+        The nonce is released if the transaction is aborted due to a
+        conflict, such that the request can be retried.
+        """
+
+        if not self.nonceManager:
+            # Just let this one go...
+            return True
+
+        # The same request may be validated more than once, such as by
+        # the PAS plugin then by the token endpoint, so only the first
+        # check is recorded by the nonce manager.
+        key = (client_key, timestamp, nonce, token)
+        result = self._nonces.get(key, None)
+        if result is None:
+            result = self.nonceManager.check(
+                client_key, timestamp, nonce, token)
+            self._nonces[key] = result
+            if result and hasattr(self.nonceManager, 'release'):
+                self._getNonceRelease().add(*key)
+        return result
+
+    def _getNonceRelease(self):
+        txn = transaction.get()
+        release = getattr(self, '_nonce_release', None)
+        if release is None or release[0] is not txn:
+            release = (txn, NonceRelease(self.nonceManager))
+            txn.join(release[1])
+            self._nonce_release = release
+        return release[1]
+
     def validate_redirect_uri(self, client_key, redirect_uri, request):
         # Redirect URI will be external, verify that it is in the
         # same format as it was registered for the consumer.
@@ -219,7 +379,7 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
             return True
 
         # Only the token request will have this
-        consumer = self.consumerManager.getValidated(client_key)
+        consumer = self._getConsumer(client_key)
         return self.callbackManager.validate(consumer, redirect_uri)
 
     def validate_requested_realms(self, client_key, realms, request):
@@ -251,6 +411,26 @@ class SiteRequestValidatorAdapter(oauthlib.oauth1.RequestValidator):
         return
 
 
+def getRequestValidator(site, request):
+    """
+    Return the request validator adapter for the site and the request.
+
+    The adapter is only looked up once per request, subsequent calls
+    will return the same instance, which allows the managers and the
+    values extracted from the request to be reused.
+    """
+
+    # Only look at the instance dict, as the request object falls back
+    # to the form values for missing attributes.
+    cached = vars(request).get('_pmr2_oauth1_validator_', None)
+    if cached is not None and cached[0] is site:
+        return cached[1]
+
+    validator = zope.component.getMultiAdapter((site, request),
+        IOAuthRequestValidatorAdapter)
+    request._pmr2_oauth1_validator_ = (site, validator)
+    return validator
+
 def random_string(length):
     """
     Request a random string up to this length.
@@ -264,11 +444,32 @@ def random_string(length):
     actual = int(length / 4) * 3
     return base64.urlsafe_b64encode(os.urandom(actual))
 
+def isValidQueryString(query_string):
+    """
+    Return whether the query string would be accepted by oauthlib,
+    without decoding it unless it has escaped non-ASCII bytes.
+    """
+
+    if _valid_query_string.match(query_string) is None:
+        return False
+    if _non_ascii_escape.search(query_string) is None:
+        return True
+    try:
+        urldecode(query_string)
+    except ValueError:
+        return False
+    return True
+
 def extractRequestURL(request):
     # I am not sure why there isn't a thing that gets me the original
     # URI in the HTTP header and has to reconstruct all of this from
     # broken up pieces.
 
+    # Only look at the instance dict, as with getRequestValidator.
+    result = vars(request).get('_pmr2_oauth1_url_', None)
+    if result is not None:
+        return result
+
     actual_url = request.get('ACTUAL_URL', None)
     query_string = request.get('QUERY_STRING', None)
     
@@ -279,15 +480,14 @@ def extractRequestURL(request):
             # circumstances we are not getting back the original encoded
             # values that we used to sign the request.  This rectifies
             # that.
-            try:
-                urldecode(query_string)
-            except ValueError:
+            if not isValidQueryString(query_string):
                 query_string = quote_plus(query_string, safe='=&;%+~')
-            result += '?' + query_string
+            result = '%s?%s' % (actual_url, query_string)
     else:
         # fallback.
         result = request.getURL()
 
+    request._pmr2_oauth1_url_ = result
     return result
 
 def safe_unicode(s):
@@ -39,11 +39,16 @@ setup(name='pmr2.oauth',
           'zope.interface',
           'zope.schema',
           'zope.annotation',
+          'zope.cachedescriptors',
           'pmr2.z3cform',
       ],
       extras_require={
+          'rsa': [
+              'pycrypto',
+          ],
           'test': [
               'z3c.form [test]',
+              'pycrypto',
           ],
       },
       entry_points="""